@@ -5,7 +5,19 @@ See LICENSE for license information.
 InterLivreApp@gmail.com
 """
 
-from ilviewcontroller import ILViewController
+import sys
+from multiprocessing import freeze_support
+import startupprofile
 
 if __name__ == '__main__':
+    # Chapters are interleaved in worker processes, which need this when the app is frozen
+    freeze_support()
+    # --startup-profile prints import times and time to the first window or command line ready to stderr
+    startupprofile.enable()
+    import ilcli
+    if len(sys.argv) > 1 and (sys.argv[1] in ilcli.COMMANDS or sys.argv[1] in ('-h', '--help')):
+        # Command line mode for headless hosts
+        sys.exit(ilcli.main())
+    from ilviewcontroller import ILViewController
+    startupprofile.mark("Modules imported")
     controller = ILViewController()
@@ -0,0 +1,264 @@
+"""
+InterLivre, audiobook splicer
+
+asyncio API for embedding the interleaving pipeline in services
+
+Example:
+    job = start_interleave_book(src1_dir, src2_dir, dst_dir, settings)
+    async for progress, msg in job:
+        print(progress, msg)
+    await job
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import asyncio
+import logging
+from os import remove
+from threading import Event
+from audiotools import AsyncAudioConvertor
+from pipeline import JobSettings, Pipeline, run_chapter_task
+from scheduler import ChapterScheduler
+import utils
+
+# Maximum number of FFmpeg/ffprobe processes each job runs at the same time
+DEFAULT_MAX_PROCESSES = 4
+# Time between reads of the progress the chapter workers send to the scheduler
+PROGRESS_POLL_SECONDS = 0.1
+
+_shared_scheduler = None
+
+
+def get_shared_scheduler():
+    """Returns the ChapterScheduler shared by every job that doesn't bring its own."""
+    global _shared_scheduler
+    if _shared_scheduler is None:
+        _shared_scheduler = ChapterScheduler()
+    return _shared_scheduler
+
+
+async def _gather(aws):
+    """Like asyncio.gather(), but cancels the remaining awaitables as soon as one of them fails."""
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class _AsyncStatusQueue:
+    """Forwards (progress, message) status tuples from any thread onto an asyncio.Queue."""
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def put(self, status):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, status)
+
+
+class InterleaveJob:
+    """Interleaves one pair of books on the running event loop.
+
+    FFmpeg and ffprobe run as asyncio subprocesses, file operations run in the default executor, and chapters are
+    interleaved in worker processes by a ChapterScheduler, which may be shared between many jobs.
+
+    The job is awaitable, and iterating over it with `async for` yields (progress, message) tuples until it finishes.
+    Cancelling the job kills its FFmpeg processes, drops its queued chapters, stops its running ones, leaving the
+    chapters of other jobs on the same scheduler alone, and removes the partial files. A job that fails is cleaned up
+    the same way.
+
+    Attributes:
+        settings (JobSettings): Job to run.
+        chapter_scheduler (ChapterScheduler): Runs the chapter tasks.
+    """
+
+    def __init__(self, settings, chapter_scheduler=None, max_processes=DEFAULT_MAX_PROCESSES):
+        self.settings = settings
+        self.chapter_scheduler = chapter_scheduler if chapter_scheduler is not None else get_shared_scheduler()
+        self.max_processes = max_processes
+        self._task = None
+        self._progress = None
+        self._progress_done = False
+        self._cancel_event = Event()
+        self._chapter_futures = []
+
+    def start(self):
+        """Starts the job on the running event loop and returns self."""
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._progress = asyncio.Queue()
+            self._task = loop.create_task(self._run(loop))
+        return self
+
+    def cancel(self):
+        """Cancels the job."""
+        if self._task is not None:
+            self._task.cancel()
+
+    def done(self):
+        """Returns True once the job has finished, failed, or been cancelled."""
+        return self._task is not None and self._task.done()
+
+    def __await__(self):
+        return self.start()._task.__await__()
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        if self._progress_done:
+            raise StopAsyncIteration
+        status = await self._progress.get()
+        if status is None:
+            self._progress_done = True
+            raise StopAsyncIteration
+        return status
+
+    async def wait_for_chapters(self, tasks, status_queue):
+        """Waits for the chapter tasks, reporting the progress the workers send to the scheduler."""
+        keys = {asyncio.wrap_future(f): task.dst_path for f, task in zip(self._chapter_futures, tasks)}
+        pending = set(keys)
+        last_status = None
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, timeout=PROGRESS_POLL_SECONDS)
+                for f in done:
+                    f.result()
+                percents = self.chapter_scheduler.poll_progress()
+                finished = len(tasks) - len(pending)
+                running = sum(utils.clamp(percents.get(keys[f], 0), 0, 100) for f in pending) / 100.0
+                status = (int((finished + running) / len(tasks) * 100.0),
+                          f"Processing chapters, {finished}/{len(tasks)} done")
+                if status != last_status:
+                    status_queue.put(status)
+                    last_status = status
+        finally:
+            self.chapter_scheduler.forget_progress(list(keys.values()))
+
+    async def _run(self, loop):
+        status_queue = _AsyncStatusQueue(loop, self._progress)
+        pipeline = Pipeline(self.settings, status_queue=status_queue, cancel=self._cancel_event)
+        fm = pipeline.filemanager
+        convertor = AsyncAudioConvertor(self.settings.tmp_audio_format)
+        processes = asyncio.Semaphore(self.max_processes)
+        try:
+            if self.settings.is_valid() is False:
+                raise ValueError("Book 1, book 2 and output folders and the output name are required")
+            await loop.run_in_executor(None, pipeline.preflight)
+            await loop.run_in_executor(None, pipeline.plan_resume)
+            if len(pipeline.chapter_numbers) == 0:
+                status_queue.put((100, "Finished! Every chapter was already up to date"))
+                return []
+            status_queue.put((1, "Creating temporary workspace"))
+            await loop.run_in_executor(None, pipeline.create_workspace)
+            convertor.probe_cache = pipeline.probe_cache
+
+            # Convert the input files
+            tmp_paths = [p for p in fm.get_tmp_input_paths() if p not in pipeline.cached_inputs]
+            converted = [0]
+
+            async def convert_input(fpath):
+                async with processes:
+                    auformat = await convertor.get_audio_format(fm.get_source_path(fpath))
+                    if convertor.output_format.equals(auformat) is False:
+                        inpath, outpath = fm.begin_tmp_conversion(fpath)
+                        if not await convertor.convert(inpath, outpath):
+                            raise RuntimeError(f"Couldn't convert {fm.get_source_path(fpath)}")
+                        fm.finish_tmp_conversion(inpath)
+                converted[0] += 1
+                status_queue.put((converted[0] / len(tmp_paths) * 100.0,
+                                  f"Converting input files, {converted[0]}/{len(tmp_paths)} done"))
+
+            await _gather([convert_input(p) for p in tmp_paths])
+            await loop.run_in_executor(None, pipeline.cache_converted_inputs)
+
+            # Interleave the chapters in worker processes
+            tasks = await loop.run_in_executor(None, pipeline.plan_chapters)
+
+            async def probe_durations(task):
+                async with processes:
+                    return [await convertor.get_duration(task.src_path_1), await convertor.get_duration(task.src_path_2)]
+
+            durations = await _gather([probe_durations(t) for t in tasks])
+            for task, d in zip(tasks, durations):
+                estimate = pipeline.estimate_memory(task, d)
+                self._chapter_futures.append(self.chapter_scheduler.submit(run_chapter_task, task, estimate))
+            await self.wait_for_chapters(tasks, status_queue)
+            await loop.run_in_executor(None, pipeline.join_shards, tasks)
+
+            # Convert the interleaved chapters into the output format
+            convertor.output_format = self.settings.dst_audio_format
+            conversions = fm.get_output_conversions(convertor.output_format.file_format)
+
+            async def convert_output(f_in, f_out):
+                async with processes:
+                    if not await convertor.convert(f_in, f_out):
+                        raise RuntimeError(f"Couldn't convert {f_in} into {f_out}")
+                remove(f_in)
+                await loop.run_in_executor(None, pipeline.record_output, f_out)
+
+            await _gather([convert_output(f_in, f_out) for f_in, f_out in conversions])
+            status_queue.put((100, "Finished!"))
+            return [f_out for f_in, f_out in conversions]
+        except asyncio.CancelledError:
+            await self._stop(loop, pipeline)
+            raise
+        except Exception as e:
+            logging.exception(e)
+            # Don't leave the job's other chapters running on the shared scheduler after it has failed
+            await self._stop(loop, pipeline)
+            raise
+        finally:
+            pipeline.remove_cancel_file()
+            # Posted the same way as the statuses, so it ends up behind every status already sent from other threads
+            status_queue.put(None)
+
+    async def _stop(self, loop, pipeline):
+        """Stops the job's chapters and removes its partial files, after it was cancelled or failed."""
+        self._cancel_event.set()
+        # The workers only see the cancel file, wait for them so they're done with the tmp files
+        await loop.run_in_executor(None, pipeline.cancel_chapters, self._chapter_futures)
+        await loop.run_in_executor(None, pipeline.remove_partial_files)
+
+
+def start_interleave_book(src1_dir, src2_dir, dst_dir, settings=None, chapter_scheduler=None):
+    """Starts interleaving a pair of books on the running event loop.
+
+    Args:
+        src1_dir (str): Path to a directory containing the book 1 audio files.
+        src2_dir (str): Path to a directory containing the book 2 audio files.
+        dst_dir (str): Path to a directory to write the interleaved audio files.
+        settings (JobSettings or dict): Remaining job settings. The directories above take precedence.
+        chapter_scheduler (ChapterScheduler): Scheduler to run chapters on, defaults to one shared by every job.
+
+    Returns:
+        InterleaveJob: The running job.
+    """
+    if settings is None:
+        settings = JobSettings()
+    elif isinstance(settings, dict):
+        settings = JobSettings.from_dict(settings)
+    else:
+        settings = JobSettings.from_dict(settings.to_dict())
+    settings.src1_dir = src1_dir
+    settings.src2_dir = src2_dir
+    settings.dst_dir = dst_dir
+    return InterleaveJob(settings, chapter_scheduler).start()
+
+
+async def interleave_book(src1_dir, src2_dir, dst_dir, settings=None, chapter_scheduler=None):
+    """Interleaves a pair of books. See start_interleave_book.
+
+    Returns:
+        list(str): Paths to the output files made by this job. Chapters that were already up to date are left out.
+    """
+    return await start_interleave_book(src1_dir, src2_dir, dst_dir, settings, chapter_scheduler)
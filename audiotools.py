@@ -6,8 +6,12 @@ InterLivreApp@gmail.com
 """
 
 import logging
-from os.path import isfile
+from os import remove
+from os.path import basename, getsize, isfile
 from pubsub import pub
+from probecache import ProbeCache
+import metrics
+import tracing
 import utils
 import subprocess
 import json
@@ -17,6 +21,32 @@ SAMPLE_RATES = (8000, 16000, 24000, 32000, 44100, 48000, 96000)
 BIT_DEPTHS = (16, 32)
 CHANNEL_COUNTS = (1, 2)
 FILE_FORMATS = ('wav', 'mp3')
+# Maximum number of files converted by a single FFmpeg process in a batch conversion
+BATCH_GROUP_SIZE = 16
+# How often a running FFmpeg or ffprobe process checks whether the job has been cancelled
+CANCEL_POLL_SECONDS = 0.05
+
+
+class CancelledError(Exception):
+    """Raised when FFmpeg or ffprobe is stopped because the job was cancelled."""
+
+
+def remove_partial(path):
+    """Removes a file that FFmpeg may have only partly written."""
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.exception(e)
+
+
+def record_process(tool, returncode):
+    """Counts an FFmpeg or ffprobe process and its exit code in the metrics registry."""
+    metrics.counter("ffmpeg_processes_total", "FFmpeg and ffprobe processes run").inc(tool=tool)
+    metrics.counter("ffmpeg_exit_codes_total", "Exit codes of FFmpeg and ffprobe processes").inc(tool=tool,
+                                                                                                 code=returncode)
+
 
 class AudioFormat:
     """Audio format parameters (e.g. sample rate, bit depth, channel counts, and file type)."""
@@ -138,10 +168,14 @@ class AudioConvertor:
 
     Attributes:
         output_format (AudioFormat): Output audio format to use when converting audio files.
+        probe_cache (ProbeCache): ffprobe results, so each unchanged file is only probed once.
+        cancel_event: Kills the running FFmpeg or ffprobe process when set. May be None.
     """
 
-    def __init__(self, output_format):
+    def __init__(self, output_format, probe_cache=None, cancel=None):
         self.output_format = output_format
+        self.probe_cache = probe_cache if probe_cache is not None else ProbeCache()
+        self.cancel_event = cancel
 
     # region info
     def get_sample_rate(self, in_path):
@@ -156,6 +190,10 @@ class AudioConvertor:
         """Get the bit depth of an audio file."""
         return AudioFormat.bit_depth_from_string(self.probe(in_path)['sample_fmt'])
 
+    def get_duration(self, in_path):
+        """Get the duration of an audio file in seconds."""
+        return float(self.probe(in_path).get('duration', 0.0))
+
     def get_audio_format(self, in_path):
         """Returns an AudioFormat object describing an audio file on disk.
 
@@ -169,34 +207,166 @@ class AudioConvertor:
         ext = utils.get_extension(in_path)
         return AudioFormat(sr, bt, ch, ext)
 
-    def convert(self, in_path, out_path):
+    def convert(self, in_path, out_path, max_seconds=None):
         """Convert an input file into the chosen output format.
 
         Uses FFmpeg to convert a file on disk into the output format set in the output_format attribute via subprocess.
-        The FFmpeg options include the '-y' flag, which enables overwriting existing files.
+        The FFmpeg options include the '-y' flag, which enables overwriting existing files. If the job is cancelled,
+        FFmpeg is killed and the partly written output is removed.
 
         Args:
             in_path (str): Path to the input audio file to convert.
             out_path (str): Path to the output audio file to write.
+            max_seconds (float): Only convert this many seconds from the start of the input, None for all of it.
+
+        Returns:
+            bool: True if FFmpeg finished without an error.
+        """
+        args = self.convert_args(in_path, out_path, max_seconds)
+        if utils.is_cancelled(self.cancel_event):
+            return False
+        try:
+            with tracing.span("ffmpeg.convert", cat="ffmpeg", source=basename(in_path), output=basename(out_path)):
+                returncode, out = self.run_process(args)
+            return returncode == 0
+        except CancelledError:
+            remove_partial(out_path)
+        except Exception as e:
+            logging.exception(e)
+        return False
+
+    def run_process(self, args, tool="ffmpeg", cancel=None):
+        """Runs FFmpeg or ffprobe and waits for it to finish, killing it if the job is cancelled meanwhile.
+
+        Args:
+            args (list(str)): Command line to run.
+            tool (str): 'ffmpeg' or 'ffprobe', used for the metrics.
+            cancel: Kills the process when set, within CANCEL_POLL_SECONDS. Defaults to cancel_event.
+
+        Returns:
+            A tuple containing the exit code and the standard output of the process.
+
+        Raises:
+            CancelledError: If the job was cancelled before or while the process ran.
+        """
+        cancel = cancel if cancel is not None else self.cancel_event
+        if utils.is_cancelled(cancel):
+            raise CancelledError(f"Cancelled before starting {tool}")
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while True:
+            try:
+                out, err = p.communicate(timeout=CANCEL_POLL_SECONDS if cancel is not None else None)
+                break
+            except subprocess.TimeoutExpired:
+                # communicate() can be called again after a timeout without losing any output
+                if utils.is_cancelled(cancel):
+                    p.kill()
+                    p.communicate()
+                    record_process(tool, "cancelled")
+                    raise CancelledError(f"Cancelled while {tool} was running")
+        record_process(tool, p.returncode)
+        return p.returncode, out
+
+    def convert_args(self, in_path, out_path, max_seconds=None):
+        """Validates the paths for a conversion and returns the FFmpeg command line to run it.
+
+        Raises:
+            FileNotFoundError: If in_path doesn't exist.
+            ValueError: If either path has an unsupported file extension.
         """
+        self.check_paths(in_path, out_path)
+        # Limiting the duration stops FFmpeg from decoding the rest of the input
+        duration = ['-t', str(max_seconds)] if max_seconds is not None else []
+        return [utils.resource_path("ffmpeg", dbg="./ffmpeg"),
+                '-i', in_path] + duration + [
+                '-ac', str(self.output_format.channels),
+                '-ar', str(self.output_format.sample_rate),
+                '-sample_fmt', AudioFormat.bit_depth_to_string(self.output_format.bit_depth),
+                '-loglevel', 'quiet',
+                out_path, '-y']
+
+    def check_paths(self, in_path, out_path):
+        """Validates the paths for a conversion. See convert_args."""
         if isfile(in_path) is False:
             raise FileNotFoundError(f"Couldn't find input file {in_path}")
         if utils.get_extension(in_path) not in FILE_FORMATS:
             raise ValueError("Invalid input file extension")
         if utils.get_extension(out_path) not in FILE_FORMATS:
             raise ValueError("Invalid output file extension")
-        try:
-            args = [utils.resource_path("ffmpeg", dbg="./ffmpeg"),
-                    '-i', in_path,
-                    '-ac', str(self.output_format.channels),
-                    '-ar', str(self.output_format.sample_rate),
-                    '-sample_fmt', AudioFormat.bit_depth_to_string(self.output_format.bit_depth),
-                    '-loglevel', 'quiet',
-                    out_path, '-y']
-            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            p.communicate()
-        except Exception as e:
-            logging.exception(e)
+
+    def convert_batch(self, conversions, group_size=BATCH_GROUP_SIZE, on_output=None, cancel=None):
+        """Converts many files into the output format with one FFmpeg process per group of files.
+
+        Starting FFmpeg and initializing its codecs once per group instead of once per file saves most of the
+        runtime for short files. If a group fails, each file in it that wasn't written is converted on its own.
+
+        Args:
+            conversions (list(tuple)): (input path, output path) tuples.
+            group_size (int): Maximum number of files converted by each FFmpeg process.
+            on_output (function): Called as on_output(index, out_path, ok) as each output is finished, where index
+                is the position of the conversion in the list and ok is False if it couldn't be converted, in which
+                case out_path has been removed.
+            cancel: Kills the running FFmpeg process when set, and removes the outputs of its group. Defaults to
+                cancel_event.
+
+        Returns:
+            list(str): Output paths that couldn't be converted.
+        """
+        cancel = cancel if cancel is not None else self.cancel_event
+        failed = []
+        for group_start in range(0, len(conversions), max(1, group_size)):
+            if utils.is_cancelled(cancel):
+                break
+            group = conversions[group_start:group_start + group_size]
+            try:
+                with tracing.span("ffmpeg.convert_batch", cat="ffmpeg", files=len(group),
+                                  source=basename(group[0][0])):
+                    returncode, out = self.run_process(self.batch_args(group), cancel=cancel)
+                group_ok = returncode == 0
+            except CancelledError:
+                for in_path, out_path in group:
+                    remove_partial(out_path)
+                break
+            except Exception as e:
+                logging.exception(e)
+                group_ok = False
+            for i, (in_path, out_path) in enumerate(group):
+                ok = group_ok and isfile(out_path) and getsize(out_path) > 0
+                if not ok and utils.is_cancelled(cancel):
+                    # Don't start any more FFmpeg processes, a later run converts the rest of the group
+                    break
+                if not ok:
+                    # Fall back to converting this file on its own
+                    try:
+                        ok = self.convert(in_path, out_path) and isfile(out_path) and getsize(out_path) > 0
+                    except Exception as e:
+                        logging.exception(e)
+                if not ok:
+                    # Don't leave a partial output that could be taken for a converted file
+                    remove_partial(out_path)
+                    failed.append(out_path)
+                if on_output is not None:
+                    on_output(group_start + i, out_path, ok)
+        return failed
+
+    def batch_args(self, conversions):
+        """Returns the FFmpeg command line converting every (input path, output path) tuple in one process.
+
+        Raises:
+            FileNotFoundError: If an input path doesn't exist.
+            ValueError: If a path has an unsupported file extension.
+        """
+        args = [utils.resource_path("ffmpeg", dbg="./ffmpeg"), '-loglevel', 'quiet', '-y']
+        for in_path, out_path in conversions:
+            self.check_paths(in_path, out_path)
+            args += ['-i', in_path]
+        for i, (in_path, out_path) in enumerate(conversions):
+            args += ['-map', f'{i}:a:0',
+                     '-ac', str(self.output_format.channels),
+                     '-ar', str(self.output_format.sample_rate),
+                     '-sample_fmt', AudioFormat.bit_depth_to_string(self.output_format.bit_depth),
+                     out_path]
+        return args
 
     def probe(self, in_path):
         """Reads audio file metadata using ffprobe via subprocess.
@@ -206,9 +376,84 @@ class AudioConvertor:
 
         Returns:
             The first 'streams' dictionary instance from ffprobe.
+
+        Raises:
+            CancelledError: If the job was cancelled before or while ffprobe ran.
         """
-        args = [utils.resource_path("./ffprobe", dbg="./ffmpeg"), '-show_format', '-show_streams', '-of', 'json', in_path]
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
+        info = self.probe_cache.get(in_path)
+        if info is None:
+            with tracing.span("ffprobe", cat="ffmpeg", source=basename(in_path)):
+                returncode, out = self.run_process(self.probe_args(in_path), tool="ffprobe")
+            info = self.parse_probe(out)
+            self.probe_cache.put(in_path, info)
+        return info
+
+    def probe_args(self, in_path):
+        """Returns the ffprobe command line used to read audio file metadata."""
+        return [utils.resource_path("./ffprobe", dbg="./ffmpeg"), '-show_format', '-show_streams', '-of', 'json', in_path]
+
+    @classmethod
+    def parse_probe(cls, out):
+        """Returns the first 'streams' dictionary instance from ffprobe's json output."""
         return json.loads(out.decode('utf-8'))['streams'][0]
     # endregion
+
+
+class AsyncAudioConvertor(AudioConvertor):
+    """AudioConvertor that runs FFmpeg and ffprobe with asyncio subprocesses instead of blocking the caller.
+
+    Cancelling a coroutine that is waiting on FFmpeg kills the FFmpeg process.
+    """
+
+    async def _run(self, args, tool="ffmpeg"):
+        # Only the asyncio API needs asyncio, the GUI and command line don't pay for importing it
+        import asyncio
+        p = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await p.communicate()
+        except asyncio.CancelledError:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            raise
+        record_process(tool, p.returncode)
+        return p.returncode, out
+
+    async def get_duration(self, in_path):
+        """Get the duration of an audio file in seconds."""
+        return float((await self.probe(in_path)).get('duration', 0.0))
+
+    async def get_audio_format(self, in_path):
+        """Returns an AudioFormat object describing an audio file on disk."""
+        info = await self.probe(in_path)
+        return AudioFormat(int(info['sample_rate']), AudioFormat.bit_depth_from_string(info['sample_fmt']),
+                           info['channels'], utils.get_extension(in_path))
+
+    async def convert(self, in_path, out_path):
+        """Convert an input file into the chosen output format. See AudioConvertor.convert.
+
+        Returns:
+            bool: True if FFmpeg finished without an error. The partly written output is removed if it didn't, or if
+                the coroutine was cancelled.
+        """
+        import asyncio
+        try:
+            returncode, out = await self._run(self.convert_args(in_path, out_path))
+        except asyncio.CancelledError:
+            remove_partial(out_path)
+            raise
+        if returncode != 0:
+            logging.error(f"FFmpeg exited with code {returncode} converting {in_path}")
+            remove_partial(out_path)
+            return False
+        return True
+
+    async def probe(self, in_path):
+        """Reads audio file metadata using ffprobe. See AudioConvertor.probe."""
+        info = self.probe_cache.get(in_path)
+        if info is None:
+            returncode, out = await self._run(self.probe_args(in_path), tool="ffprobe")
+            info = self.parse_probe(out)
+            self.probe_cache.put(in_path, info)
+        return info
@@ -0,0 +1,239 @@
+"""
+InterLivre, audiobook splicer
+
+Batch mode that interleaves many book pairs in one run, feeding every book's chapters to one pool of workers
+
+A batch file is a JSON object with a list of books. Each book holds JobSettings applied over the batch's own
+settings, and relative paths are taken from the batch file's folder. dst_name defaults to the dst_dir folder name.
+
+Example:
+    {"settings": {"seg_size_min": 5, "seg_size_max": 18, "dst_file_format": "mp3"},
+     "books": [{"src1_dir": "dune/en", "src2_dir": "dune/fr", "dst_dir": "out/dune"},
+               {"src1_dir": "emma/en", "src2_dir": "emma/fr", "dst_dir": "out/emma", "seg_size_max": 25}]}
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, basename, dirname, join as pjoin, normpath, realpath
+from convcache import ConversionCache, CACHE_DIRECTORY
+from filemanager import TMP_DIRECTORY
+from pipeline import JobSettings, Pipeline
+from preflight import PreflightError
+from probecache import ProbeCache, PROBE_CACHE_FILENAME
+from progress import REPORT_INTERVAL_SECONDS
+from scheduler import ChapterScheduler
+import metrics
+import utils
+
+# Books that are checked, converted and queued at the same time. Their chapters are admitted in book order, so the
+# later ones only fill the workers the earlier ones leave idle, e.g. while a book converts its inputs.
+DEFAULT_ACTIVE_BOOKS = 2
+PATH_SETTINGS = ("src1_dir", "src2_dir", "dst_dir", "trace_path")
+
+
+class BatchJob:
+    """Settings of every book in a batch.
+
+    Attributes:
+        books (list(JobSettings)): Books to interleave, in the order their chapters are queued.
+        settings (JobSettings): Settings shared by every book. Its max_jobs and memory_budget size the worker pool.
+        cache_dir (str): Directory of the probe and conversion caches shared by every book, None for the tmp
+            directory of the first book.
+    """
+
+    def __init__(self, books, settings=None, cache_dir=None):
+        self.books = books
+        self.settings = settings if settings is not None else JobSettings()
+        self.cache_dir = cache_dir
+
+    @classmethod
+    def from_dict(cls, d, base_dir=None):
+        """Returns a BatchJob from a dictionary, such as one loaded from a batch file.
+
+        Args:
+            d (dict): Batch with a list of "books", and optional shared "settings" and "cache_dir".
+            base_dir (str): Folder relative paths are taken from, None for the working directory.
+
+        Raises:
+            ValueError: If the batch has no books, a book is missing a path or has unknown settings, or two books
+                share an output folder, whose workspace and manifest only one book at a time may use.
+        """
+        if not isinstance(d, dict) or not isinstance(d.get("books"), list) or len(d["books"]) == 0:
+            raise ValueError("A batch needs a list of books")
+        base = d.get("settings", {})
+        try:
+            settings = JobSettings.from_dict(base)
+        except TypeError as e:
+            raise ValueError(f"Unknown batch setting: {e}")
+        books = []
+        dst_dirs = set()
+        for i, book in enumerate(d["books"]):
+            book_dict = dict(base)
+            book_dict.update(book)
+            for key in PATH_SETTINGS:
+                if book_dict.get(key):
+                    book_dict[key] = cls.resolve_path(book_dict[key], base_dir)
+            if not book_dict.get("dst_name") and book_dict.get("dst_dir"):
+                book_dict["dst_name"] = basename(normpath(book_dict["dst_dir"]))
+            try:
+                book_settings = JobSettings.from_dict(book_dict)
+            except TypeError as e:
+                raise ValueError(f"Book {i + 1}: unknown setting: {e}")
+            if not book_settings.is_valid():
+                raise ValueError(f"Book {i + 1}: src1_dir, src2_dir and dst_dir are required")
+            dst_dir = realpath(book_settings.dst_dir)
+            if dst_dir in dst_dirs:
+                raise ValueError(f"Book {i + 1}: another book already writes to {book_settings.dst_dir}, give each "
+                                 f"book its own dst_dir")
+            dst_dirs.add(dst_dir)
+            books.append(book_settings)
+        cache_dir = d.get("cache_dir")
+        return cls(books, settings, cls.resolve_path(cache_dir, base_dir) if cache_dir else None)
+
+    @classmethod
+    def load(cls, path):
+        """Returns the BatchJob saved in a JSON batch file."""
+        with open(path) as f:
+            d = json.load(f)
+        return cls.from_dict(d, dirname(abspath(path)))
+
+    @classmethod
+    def resolve_path(cls, path, base_dir):
+        return abspath(pjoin(base_dir, path)) if base_dir is not None else abspath(path)
+
+    def get_cache_dir(self):
+        """Returns the directory of the shared caches."""
+        if self.cache_dir is not None:
+            return self.cache_dir
+        return pjoin(self.books[0].dst_dir, TMP_DIRECTORY)
+
+
+class _BookStatusQueue:
+    """Passes the progress of one book in a batch on to the BatchRunner."""
+
+    def __init__(self, runner, index):
+        self.runner = runner
+        self.index = index
+
+    def put(self, status):
+        progress, msg = status
+        self.runner.update_book(self.index, progress / 100.0 if progress >= 0 else None, msg)
+
+    def put_progress(self, snapshot):
+        self.runner.update_book(self.index, snapshot["progress"] / 100.0, snapshot["message"],
+                                snapshot["audio_seconds_total"])
+
+
+class BatchRunner:
+    """Interleaves every book of a BatchJob on one ChapterScheduler, with shared probe and conversion caches.
+
+    A few books run at the same time, each in its own thread, and the next one starts as soon as one finishes. Every
+    book's chapters are queued on the same scheduler with the book's position in the batch as their priority, so the
+    workers stay busy across book boundaries while the books still finish roughly in order.
+
+    Attributes:
+        batch (BatchJob): Books to interleave.
+        status_queue: Receives (progress, message) tuples for the whole batch through put(). May be None.
+        cancel_event: Cancels the batch when set.
+        max_active_books (int): Number of books run at the same time.
+        results (list(dict)): Name, output folder, result, error and output files of each book, set by run().
+    """
+
+    def __init__(self, batch, status_queue=None, cancel=None, max_active_books=DEFAULT_ACTIVE_BOOKS):
+        self.batch = batch
+        self.status_queue = status_queue
+        self.cancel_event = cancel if cancel is not None else threading.Event()
+        self.max_active_books = max(1, max_active_books)
+        self.results = [{"name": b.dst_name, "dst_dir": b.dst_dir, "result": "queued", "error": None, "outputs": []}
+                        for b in batch.books]
+        self._lock = threading.Lock()
+        # Fraction done and seconds of audio of each book, the audio is None until the book's preflight is done
+        self._fractions = [0.0] * len(batch.books)
+        self._audio_seconds = [None] * len(batch.books)
+        self._last_report = None
+
+    def run(self):
+        """Interleaves every book and returns the results.
+
+        A book that fails doesn't stop the others, so check the results rather than the status queue for failures.
+        """
+        cache_dir = self.batch.get_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        probe_cache = ProbeCache(pjoin(cache_dir, PROBE_CACHE_FILENAME))
+        conversion_cache = ConversionCache(pjoin(cache_dir, CACHE_DIRECTORY), self.batch.settings.cache_max_bytes)
+        chapter_scheduler = ChapterScheduler(memory_budget=self.batch.settings.memory_budget,
+                                             max_workers=self.batch.settings.max_jobs)
+        self.update_status(1, f"Interleaving {len(self.batch.books)} books")
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_active_books, thread_name_prefix="InterLivreBatch") as pool:
+                for i in range(len(self.batch.books)):
+                    pool.submit(self._run_book, i, chapter_scheduler, probe_cache, conversion_cache)
+        finally:
+            if utils.is_cancelled(self.cancel_event):
+                # Nothing else runs on this scheduler, kill the workers instead of waiting for them
+                chapter_scheduler.terminate()
+            chapter_scheduler.shutdown()
+            probe_cache.close()
+        return self.results
+
+    def _run_book(self, index, chapter_scheduler, probe_cache, conversion_cache):
+        settings = self.batch.books[index]
+        result = self.results[index]
+        if utils.is_cancelled(self.cancel_event):
+            result["result"] = "cancelled"
+            return
+        result["result"] = "running"
+        pipeline = Pipeline(settings, status_queue=_BookStatusQueue(self, index), cancel=self.cancel_event,
+                            chapter_scheduler=chapter_scheduler, priority=index, probe_cache=probe_cache,
+                            conversion_cache=conversion_cache)
+        try:
+            os.makedirs(settings.dst_dir, exist_ok=True)
+            pipeline.run()
+            result["result"] = "cancelled" if utils.is_cancelled(self.cancel_event) else "finished"
+        except PreflightError as e:
+            result["result"] = "preflight_error"
+            result["error"] = str(e)
+            logging.error(f"{settings.dst_name}: {e}")
+        except Exception as e:
+            result["result"] = "failed"
+            result["error"] = str(e)
+            logging.exception(e)
+        finally:
+            result["outputs"] = list(pipeline.output_paths)
+            metrics.counter("batch_books_total", "Books processed in batch mode").inc(result=result["result"])
+            if result["result"] != "cancelled":
+                self.update_book(index, 1.0, result["result"].replace("_", " ").capitalize(), force=True)
+
+    def update_book(self, index, fraction, msg, audio_seconds=None, force=False):
+        """Records the progress of one book and reports the batch's progress if the report interval has passed.
+
+        Books are weighted by their audio duration once it's known, and by the average of the known ones until then.
+        """
+        with self._lock:
+            if fraction is not None:
+                self._fractions[index] = utils.clamp(fraction, 0.0, 1.0)
+            if audio_seconds is not None:
+                self._audio_seconds[index] = audio_seconds
+            now = time.monotonic()
+            if not force and self._last_report is not None and now - self._last_report < REPORT_INTERVAL_SECONDS:
+                return
+            self._last_report = now
+            known = [s for s in self._audio_seconds if s is not None and s > 0]
+            default = sum(known) / len(known) if len(known) > 0 else 1.0
+            weights = [s if s is not None and s > 0 else default for s in self._audio_seconds]
+            progress = 100.0 * sum(w * f for w, f in zip(weights, self._fractions)) / sum(weights)
+            done = sum(1 for r in self.results if r["result"] not in ("queued", "running"))
+        self.update_status(utils.clamp(progress, 1, 99), f"[{done}/{len(self.results)} books] "
+                                                          f"{self.batch.books[index].dst_name}: {msg}")
+
+    def update_status(self, progress, msg):
+        if self.status_queue is not None:
+            self.status_queue.put((progress, msg))
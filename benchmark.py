@@ -0,0 +1,251 @@
+"""
+InterLivre, audiobook splicer
+
+Micro-benchmarks of the segmentation and interleaving hot paths on synthetic speech, with results saved as JSON
+
+Example:
+    python benchmark.py --durations 1m 10m 1h --output before.json
+    python benchmark.py --durations 1m 10m 1h --output after.json --compare before.json
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import numpy as np
+from interleaver import Interleaver
+from silencemap import SilenceMap, MIN_SILENCE_SECONDS
+from synthspeech import SyntheticSpeech, PAUSE_DISTRIBUTIONS
+import utils
+
+DEFAULT_DURATIONS = ["1m", "10m", "1h"]
+DEFAULT_REPEAT = 5
+# Book 2 is this much longer than book 1, like a translation read at a different pace
+BOOK2_LENGTH_RATIO = 1.07
+RESULTS_VERSION = 2
+
+
+def parse_duration(s):
+    """Parses a duration such as 90, 90s, 10m or 1.5h into seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    try:
+        if s[-1] in units:
+            return float(s[:-1]) * units[s[-1]]
+        return float(s)
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError(f"expected a duration like 90s, 10m or 1h, got '{s}'")
+
+
+class BenchmarkCase:
+    """Synthetic book 1 and book 2 chapters of one length, with everything the benchmarks need precomputed.
+
+    Attributes:
+        audio_seconds (float): Length of the book 1 chapter.
+        src1 (np.array): Book 1 audio.
+        src2 (np.array): Book 2 audio.
+        interleaver (Interleaver): Interleaver with the default settings.
+        silence_maps (list(SilenceMap)): Silence analysis of each source.
+        splits (list(list(int))): Split points of each source.
+        fades (list(list(tuple))): (start, split, end) of each fade in each source.
+        plan (list(tuple)): Segment order from Interleaver.plan_segments.
+    """
+
+    def __init__(self, audio_seconds, signal_args):
+        self.audio_seconds = audio_seconds
+        seed = signal_args.get('seed', 0)
+        self.src1 = SyntheticSpeech(audio_seconds, **signal_args).samples()
+        self.src2 = SyntheticSpeech(audio_seconds * BOOK2_LENGTH_RATIO, **dict(signal_args, seed=seed + 1)).samples()
+        self.interleaver = Interleaver()
+        min_run = int(MIN_SILENCE_SECONDS * self.interleaver.sample_rate)
+        self.silence_maps = [SilenceMap.analyze(b, self.interleaver.noise_threshold, min_run)
+                             for b in (self.src1, self.src2)]
+        self.fades = [[], []]
+        self.splits = [self.interleaver.segment(b.copy(), m, f)
+                       for b, m, f in zip((self.src1, self.src2), self.silence_maps, self.fades)]
+        self.plan = self.interleaver.plan_segments(len(self.src1), len(self.src2), self.splits[0], self.splits[1])
+
+
+# region Benchmarks
+# Each benchmark takes a BenchmarkCase and returns the untimed setup's result: a function to time, the amount of
+# work it does per call, and the unit of that work. Only the benchmarks that read every sample count samples, the
+# ones working from the silence map count the windows or segments they handle.
+
+def bench_find_silent_runs(case):
+    return lambda: utils.find_silent_runs(case.src1, case.interleaver.noise_threshold), len(case.src1), "samples"
+
+
+def bench_silence_map_analyze(case):
+    min_run = int(MIN_SILENCE_SECONDS * case.interleaver.sample_rate)
+    return (lambda: SilenceMap.analyze(case.src1, case.interleaver.noise_threshold, min_run), len(case.src1),
+            "samples")
+
+
+def bench_longest_silence(case):
+    """The split point search, which replaced find_start_point and find_split_point."""
+    il = case.interleaver
+    windows = [(s + il.min_seg_len, s + il.max_seg_len) for s in case.splits[0][:-2]]
+    smap = case.silence_maps[0]
+
+    def run():
+        for start, end in windows:
+            smap.longest_silence(start, end)
+    return run, len(windows), "windows"
+
+
+def bench_segment(case):
+    # Fades are applied in place, fading an already faded copy costs the same
+    buffer = case.src1.copy()
+    # One window is searched for each split point between the first and last
+    return lambda: case.interleaver.segment(buffer, case.silence_maps[0]), len(case.splits[0]) - 2, "windows"
+
+
+def bench_apply_lin_env(case):
+    buffer = case.src1.copy()
+
+    def run():
+        for start, split, end in case.fades[0]:
+            utils.apply_lin_env(buffer, start, split, 1.0, 0.0)
+            utils.apply_lin_env(buffer, split, end, 0.0, 1.0)
+    return run, sum(end - start for start, split, end in case.fades[0]), "samples"
+
+
+def bench_plan_segments(case):
+    return (lambda: case.interleaver.plan_segments(len(case.src1), len(case.src2), case.splits[0], case.splits[1]),
+            len(case.plan), "segments")
+
+
+def bench_assemble_segments(case):
+    return (lambda: case.interleaver.render_segments(case.src1, case.src2, case.plan),
+            sum(end - start for src, start, end in case.plan), "samples")
+
+
+BENCHMARKS = {
+    "find_silent_runs": bench_find_silent_runs,
+    "silence_map.analyze": bench_silence_map_analyze,
+    "silence_map.longest_silence": bench_longest_silence,
+    "segment": bench_segment,
+    "apply_lin_env": bench_apply_lin_env,
+    "plan_segments": bench_plan_segments,
+    "assemble_segments": bench_assemble_segments,
+}
+
+# endregion
+
+
+def time_call(fn, repeat):
+    """Calls fn repeat times and returns the wall clock seconds of each call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def host_info():
+    """Returns a description of the machine and libraries, saved with the results."""
+    return {"platform": platform.platform(), "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "python": platform.python_version(), "numpy": np.__version__}
+
+
+def run_benchmarks(durations, repeat=DEFAULT_REPEAT, names=None, signal_args=None, out=sys.stdout):
+    """Runs the benchmarks on synthetic chapters of each duration.
+
+    Args:
+        durations (list(float)): Chapter lengths in seconds.
+        repeat (int): Timed calls of each benchmark, the best and median are reported.
+        names (list(str)): Benchmarks to run, defaults to all of BENCHMARKS.
+        signal_args (dict): Keyword arguments for SyntheticSpeech.
+        out: Stream to print a line per result to, or None.
+
+    Returns:
+        dict: The results, ready to be saved as JSON.
+    """
+    signal_args = signal_args if signal_args is not None else {}
+    names = names if names is not None else list(BENCHMARKS)
+    results = []
+    for seconds in durations:
+        case = BenchmarkCase(seconds, signal_args)
+        for name in names:
+            fn, work, unit = BENCHMARKS[name](case)
+            times = time_call(fn, repeat)
+            best = min(times)
+            result = {"name": name, "audio_seconds": seconds, "work": work, "unit": unit, "repeat": repeat,
+                      "best_seconds": best, "median_seconds": statistics.median(times),
+                      "work_per_second": work / best if best > 0 else None}
+            results.append(result)
+            if out is not None:
+                print(format_result(result), file=out, flush=True)
+        del case
+    return {"version": RESULTS_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "host": host_info(),
+            "signal": signal_args, "results": results}
+
+
+def get_rate(result):
+    """Returns the work per second and its unit of a result, including results saved before units were recorded."""
+    if "work_per_second" in result:
+        return result["work_per_second"], result["unit"]
+    return result.get("samples_per_second"), "samples"
+
+
+def format_result(result, baseline=None):
+    rate, unit = get_rate(result)
+    line = (f"{result['name']:<28} {result['audio_seconds']:>8.0f}s  {result['best_seconds'] * 1000.0:>10.2f} ms  "
+            f"{rate or 0:>14,.0f} {unit + '/s':<10}")
+    if baseline is not None:
+        old_rate, old_unit = get_rate(baseline)
+        if old_rate and rate and old_unit == unit:
+            line += f"  {rate / old_rate:>6.2f}x"
+        elif baseline.get("best_seconds") and result["best_seconds"]:
+            # e.g. a baseline that counted the whole source for a search over a few windows, the times still compare
+            line += f"  {baseline['best_seconds'] / result['best_seconds']:>6.2f}x"
+    return line.rstrip()
+
+
+def compare(results, baseline):
+    """Returns a table of results with their speedup over matching results in baseline."""
+    old = {(r['name'], r['audio_seconds']): r for r in baseline['results']}
+    return "\n".join(format_result(r, old.get((r['name'], r['audio_seconds']))) for r in results['results'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the InterLivre segmentation hot paths")
+    parser.add_argument('--durations', nargs='+', type=parse_duration, default=DEFAULT_DURATIONS,
+                        help="Chapter lengths to test, e.g. 1m 10m 1h 10h. 10h needs about 16 GB of RAM")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Timed calls of each benchmark")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=None, help="Benchmarks to run")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic speech")
+    parser.add_argument('--pause-distribution', default='lognormal', choices=list(PAUSE_DISTRIBUTIONS),
+                        help="Distribution of the pause lengths between bursts of speech")
+    parser.add_argument('--pause-seconds', type=float, default=0.6, help="Mean pause length")
+    parser.add_argument('--pause-spread', type=float, default=0.8, help="Spread of the pause lengths")
+    parser.add_argument('--noise-floor', type=int, default=60, help="Background noise level in 16 bit units")
+    parser.add_argument('--output', default=None, help="Path to save the results as JSON")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    durations = [parse_duration(d) if isinstance(d, str) else d for d in args.durations]
+    signal_args = {"seed": args.seed, "pause_distribution": args.pause_distribution,
+                   "pause_seconds": args.pause_seconds, "pause_spread": args.pause_spread,
+                   "noise_floor": args.noise_floor}
+    results = run_benchmarks(durations, args.repeat, args.only, signal_args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare}:")
+        print(compare(results, baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
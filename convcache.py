@@ -0,0 +1,107 @@
+"""
+InterLivre, audiobook splicer
+
+Content-addressed cache of converted input files, reused between runs
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from os.path import isfile, join as pjoin
+from uuid import uuid4
+import utils
+
+CACHE_DIRECTORY = "cache"
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+
+def _link_or_copy(src, dst):
+    """Hard links src to dst, or copies it if the filesystem doesn't support hard links."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+class ConversionCache:
+    """Stores decoded and normalized input files keyed by a fingerprint of the source and the target format.
+
+    Entries are hard linked into the workspace, so a cache hit costs neither decoding nor copying. Least recently
+    used entries are evicted once the cache grows past max_bytes. Use is tracked with each entry's access time, so
+    the entries keep their modification time and their cached probe results stay valid.
+
+    Attributes:
+        root (str): Directory holding the cached wav files.
+        max_bytes (int): Size cap for the cache.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_MAX_BYTES
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def key(cls, src_path, audio_format):
+        """Returns the cache key for a source file converted into audio_format."""
+        fmt = f"{audio_format.sample_rate}-{audio_format.bit_depth}-{audio_format.channels}"
+        return f"{utils.fingerprint_file(src_path)}-{fmt}"
+
+    def entry_path(self, key):
+        return pjoin(self.root, f"{key}.wav")
+
+    def get(self, key, dst_path):
+        """Links the cached file for key to dst_path.
+
+        Returns:
+            bool: True on a cache hit.
+        """
+        path = self.entry_path(key)
+        try:
+            st = os.stat(path)
+            _link_or_copy(path, dst_path)
+            # Mark as recently used without touching the modification time
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+            return True
+        except OSError:
+            return False
+
+    def put(self, key, src_path):
+        """Adds a converted file to the cache, then evicts old entries if the cache is over its size cap."""
+        if not isfile(src_path):
+            return
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{uuid4().hex}.part"
+        try:
+            _link_or_copy(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.exception(e)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for f in utils.list_files_with_extension(self.root, 'wav'):
+                try:
+                    st = os.stat(pjoin(self.root, f))
+                except OSError:
+                    continue
+                entries.append((st.st_atime_ns, st.st_size, f))
+            total = sum(e[1] for e in entries)
+            for atime, size, f in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(pjoin(self.root, f))
+                    total -= size
+                except OSError as e:
+                    logging.exception(e)
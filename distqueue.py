@@ -0,0 +1,491 @@
+"""
+InterLivre, audiobook splicer
+
+File-based chapter work queue for spreading a job across several machines that share a filesystem
+
+A coordinator converts the input files, writes one work unit per chapter into the queue directory, and waits for
+workers on any host to interleave them. Every path in a work unit must be valid on every host, so the output
+directory and the queue directory should both live on the shared mount.
+
+Queue directory layout:
+    units/<id>.json     Work units (ChapterTask dictionaries)
+    leases/<id>.lease   Claimed units. The worker touches the lease as a heartbeat while it works.
+    done/<id>.json      Finished units
+    failed/<id>.json    Units that raised an error, or were dropped or stopped when the job was cancelled or failed
+    closed              Created by the coordinator when the job is over, workers exit when they see it
+
+Usage:
+    python distqueue.py worker QUEUE_DIR [--worker-id ID] [--exit-when-idle]
+    python distqueue.py coordinate QUEUE_DIR SETTINGS_JSON
+
+distqueuetest.py runs a job against several local worker processes to test the queue on one machine.
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from os.path import isfile, join as pjoin
+from uuid import uuid4
+from pipeline import CANCEL_WAIT_SECONDS, ChapterTask, JobSettings, Pipeline, run_chapter_task
+from audiotools import AudioConvertor
+from preflight import PreflightError
+import utils
+
+HEARTBEAT_SECONDS = 10
+LEASE_TIMEOUT_SECONDS = 60
+POLL_SECONDS = 1.0
+
+
+def _write_json_atomic(path, data):
+    """Writes JSON to a temporary file and renames it into place so readers never see a partial file."""
+    tmp_path = f"{path}.{uuid4().hex}.part"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class WorkQueue:
+    """A queue of chapter work units stored as files in a directory on a shared filesystem.
+
+    Units are claimed by exclusively creating a lease file, which works across hosts on NFSv3 and later.
+    A lease that hasn't been touched for lease_timeout seconds is considered abandoned and can be claimed again.
+    Lease ages are measured against the shared filesystem's clock, not the local one, so hosts with skewed
+    clocks agree on when a lease expires.
+
+    Attributes:
+        root (str): Path to the queue directory.
+        lease_timeout (float): Seconds without a heartbeat before a lease expires.
+    """
+
+    def __init__(self, root, lease_timeout=LEASE_TIMEOUT_SECONDS):
+        self.root = root
+        self.lease_timeout = lease_timeout
+        self.units_dir = pjoin(root, 'units')
+        self.leases_dir = pjoin(root, 'leases')
+        self.done_dir = pjoin(root, 'done')
+        self.failed_dir = pjoin(root, 'failed')
+        self.closed_path = pjoin(root, 'closed')
+        # Unit id -> token of the lease this queue claimed
+        self._tokens = {}
+        for d in [root, self.units_dir, self.leases_dir, self.done_dir, self.failed_dir]:
+            os.makedirs(d, exist_ok=True)
+
+    # region Coordinator
+    def put(self, unit_id, task):
+        """Adds a ChapterTask to the queue under the given id."""
+        _write_json_atomic(pjoin(self.units_dir, f"{unit_id}.json"), task.to_dict())
+
+    def close(self):
+        """Tells workers that no more units are coming once the queue is empty."""
+        open(self.closed_path, 'w').close()
+
+    def is_closed(self):
+        return isfile(self.closed_path)
+
+    def abort(self, error):
+        """Marks every unit nobody has claimed as failed, so workers stop taking units of a job that is over.
+
+        Units that are running are left to their workers, which the coordinator stops through the job's cancel file.
+
+        Returns:
+            list(str): Ids of the units that were dropped.
+        """
+        dropped = sorted(self.status()['pending'])
+        for unit_id in dropped:
+            _write_json_atomic(pjoin(self.failed_dir, f"{unit_id}.json"), {'error': error})
+        return dropped
+
+    def reset(self):
+        """Removes every unit, lease and result so the queue can be reused for a new job."""
+        for d in [self.units_dir, self.leases_dir, self.done_dir, self.failed_dir]:
+            for f in utils.list_files(d):
+                os.remove(pjoin(d, f))
+        if self.is_closed():
+            os.remove(self.closed_path)
+
+    def status(self):
+        """Returns a dictionary of unit ids grouped by state: 'pending', 'running', 'done' and 'failed'."""
+        units = [utils.strip_extension(f) for f in utils.list_files_with_extension(self.units_dir, 'json')]
+        done = set(utils.strip_extension(f) for f in utils.list_files_with_extension(self.done_dir, 'json'))
+        failed = set(utils.strip_extension(f) for f in utils.list_files_with_extension(self.failed_dir, 'json'))
+        leased = set(utils.strip_extension(f) for f in utils.list_files_with_extension(self.leases_dir, 'lease'))
+        res = {'pending': [], 'running': [], 'done': [], 'failed': []}
+        for u in units:
+            if u in done:
+                res['done'].append(u)
+            elif u in failed:
+                res['failed'].append(u)
+            elif u in leased:
+                res['running'].append(u)
+            else:
+                res['pending'].append(u)
+        return res
+
+    def get_result(self, unit_id):
+        """Returns the result recorded for a finished unit."""
+        with open(pjoin(self.done_dir, f"{unit_id}.json")) as f:
+            return json.load(f)
+
+    def get_failure(self, unit_id):
+        """Returns the error recorded for a failed unit."""
+        with open(pjoin(self.failed_dir, f"{unit_id}.json")) as f:
+            return json.load(f)
+    # endregion
+
+    # region Worker
+    def fs_now(self):
+        """Returns the current time according to the shared filesystem."""
+        clock_path = pjoin(self.root, 'clock')
+        with open(clock_path, 'a'):
+            os.utime(clock_path)
+        return os.stat(clock_path).st_mtime
+
+    def lease_path(self, unit_id):
+        return pjoin(self.leases_dir, f"{unit_id}.lease")
+
+    def claim(self, worker_id):
+        """Claims the next unclaimed unit.
+
+        Each claim writes a token of its own into the lease, so a worker whose lease expired and was claimed again
+        can't refresh, complete or release the new owner's lease.
+
+        Returns:
+            A tuple containing the unit id and its ChapterTask, or None if there's nothing to claim.
+        """
+        status = self.status()
+        self._break_expired_leases(status['running'])
+        for unit_id in sorted(status['pending']) + sorted(status['running']):
+            try:
+                fd = os.open(self.lease_path(unit_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            token = uuid4().hex
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'worker': worker_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'token': token}, f)
+            self._tokens[unit_id] = token
+            # The unit may have finished or failed between listing the queue and taking the lease
+            if isfile(pjoin(self.done_dir, f"{unit_id}.json")) or isfile(pjoin(self.failed_dir, f"{unit_id}.json")):
+                self.release(unit_id)
+                continue
+            with open(pjoin(self.units_dir, f"{unit_id}.json")) as f:
+                return unit_id, ChapterTask.from_dict(json.load(f))
+        return None
+
+    def read_lease_token(self, path):
+        """Returns the claim token written in a lease file, or None if it can't be read yet."""
+        try:
+            with open(path) as f:
+                return json.load(f).get('token')
+        except (OSError, ValueError):
+            return None
+
+    def owns(self, unit_id):
+        """Returns True if the lease on a unit is still the one this queue claimed."""
+        token = self._tokens.get(unit_id)
+        return token is not None and self.read_lease_token(self.lease_path(unit_id)) == token
+
+    def _break_expired_leases(self, unit_ids):
+        if len(unit_ids) == 0:
+            return
+        now = self.fs_now()
+        for unit_id in unit_ids:
+            path = self.lease_path(unit_id)
+            try:
+                if now - os.stat(path).st_mtime <= self.lease_timeout:
+                    continue
+                token = self.read_lease_token(path)
+                # Only one worker can win the rename, so only one of them breaks the lease
+                expired_path = f"{path}.expired.{uuid4().hex}"
+                os.rename(path, expired_path)
+            except FileNotFoundError:
+                continue
+            # Another worker may have broken the lease and claimed the unit again between the stat and the rename,
+            # or the owner may have sent a heartbeat. If so, that lease is alive, so put it back.
+            try:
+                alive = self.read_lease_token(expired_path) != token or \
+                    now - os.stat(expired_path).st_mtime <= self.lease_timeout
+                if alive:
+                    os.link(expired_path, path)
+                    os.remove(expired_path)
+                    continue
+            except FileExistsError:
+                logging.warning(f"Lease on unit {unit_id} was claimed again while it was being restored")
+                continue
+            except FileNotFoundError:
+                continue
+            logging.warning(f"Lease on unit {unit_id} expired, it will be retried")
+        for f in utils.list_files(self.leases_dir):
+            if '.expired.' in f:
+                try:
+                    os.remove(pjoin(self.leases_dir, f))
+                except FileNotFoundError:
+                    pass
+
+    def heartbeat(self, unit_id):
+        """Refreshes the lease on a claimed unit.
+
+        Returns:
+            bool: False if the lease expired and another worker claimed the unit.
+        """
+        if not self.owns(unit_id):
+            return False
+        os.utime(self.lease_path(unit_id))
+        return True
+
+    def complete(self, unit_id, result):
+        """Marks a claimed unit as done and releases its lease.
+
+        Returns:
+            bool: False if the lease was lost to another worker, which then records the unit instead.
+        """
+        if not self.owns(unit_id):
+            logging.warning(f"Lease on unit {unit_id} was lost, leaving it to the worker that claimed it again")
+            self._tokens.pop(unit_id, None)
+            return False
+        _write_json_atomic(pjoin(self.done_dir, f"{unit_id}.json"), result)
+        self.release(unit_id)
+        return True
+
+    def fail(self, unit_id, error):
+        """Marks a claimed unit as failed and releases its lease.
+
+        Returns:
+            bool: False if the lease was lost to another worker, which then records the unit instead.
+        """
+        if not self.owns(unit_id):
+            logging.warning(f"Lease on unit {unit_id} was lost, leaving it to the worker that claimed it again")
+            self._tokens.pop(unit_id, None)
+            return False
+        _write_json_atomic(pjoin(self.failed_dir, f"{unit_id}.json"), {'error': error})
+        self.release(unit_id)
+        return True
+
+    def release(self, unit_id):
+        """Removes the lease on a unit, if it's still the one this queue claimed."""
+        if self.owns(unit_id):
+            try:
+                os.remove(self.lease_path(unit_id))
+            except FileNotFoundError:
+                pass
+        self._tokens.pop(unit_id, None)
+    # endregion
+
+
+class _Heartbeat:
+    """Touches a unit's lease from a background thread until stopped."""
+
+    def __init__(self, queue, unit_id, interval=HEARTBEAT_SECONDS):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.unit_id):
+                    logging.warning(f"Lease on unit {self.unit_id} was lost to another worker")
+                    return
+            except OSError as e:
+                logging.exception(e)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue_dir, worker_id=None, exit_when_idle=False, poll_interval=POLL_SECONDS):
+    """Claims and interleaves chapter units until the queue is closed and empty.
+
+    Args:
+        queue_dir (str): Path to the queue directory.
+        worker_id (str): Name of this worker, defaults to host name and process id.
+        exit_when_idle (bool): Exit as soon as there's nothing left to claim, even if the queue isn't closed.
+        poll_interval (float): Seconds to wait between checks for new units.
+
+    Returns:
+        int: Number of units processed.
+    """
+    queue = WorkQueue(queue_dir)
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    processed = 0
+    while True:
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            status = queue.status()
+            if exit_when_idle or (queue.is_closed() and len(status['pending']) + len(status['running']) == 0):
+                return processed
+            time.sleep(poll_interval)
+            continue
+        unit_id, task = claimed
+        logging.info(f"{worker_id} interleaving unit {unit_id}")
+        with _Heartbeat(queue, unit_id):
+            try:
+                start = time.time()
+                dst_path = run_chapter_task(task)
+                if task.cancel_path is not None and isfile(task.cancel_path):
+                    # The coordinator stopped the job, so the chapter is incomplete
+                    queue.fail(unit_id, f"{worker_id}: cancelled")
+                else:
+                    queue.complete(unit_id, {'dst_path': dst_path, 'worker': worker_id,
+                                             'seconds': time.time() - start})
+            except Exception as e:
+                logging.exception(e)
+                queue.fail(unit_id, f"{worker_id}: {e}")
+        processed += 1
+
+
+class Coordinator:
+    """Runs a job with its chapters interleaved by workers reading from a WorkQueue.
+
+    The coordinator does the steps that need the whole book: creating the workspace, converting the inputs,
+    splitting single-file books, and finally joining virtual chapters and converting the outputs.
+    """
+
+    def __init__(self, settings, queue_dir, status_queue=None, cancel=None, poll_interval=POLL_SECONDS):
+        self.settings = settings
+        self.queue = WorkQueue(queue_dir)
+        self.status_queue = status_queue
+        self.cancel_event = cancel
+        self.poll_interval = poll_interval
+
+    def run(self):
+        """Runs the job and returns the number of chapters interleaved.
+
+        If the job is cancelled or a chapter fails, the units nobody has claimed are dropped, the running ones are
+        stopped, and the partial files are removed.
+
+        Raises:
+            RuntimeError: If any chapter failed.
+        """
+        pipeline = Pipeline(self.settings, status_queue=self.status_queue, cancel=self.cancel_event)
+        fm = pipeline.filemanager
+        convertor = AudioConvertor(self.settings.tmp_audio_format, cancel=self.cancel_event)
+        self.queue.reset()
+        try:
+            pipeline.preflight()
+            pipeline.plan_resume()
+            if len(pipeline.chapter_numbers) == 0:
+                pipeline.update_status(100, "Finished! Every chapter was already up to date")
+                return 0
+            pipeline.update_status(1, "Creating temporary workspace")
+            pipeline.create_workspace()
+            convertor.probe_cache = pipeline.probe_cache
+            pipeline.update_status(2, "Converting input files")
+            fm.convert_tmp_files(convertor, status_queue=self.status_queue, cancel=self.cancel_event,
+                                 skip=pipeline.cached_inputs)
+            if utils.is_cancelled(self.cancel_event):
+                self.stop(pipeline, "Cancelled")
+                return 0
+            pipeline.cache_converted_inputs()
+            tasks = pipeline.plan_chapters()
+            for i, task in enumerate(tasks):
+                self.queue.put(f"{i + 1:06d}", task)
+
+            # Wait for the workers
+            while True:
+                status = self.queue.status()
+                if len(status['failed']) > 0:
+                    errors = [self.queue.get_failure(u)['error'] for u in status['failed']]
+                    self.stop(pipeline, "Job failed")
+                    raise RuntimeError(f"{len(errors)} chapter(s) failed: {'; '.join(errors)}")
+                if len(status['done']) == len(tasks):
+                    break
+                if utils.is_cancelled(self.cancel_event):
+                    self.stop(pipeline, "Cancelled")
+                    return 0
+                utils.update_progress(self.status_queue, len(status['done']) / len(tasks) * 100.0,
+                                      f"Processing chapters, {len(status['done'])}/{len(tasks)} done, "
+                                      f"{len(status['running'])} running")
+                time.sleep(self.poll_interval)
+
+            pipeline.join_shards(tasks)
+            utils.update_progress(self.status_queue, 1, "Converting interleaved audio to selected output format")
+            convertor.output_format = self.settings.dst_audio_format
+            conversions = fm.get_output_conversions(convertor.output_format.file_format)
+            failed = fm.convert_output_files(convertor, cleanup=True, cleanup_string="tmp_",
+                                             status_queue=self.status_queue, cancel=self.cancel_event)
+            if utils.is_cancelled(self.cancel_event):
+                # Only record complete runs, the next run converts whatever is left
+                self.stop(pipeline, "Cancelled")
+                return 0
+            for f_in, f_out in conversions:
+                if f_out not in failed:
+                    pipeline.record_output(f_out)
+            if len(failed) > 0:
+                # The tmp chapters are kept, the next run converts them again
+                raise RuntimeError(f"Couldn't convert {len(failed)} chapter(s): {', '.join(failed)}")
+            pipeline.update_status(100, "Finished!")
+            return len(tasks)
+        finally:
+            self.queue.close()
+            pipeline.remove_cancel_file()
+
+    def stop(self, pipeline, reason, timeout=CANCEL_WAIT_SECONDS):
+        """Stops the job's chapters and removes its partial files, after it was cancelled or a chapter failed.
+
+        Args:
+            pipeline (Pipeline): Pipeline running the job.
+            reason (str): Error recorded for the units that are dropped.
+            timeout (float): Longest time to wait for the running units to stop.
+        """
+        pipeline.signal_cancel_file()
+        dropped = self.queue.abort(reason)
+        if len(dropped) > 0:
+            logging.info(f"Dropped {len(dropped)} unclaimed unit(s)")
+        # The workers only see the cancel file, wait for them so they're done with the tmp files. A worker that died
+        # keeps its lease until the timeout, so don't wait for it.
+        deadline = time.monotonic() + timeout
+        while len(self.queue.status()['running']) > 0 and time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, 0.1))
+        pipeline.remove_partial_files()
+
+
+class _PrintStatusQueue:
+    def put(self, status):
+        print(f"{status[0]:3d}% {status[1]}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distribute InterLivre chapter work over a shared filesystem.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help="Claim and interleave chapters from a queue directory")
+    worker.add_argument('queue_dir')
+    worker.add_argument('--worker-id', default=None)
+    worker.add_argument('--exit-when-idle', action='store_true')
+    coordinate = sub.add_parser('coordinate', help="Queue a job's chapters and assemble the results")
+    coordinate.add_argument('queue_dir')
+    coordinate.add_argument('settings', help="Path to a JSON file of JobSettings")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'worker':
+        run_worker(args.queue_dir, args.worker_id, args.exit_when_idle)
+        return 0
+    with open(args.settings) as f:
+        settings = JobSettings.from_dict(json.load(f))
+    try:
+        Coordinator(settings, args.queue_dir, status_queue=_PrintStatusQueue()).run()
+    except (RuntimeError, PreflightError) as e:
+        logging.error(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
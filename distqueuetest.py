@@ -0,0 +1,183 @@
+"""
+InterLivre, audiobook splicer
+
+Local test of the distributed work queue: starts several worker processes against a queue in a temp directory, runs
+a coordinator on a synthetic book pair, and checks that every chapter is interleaved once. A second job is cancelled
+part way through to check that the units nobody has claimed are dropped, the workers exit and the partial files are
+removed.
+
+Example:
+    python distqueuetest.py --workers 3 --chapters 6
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from os.path import isdir, join as pjoin
+import distqueue
+from distqueue import Coordinator, WorkQueue
+from filemanager import TMP_DIRECTORY
+from pipeline import CANCEL_FILE_PREFIX, JobSettings
+from scalebenchmark import build_book_pair
+import utils
+
+DEFAULT_WORKERS = 3
+DEFAULT_CHAPTERS = 6
+DEFAULT_CHAPTER_SECONDS = 60
+# Longest time the workers get to exit once the queue is closed
+WORKER_EXIT_SECONDS = 30
+# Faster than the default, so the test doesn't spend most of its time waiting
+POLL_SECONDS = 0.2
+
+
+def start_workers(queue_dir, count):
+    """Starts worker processes against a queue directory and returns their Popen objects."""
+    return [subprocess.Popen([sys.executable, distqueue.__file__, 'worker', queue_dir, '--worker-id', f"local-{i}"])
+            for i in range(count)]
+
+
+def wait_for_workers(workers, timeout=WORKER_EXIT_SECONDS):
+    """Waits for the worker processes to exit and kills the ones that don't.
+
+    Returns:
+        bool: True if every worker exited by itself with a zero exit code.
+    """
+    ok = True
+    deadline = time.monotonic() + timeout
+    for p in workers:
+        try:
+            ok = p.wait(timeout=max(0.0, deadline - time.monotonic())) == 0 and ok
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+            ok = False
+    return ok
+
+
+def get_tmp_files(dst_dir):
+    """Returns the tmp files left in the workspace of an output directory."""
+    tmp_files = []
+    for d in ['book1', 'book2', 'interleaved']:
+        tmp_dir = pjoin(dst_dir, TMP_DIRECTORY, d)
+        if isdir(tmp_dir):
+            tmp_files += [f for f in utils.list_files(tmp_dir) if f.startswith("tmp")]
+    return tmp_files
+
+
+def run_job(root, name, book_dirs, workers, cancel_after=None):
+    """Runs one job with a coordinator in this process and workers in their own processes.
+
+    Args:
+        root (str): Directory for the queue and the output.
+        name (str): Name of the job, used for its directories and output files.
+        book_dirs (list(str)): Book 1 and book 2 directories.
+        workers (int): Number of worker processes.
+        cancel_after (int): Cancel the job once this many units are done, None to let it finish.
+
+    Returns:
+        dict: Outcome of the job.
+    """
+    queue_dir = pjoin(root, f"{name}-queue")
+    dst_dir = pjoin(root, f"{name}-out")
+    os.makedirs(dst_dir, exist_ok=True)
+    settings = JobSettings(book_dirs[0], book_dirs[1], dst_dir, name)
+    queue = WorkQueue(queue_dir)
+    # Workers exit as soon as they find the queue closed and empty, so open it before they start
+    queue.reset()
+    cancel = threading.Event()
+    coordinator = Coordinator(settings, queue_dir, cancel=cancel, poll_interval=POLL_SECONDS)
+    if cancel_after is not None:
+        def cancel_when_done():
+            while len(queue.status()['done']) < cancel_after and not queue.is_closed():
+                time.sleep(POLL_SECONDS / 4)
+            cancel.set()
+        threading.Thread(target=cancel_when_done, daemon=True).start()
+
+    processes = start_workers(queue_dir, workers)
+    start = time.perf_counter()
+    try:
+        interleaved = coordinator.run()
+        error = None
+    except Exception as e:
+        logging.exception(e)
+        interleaved = 0
+        error = str(e)
+    finally:
+        workers_exited = wait_for_workers(processes)
+    status = queue.status()
+    return {"seconds": time.perf_counter() - start,
+            "interleaved": interleaved,
+            "error": error,
+            "workers_exited": workers_exited,
+            "status": status,
+            "workers_used": sorted(set(queue.get_result(u).get('worker') for u in status['done'])),
+            "tmp_files": get_tmp_files(dst_dir),
+            "cancel_files": [f for f in utils.list_files(pjoin(dst_dir, TMP_DIRECTORY))
+                             if f.startswith(CANCEL_FILE_PREFIX)]}
+
+
+def check(ok, msg):
+    print(f"{'ok  ' if ok else 'FAIL'} {msg}", flush=True)
+    return ok
+
+
+def run_tests(root, workers, chapters, chapter_seconds):
+    """Runs the finished and the cancelled job and prints the checks.
+
+    Returns:
+        bool: True if every check passed.
+    """
+    book_dirs = build_book_pair(root, chapters, chapter_seconds, 'wav')
+
+    res = run_job(root, "finished", book_dirs, workers)
+    print(f"Finished job: {res['seconds']:.1f} s, units done by {', '.join(res['workers_used'])}")
+    ok = check(res['error'] is None, f"job succeeded {res['error'] or ''}")
+    ok = check(res['interleaved'] == chapters, f"{res['interleaved']}/{chapters} chapters interleaved") and ok
+    ok = check(len(res['status']['done']) == chapters and len(res['status']['failed']) == 0,
+               "every unit done, none failed") and ok
+    ok = check(res['workers_exited'], "workers exited once the queue was closed") and ok
+
+    res = run_job(root, "cancelled", book_dirs, workers, cancel_after=1)
+    print(f"Cancelled job: {res['seconds']:.1f} s, {len(res['status']['done'])} unit(s) done, "
+          f"{len(res['status']['failed'])} dropped or stopped")
+    ok = check(res['error'] is None and res['interleaved'] == 0, "job returned as cancelled") and ok
+    ok = check(len(res['status']['pending']) + len(res['status']['running']) == 0,
+               "no units left to claim or running") and ok
+    ok = check(res['workers_exited'], "workers exited after the cancel") and ok
+    ok = check(len(res['tmp_files']) == 0, f"partial files removed {res['tmp_files'] or ''}") and ok
+    ok = check(len(res['cancel_files']) == 0, "cancel file removed") and ok
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test the InterLivre work queue with local worker processes.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--chapters', type=int, default=DEFAULT_CHAPTERS)
+    parser.add_argument('--chapter-seconds', type=float, default=DEFAULT_CHAPTER_SECONDS)
+    parser.add_argument('--keep', action='store_true', help="Keep the temp directory")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    root = tempfile.mkdtemp(prefix="interlivre-distqueue-")
+    try:
+        ok = run_tests(root, args.workers, args.chapters, args.chapter_seconds)
+    finally:
+        if args.keep:
+            print(f"Kept {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
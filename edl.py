@@ -0,0 +1,102 @@
+"""
+InterLivre, audiobook splicer
+
+Edit decision lists describing how each interleaved chapter is assembled from its two sources
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import json
+import os
+
+EDL_DIRECTORY = "edl"
+EDL_EXTENSION = "edl.json"
+EDL_VERSION = 1
+
+
+class EditDecisionList:
+    """The plan for one interleaved chapter: which sample ranges of which source go where, and where to fade.
+
+    Rendering an EditDecisionList needs only the source audio, so a chapter can be made again in another output
+    format or sample rate without segmenting the sources again.
+
+    Attributes:
+        sample_rate (int): Sample rate of the decoded sources the sample indices refer to.
+        channels (int): Channel count of the decoded sources.
+        lengths (list(int)): Length in samples of the book 1 and book 2 sources.
+        segments (list(list(int))): [source, start, end] for each segment in output order, where source is 0 for
+            book 1 and 1 for book 2, and start is inclusive and end exclusive.
+        fades (list(list(list(int)))): [start, middle, end] of each fade for book 1 and book 2. The source fades out
+            over [start, middle) and back in over [middle, end).
+        sources (list(str)): Paths to the book 1 and book 2 source files.
+        fingerprints (list(str)): utils.fingerprint_file() of each source when the list was made.
+    """
+
+    def __init__(self, sample_rate, channels, lengths, segments, fades, sources=None, fingerprints=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.lengths = [int(n) for n in lengths]
+        self.segments = [[int(src), int(start), int(end)] for src, start, end in segments]
+        self.fades = [[[int(n) for n in fade] for fade in source_fades] for source_fades in fades]
+        self.sources = sources if sources is not None else []
+        self.fingerprints = fingerprints if fingerprints is not None else []
+
+    @property
+    def output_samples(self):
+        """int: Length in samples of the rendered chapter."""
+        return sum(end - start for src, start, end in self.segments)
+
+    @classmethod
+    def concat(cls, edls, sources=None, fingerprints=None):
+        """Joins the lists of consecutive virtual chapters into one list over the whole sources.
+
+        Args:
+            edls (list(EditDecisionList)): Lists of each virtual chapter, in order.
+            sources (list(str)): Paths to the whole book 1 and book 2 source files.
+            fingerprints (list(str)): Fingerprints of the whole sources.
+        """
+        offsets = [0, 0]
+        segments = []
+        fades = [[], []]
+        for edl in edls:
+            segments += [[src, start + offsets[src], end + offsets[src]] for src, start, end in edl.segments]
+            for src in (0, 1):
+                fades[src] += [[n + offsets[src] for n in fade] for fade in edl.fades[src]]
+                offsets[src] += edl.lengths[src]
+        return cls(edls[0].sample_rate, edls[0].channels, offsets, segments, fades, sources, fingerprints)
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get("version") != EDL_VERSION:
+            raise ValueError("Unsupported edit decision list version")
+        return cls(d["sample_rate"], d["channels"], d["lengths"], d["segments"], d["fades"], d.get("sources"),
+                   d.get("fingerprints"))
+
+    def to_dict(self):
+        return {"version": EDL_VERSION,
+                "sample_rate": self.sample_rate,
+                "channels": self.channels,
+                "lengths": self.lengths,
+                "sources": self.sources,
+                "fingerprints": self.fingerprints,
+                "segments": self.segments,
+                "fades": self.fades}
+
+    @classmethod
+    def load(cls, path):
+        """Reads an EditDecisionList saved with save().
+
+        Raises:
+            ValueError: If the file isn't a supported edit decision list.
+        """
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, path):
+        """Writes the list as compact JSON, replacing any existing file atomically."""
+        tmp_path = f"{path}.part"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+        os.replace(tmp_path, path)
@@ -0,0 +1,112 @@
+"""
+InterLivre, audiobook splicer
+
+Runs the interleaving pipeline in a dedicated worker process so the GUI process only renders progress updates
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import logging
+import multiprocessing
+
+
+class PipeStatusQueue:
+    """Sends (progress, message) status tuples through the sending end of a multiprocessing pipe.
+
+    Has the same put() method as queue.Queue, so it can be handed to code that expects a status_queue.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, status):
+        try:
+            self.conn.send(status)
+        except (BrokenPipeError, EOFError, OSError):
+            # The GUI process has gone away, nothing left to report to
+            pass
+
+
+def _run_engine(settings, conn, cancel_event, preview_minutes=None):
+    """Worker process entry point: runs the pipeline and reports progress back through conn.
+
+    If preview_minutes is set, makes a preview instead of running the job, and the final status message is the
+    path to the preview file.
+    """
+    from audiotools import CancelledError
+    from pipeline import Pipeline
+    status_queue = PipeStatusQueue(conn)
+    try:
+        if preview_minutes is not None:
+            from preview import Preview
+            preview_path = Preview(settings, preview_minutes, status_queue=status_queue, cancel=cancel_event).run()
+            if preview_path is not None:
+                status_queue.put((100, preview_path))
+        else:
+            Pipeline(settings, status_queue=status_queue, cancel=cancel_event).run()
+    except CancelledError:
+        # The GUI asked for this and has already stopped waiting for a result
+        pass
+    except Exception as e:
+        logging.exception(e)
+        status_queue.put((-1, f"Error: {e}"))
+    finally:
+        conn.close()
+
+
+class EngineProcess:
+    """Runs a Pipeline for the given JobSettings in a separate process.
+
+    Progress arrives as (progress, message) tuples over a one-way pipe, and cancellation is requested through an
+    event shared with the worker process. A progress value of -1 means the job failed, and the message describes
+    the error.
+
+    Args:
+        settings (JobSettings): Job to run.
+        preview_minutes (float): If set, only previews this many minutes of the first chapter pair. See Preview.
+    """
+
+    def __init__(self, settings, preview_minutes=None):
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self.cancel_event = ctx.Event()
+        self._process = ctx.Process(target=_run_engine,
+                                    args=(settings, child_conn, self.cancel_event, preview_minutes),
+                                    name="InterLivreEngine")
+        self._child_conn = child_conn
+
+    def start(self):
+        """Starts the worker process."""
+        self._process.start()
+        # Only the worker needs the sending end, closing it here lets poll() see EOF when the worker exits
+        self._child_conn.close()
+
+    def poll(self, timeout=0.05):
+        """Waits up to timeout seconds for status updates.
+
+        Returns:
+            list(tuple): Every (progress, message) status received, oldest first.
+        """
+        res = []
+        try:
+            if self._conn.poll(timeout):
+                while self._conn.poll():
+                    res.append(self._conn.recv())
+        except (EOFError, OSError):
+            pass
+        return res
+
+    def cancel(self):
+        """Asks the worker process to stop as soon as possible."""
+        self.cancel_event.set()
+
+    def is_alive(self):
+        """Returns True while the worker process is running."""
+        return self._process.is_alive()
+
+    def join(self, timeout=None):
+        """Waits for the worker process to exit."""
+        self._process.join(timeout)
+        self._conn.close()
@@ -9,15 +9,23 @@ InterLivreApp@gmail.com
 """
 
 import logging
+import os
+import time
 from os import mkdir, remove, rename
-from os.path import isdir, join as pjoin
+from os.path import abspath, basename, getsize, isdir, isfile, join as pjoin
 from pubsub import pub
 from shutil import copy
+import metrics
+import tracing
 import utils
 
 ERR_SRC_MATCH = "Source 1 directory matches source 2 directory. Choose a different location."
 ERR_NOT_FOUND = "Directory not found"
 ERR_OK = "OK"
+TMP_DIRECTORY = "interlivre-tmp"
+# Directory listings modified more recently than this aren't cached, as a change within the same mtime tick would go
+# unnoticed on filesystems with coarse timestamps
+LISTING_RACY_NS = 2 * 1000 ** 3
 
 class FileManager:
     """File manager for creating tmp workspace, copying files, and naming output files"""
@@ -30,6 +38,12 @@ class FileManager:
         self._src_file_list = []
         self._src_files_selected = None
         self.segments_directory = "InterLivre_Segments"
+        self.tmp = None
+        self.src1_tmp = None
+        self.src2_tmp = None
+        self.dst_tmp = None
+        # Input file listings per directory, keyed by absolute path, as (directory mtime, files)
+        self._listings = {}
 
     # region Properties
     @property
@@ -92,6 +106,7 @@ class FileManager:
             self._src_file_list = file_list
             pub.sendMessage("NotifyPropertyChanged", prop="src_file_list")
             pub.sendMessage("SrcFileListChanged", files=self._src_file_list)
+        return self._src_file_list
 
     @src_file_list.setter
     def src_file_list(self, value):
@@ -130,14 +145,42 @@ class FileManager:
             2d list of strings for all valid input files found in the src directories.
             Element 0 contains the src1 file list and element 1 contains the src2 file list.
         """
-        src1_files = []
-        src2_files = []
-        for ftype in self.input_file_formats:
-            src1_files += utils.list_files_with_extension(dir1, ftype)
-            src2_files += utils.list_files_with_extension(dir2, ftype)
-        src1_files.sort(key=str.lower)
-        src2_files.sort(key=str.lower)
-        return [src1_files, src2_files]
+        return [self.list_input_files(dir1), self.list_input_files(dir2)]
+
+    def list_input_files(self, dir_path):
+        """Returns the sorted input audio files in a directory.
+
+        Listings are cached and reused until the directory's modification time changes, so repeated calls don't
+        touch the filesystem beyond a single stat.
+        """
+        if dir_path is None or dir_path == "":
+            return []
+        key = abspath(dir_path)
+        mtime = os.stat(dir_path).st_mtime_ns
+        cached = self._listings.get(key)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+        files = utils.scan_files(dir_path, self.input_file_formats)
+        files.sort(key=str.lower)
+        if time.time_ns() - mtime > LISTING_RACY_NS:
+            self._listings[key] = (mtime, files)
+        else:
+            self._listings.pop(key, None)
+        return list(files)
+
+    def get_tmp_output_filename(self, filename_prefix, idx, section_count):
+        """Returns the name of the tmp wav file for an interleaved chapter."""
+        return self.get_output_filename(f"tmp_{filename_prefix}", idx, section_count)
+
+    def get_output_filename(self, filename_prefix, idx, section_count):
+        """Returns the name of an interleaved chapter, numbered with enough digits for section_count chapters."""
+        res = filename_prefix
+        if section_count > 99:
+            res += f"_{idx:05d}"
+        elif section_count > 1:
+            res += f"_{idx:02d}"
+        res += ".wav"
+        return res
 
     def get_output_tmp_files(self):
         """Returns a list of tmp output wav files that are ready to be converted into the final output files."""
@@ -186,19 +229,80 @@ class FileManager:
             self.__create_dir(res, sd)
         return res
 
+    def create_tmp_root(self):
+        """Creates the top level tmp directory within the dst_dir without cleaning anything up.
+
+        Caches that outlive a single run are stored here.
+
+        Returns:
+            str: Path to the tmp directory.
+        """
+        return self.__create_dir(self.dst_dir, TMP_DIRECTORY)
+
     def create_tmp_workspace(self):
         """Creates a temporary workspace within the dst_dir."""
-        self.tmp = self.__create_dir(self.dst_dir, 'interlivre-tmp')
+        self.tmp = self.__create_dir(self.dst_dir, TMP_DIRECTORY)
         self.src1_tmp = self.__create_dir(self.tmp, 'book1', cleanup=True, cleanup_string="tmp")
         self.src2_tmp = self.__create_dir(self.tmp, 'book2', cleanup=True, cleanup_string="tmp")
         self.dst_tmp = self.__create_dir(self.tmp, 'interleaved', cleanup=True, cleanup_string="tmp")
 
-    def copy_to_workspace(self, filelists):
+    def remove_tmp_files(self):
+        """Removes the tmp files of the workspace, e.g. after a cancelled run, and leaves the caches alone.
+
+        Uses the same rule as the cleanup when the workspace is created, so a later run starts from the same state.
+        """
+        for tmp_dir in (self.src1_tmp, self.src2_tmp, self.dst_tmp):
+            if tmp_dir is None:
+                continue
+            for d in (tmp_dir, pjoin(tmp_dir, 'shards')):
+                if not isdir(d):
+                    continue
+                for f in utils.list_files(d):
+                    if "tmp" in f:
+                        try:
+                            remove(pjoin(d, f))
+                        except OSError as e:
+                            logging.exception(e)
+
+    def create_shard_workspace(self):
+        """Creates directories within the tmp workspace to hold virtual chapters split from single-file books.
+
+        Returns:
+            A tuple containing the src 1, src 2 and interleaved shard directory paths.
+        """
+        src1_shards = self.__create_dir(self.src1_tmp, 'shards', cleanup=True, cleanup_string="tmp")
+        src2_shards = self.__create_dir(self.src2_tmp, 'shards', cleanup=True, cleanup_string="tmp")
+        dst_shards = self.__create_dir(self.dst_tmp, 'shards', cleanup=True, cleanup_string="tmp")
+        return src1_shards, src2_shards, dst_shards
+
+    def copy_to_workspace(self, filelists, cache=None, audio_format=None):
         """Copies input audio files into the tmp workspace and prepends 'tmp_' to the filenames.
 
+        If a ConversionCache is given, files that were converted into audio_format on an earlier run are linked
+        into the workspace already converted instead of being copied.
+
         Args:
             filelists (list(list(str))): List of src 1 audio files and a list of src 2 audio files.
+            cache (ConversionCache): Cache of converted input files. May be None.
+            audio_format (AudioFormat): Format the input files are converted into.
+
+        Returns:
+            A tuple containing the set of tmp wav paths that came from the cache and a dictionary mapping the
+            tmp wav path of every other file to its cache key.
         """
+        cached = set()
+        uncached = {}
+        if cache is not None:
+            src_dirs = [self.src1_dir, self.src2_dir]
+            for i, filelist in enumerate(filelists):
+                for f in list(filelist):
+                    key = cache.key(pjoin(src_dirs[i], f), audio_format)
+                    tmp_wav = self.get_tmp_wav_path(i, f)
+                    if cache.get(key, tmp_wav):
+                        cached.add(tmp_wav)
+                        filelist.remove(f)
+                    else:
+                        uncached[tmp_wav] = key
         src_dirs = [self.src1_dir, self.src2_dir]
         tmp_dirs = [self.src1_tmp, self.src2_tmp]
         for i, filelist in enumerate(filelists):
@@ -206,59 +310,133 @@ class FileManager:
                 src_path = pjoin(src_dirs[i], f)
                 dst_path = pjoin(tmp_dirs[i], f'tmp_{f}')
                 copy(src_path, dst_path)
+                size = getsize(dst_path)
+                metrics.record_bytes("convert_inputs", read=size, written=size)
             filelist.sort(key=str.lower)
+        return cached, uncached
 
-    def convert_tmp_files(self, convertor, status_queue=None, cancel=None):
-        """Converts input tmp files into the correct audio file format for interleaving (48k, 16b, mono, wav)."""
+    def get_tmp_input_paths(self):
+        """Returns the paths of every input tmp file in the workspace, book 1 files first."""
         tmp_files = self.get_input_files(self.src1_tmp, self.src2_tmp)
         tmp_dirs = [self.src1_tmp, self.src2_tmp]
-        file_cnt = len(tmp_files[0]) + len(tmp_files[1])
+        return [pjoin(tmp_dirs[i], f) for i, files in enumerate(tmp_files) for f in files]
+
+    def get_source_path(self, tmp_path):
+        """Returns the path of the source file that an input tmp file was copied from, or tmp_path if unknown.
 
-        for i, files in enumerate(tmp_files):
-            for j, f in enumerate(files):
+        Probing the source instead of its tmp copy lets cached probe results be reused between runs, because the
+        source keeps its size, modification time and inode.
+        """
+        f = basename(tmp_path)
+        parent = utils.get_parent_directory(tmp_path)
+        for src_dir, tmp_dir in [(self.src1_dir, self.src1_tmp), (self.src2_dir, self.src2_tmp)]:
+            if tmp_dir is not None and parent == abspath(tmp_dir) and f.startswith('tmp_'):
+                src_path = pjoin(src_dir, f[4:])
+                if isfile(src_path):
+                    return src_path
+        return tmp_path
+
+    def begin_tmp_conversion(self, fpath):
+        """Moves an input tmp file out of the way so it can be converted into a tmp wav file with the same name.
+
+        Returns:
+            A tuple containing the path to convert from and the path of the tmp wav file to convert to.
+        """
+        tmp_dir = utils.get_parent_directory(fpath)
+        f = basename(fpath)
+        preconvert = pjoin(tmp_dir, f"preconvert_{f}")
+        rename(fpath, preconvert)
+        return preconvert, pjoin(tmp_dir, f'{utils.strip_extension(f)}.wav')
+
+    def finish_tmp_conversion(self, inpath, status_queue=None, progress=0):
+        """Removes the pre-converted copy of an input tmp file."""
+        try:
+            remove(inpath)
+        except Exception as e:
+            utils.update_progress(status_queue, progress, f"Couldn't find {inpath}, continuing")
+            logging.exception(e)
+
+    def get_tmp_wav_path(self, book_idx, f):
+        """Returns the path of the converted tmp wav file for source file f of book 1 (book_idx 0) or 2 (book_idx 1)."""
+        tmp_dirs = [self.src1_tmp, self.src2_tmp]
+        return pjoin(tmp_dirs[book_idx], f'tmp_{utils.strip_extension(f)}.wav')
+
+    def convert_tmp_files(self, convertor, status_queue=None, cancel=None, skip=None):
+        """Converts input tmp files into the correct audio file format for interleaving (48k, 16b, mono, wav).
+
+        Args:
+            convertor (AudioConvertor): Convertor set to the interleaving format.
+            status_queue: Receives (progress, message) tuples. May be None.
+            cancel: Stops the conversion when set. May be None.
+            skip (set(str)): Paths of tmp files that are already in the interleaving format.
+        """
+        tmp_paths = [p for p in self.get_tmp_input_paths() if skip is None or p not in skip]
+        file_cnt = len(tmp_paths)
+
+        # Find the files that aren't in the interleaving format yet
+        conversions = []
+        with tracing.span("probe_inputs", cat="convert", files=file_cnt):
+            for fpath in tmp_paths:
                 if cancel is not None:
                     if cancel.is_set():
                         # Return if user has manually cancelled the operation
                         return
-                if status_queue is not None:
-                    # Update the status to be displayed in the progress dialogue
-                    progress = ((j + (i * len(files))) / file_cnt) * 100.0
-                    # Strip off the leading "tmp"
-                    file_display_str = f[4:]
-                    utils.update_progress(status_queue, progress, f"Converting file {j + (i * len(files)) + 1}/{file_cnt}")
-                fpath = pjoin(tmp_dirs[i], f)
-                auformat = convertor.get_audio_format(fpath)
+                auformat = convertor.get_audio_format(self.get_source_path(fpath))
                 if convertor.output_format.equals(auformat) is False:
-                    # Do the audio format conversion and remove the old pre-converted tmp file
-                    preconvert = pjoin(tmp_dirs[i], f"preconvert_{f}")
-                    rename(pjoin(tmp_dirs[i], f), preconvert)
-                    fwav = f'{utils.strip_extension(f)}.wav'
-                    inpath = pjoin(tmp_dirs[i], preconvert)
-                    outpath = pjoin(tmp_dirs[i], fwav)
-                    convertor.convert(inpath, outpath)
-                    try:
-                        remove(inpath)
-                    except Exception as e:
-                        utils.update_progress(status_queue, progress, f"Couldn't find {inpath}, continuing")
-                        logging.exception(e)
+                    conversions.append(self.begin_tmp_conversion(fpath))
+        already_converted = file_cnt - len(conversions)
+
+        def on_output(i, out_path, ok):
+            # Remove the old pre-converted tmp file and update the status to be displayed in the progress dialogue
+            progress = ((already_converted + i + 1) / file_cnt) * 100.0
+            self.record_conversion_bytes("convert_inputs", conversions[i][0], out_path, ok)
+            self.finish_tmp_conversion(conversions[i][0], status_queue, progress)
+            utils.update_progress(status_queue, progress, f"Converting file {already_converted + i + 1}/{file_cnt}")
+
+        # Do the audio format conversions, many files per FFmpeg process
+        with tracing.span("convert_tmp_files", cat="convert", files=len(conversions)):
+            convertor.convert_batch(conversions, on_output=on_output, cancel=cancel)
+
+    def record_conversion_bytes(self, stage, in_path, out_path, ok):
+        """Adds the size of a converted file and its output, if it was written, to the stage's byte counters."""
+        try:
+            metrics.record_bytes(stage, read=getsize(in_path), written=getsize(out_path) if ok else 0)
+        except OSError as e:
+            logging.exception(e)
+
+    def get_output_path(self, tmp_path, file_format):
+        """Returns the final output path for an interleaved tmp file."""
+        # Strip the "tmp_" prefix from the tmp file name
+        out_str = basename(tmp_path)[4:]
+        return pjoin(self.dst_dir, f'{utils.strip_extension(out_str)}.{file_format}')
+
+    def get_output_conversions(self, file_format):
+        """Returns a list of (tmp output path, final output path) tuples for every interleaved tmp file."""
+        res = []
+        for f in self.get_output_tmp_files():
+            res.append((pjoin(self.dst_tmp, f), self.get_output_path(f, file_format)))
+        return res
 
     def convert_output_files(self, convertor, cleanup=False, cleanup_string=None, status_queue=None, cancel=None):
-        """Converts output files into the set output format while copying the files to the final dst directory."""
-        files = self.get_output_tmp_files()
-        file_cnt = len(files)
-        ex = convertor.output_format.file_format
-        for i, f in enumerate(files):
-            if cancel is not None:
-                if cancel.is_set():
-                    return
-            # Strip the "tmp_" prefix from the tmp file name
-            out_str = f[4:]
+        """Converts output files into the set output format while copying the files to the final dst directory.
+
+        Tmp files that couldn't be converted are kept, even with cleanup.
+
+        Returns:
+            list(str): Output paths that couldn't be converted.
+        """
+        conversions = self.get_output_conversions(convertor.output_format.file_format)
+        file_cnt = len(conversions)
+
+        def on_output(i, out_path, ok):
+            f_in = conversions[i][0]
+            self.record_conversion_bytes("convert_outputs", f_in, out_path, ok)
             if status_queue is not None:
-                progress = (i / file_cnt) * 100.0
-                utils.update_progress(status_queue, progress, f"Converting file {i}/{file_cnt}")
-            f_in = pjoin(self.dst_tmp, f)
-            f_out = pjoin(self.dst_dir, f'{utils.strip_extension(out_str)}.{ex}')
-            convertor.convert(f_in, f_out)
-            if cleanup is True and cleanup_string is not None:
-                if cleanup_string in f:
+                progress = ((i + 1) / file_cnt) * 100.0
+                utils.update_progress(status_queue, progress, f"Converting file {i + 1}/{file_cnt}")
+            if ok and cleanup is True and cleanup_string is not None:
+                if cleanup_string in basename(f_in):
                     remove(f_in)
+
+        with tracing.span("convert_output_files", cat="convert", files=file_cnt):
+            return convertor.convert_batch(conversions, on_output=on_output, cancel=cancel)
@@ -0,0 +1,75 @@
+"""
+InterLivre, audiobook splicer
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import wx
+import wx.html
+from appinfo import *
+from webbrowser import open as web_open
+
+
+class ILAboutDialog(wx.Dialog):
+    aboutText = f"""
+    <html>
+    <body>
+    <center>
+    <h1>{APP_NAME}</h1>
+    <p>{VERSION}</p>
+    <p><b>{APP_NAME}</b> is a short hobby project I wrote in Summer, 2024 to splice together English and French versions
+    of audiobooks.</p>
+    <p>I hope it can be helpful to others. However, be warned, I wrote this quickly and tested
+    it lightly... use it at your own risk!</p>
+    <p><b>{APP_NAME}</b> Copyright (c) {COPYRIGHT} <b>{AUTHOR}</b></p>
+    <p>{CONTACT}</p>
+    <hr>
+    <p><font size="-1"> This program comes with ABSOLUTELY NO WARRANTY and is released under the GNU General Public
+    License, version 3: <a href={LICENSE_URL}>{LICENSE_URL}</a>.
+    Please see <i>{LICENSE_FILE}</i>, distributed with <b>{APP_NAME}</b>, for details and license information.
+    </font>
+    </p>
+    <hr>
+    <p><font size="-1"><b>{APP_NAME}</b> is written in Python and uses the following tools/libraries, which have their 
+    own licenses available at the links below and reproduced in the <i>{DEPENDENCY_LICENSE_INFO}</i> file, distributed
+    with <b>{APP_NAME}</b>:</font></p>
+    <p><font size="-1">%s</font></p>
+    </center>
+    </body>
+    </html>
+    """
+    def __init__(self, parent):
+        wx.Dialog.__init__(self, parent, -1, "About InterLivre")
+        html = ILHtmlWindow(self, -1)
+        if "gtk2" in wx.PlatformInfo or "gtk3" in wx.PlatformInfo:
+            html.SetStandardFonts()
+        txt = self.aboutText % self.GetDependencyLicenseHtml(DEPENDENCY_URLS)
+        html.SetPage(txt)
+        ir = html.GetInternalRepresentation()
+        html.SetSize((ir.GetWidth()+25, ir.GetHeight()+25))
+        self.SetClientSize(html.GetSize())
+        self.CentreOnParent(wx.BOTH)
+
+    def GetDependencyLicenseHtml(self, depInfo):
+        res = "<table>"
+        for dep, urls in depInfo.items():
+            depStr = f"""
+            <tr>
+            <td><a href={urls['home']} style="color: black">{dep}</a>:</td>
+            <td><a href={urls['license']}>{urls['license']}</a></td>
+            </tr>
+            """
+            res += depStr
+        res += "</table>"
+        return res
+
+
+class ILHtmlWindow(wx.html.HtmlWindow):
+    def __init__(self, parent, id):
+        wx.html.HtmlWindow.__init__(self, parent, id, size=(420, -1), style=wx.NO_FULL_REPAINT_ON_RESIZE)
+        if "gtk2" in wx.PlatformInfo or "gtk3" in wx.PlatformInfo:
+            self.SetStandardFonts()
+
+    def OnLinkClicked(self, linkInfo):
+        web_open(linkInfo.GetHref())
@@ -6,12 +6,14 @@ InterLivreApp@gmail.com
 """
 
 import wx
-import wx.html
 from pubsub import pub
 import re
 from os.path import isdir
 from appinfo import *
-from webbrowser import open as web_open
+import startupprofile
+
+# Length of the preview clip taken from the start of the first chapter pair
+PREVIEW_MINUTES = 3
 
 
 class ILView:
@@ -20,8 +22,11 @@ class ILView:
         self.app.SetAppName(appName)
         self.frame = ILFrame(None, appName)
         self.app.SetTopWindow(self.frame)
+        startupprofile.mark("Window created")
 
     def Start(self):
+        # Runs once the event loop is idle, after the first window has been drawn
+        wx.CallAfter(startupprofile.finish, "First window shown")
         self.app.MainLoop()
 
 
@@ -60,6 +65,8 @@ class ILFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnExit, closeItem)
 
     def OnAbout(self, e):
+        # wx.html is only loaded once the dialog is first opened
+        from ilaboutdialog import ILAboutDialog
         dlg = ILAboutDialog(self)
         dlg.ShowModal()
         dlg.Destroy()
@@ -72,18 +79,33 @@ class ILFrame(wx.Frame):
                                         style=0 | wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
         self.prgDlg.Fit()
 
-    def EndProgress(self, userCancelled):
+    def EndProgress(self, userCancelled, error=None):
         self.prgDlg.Destroy()
-        if not userCancelled:
+        if error is not None:
+            dlg = wx.MessageDialog(None, error, "Interleaving failed", wx.OK | wx.ICON_ERROR)
+            dlg.ShowModal()
+            dlg.Destroy()
+        elif not userCancelled:
             dlg = wx.MessageDialog(None, "Interleaved audiobook is ready",
                                    "Success!", wx.OK | wx.ICON_INFORMATION)
             dlg.ShowModal()
             dlg.Destroy()
 
+    def ShowPreview(self, previewPath):
+        """Plays a preview clip until the user closes the dialog."""
+        import wx.adv
+        sound = wx.adv.Sound(previewPath)
+        if sound.IsOk():
+            sound.Play(wx.adv.SOUND_ASYNC)
+        dlg = wx.MessageDialog(None, f"Playing the preview, saved to {previewPath}", "Preview",
+                               wx.OK | wx.ICON_INFORMATION)
+        dlg.ShowModal()
+        dlg.Destroy()
+        wx.adv.Sound.Stop()
+
     def UpdateProgressStatus(self, progress, statusMsg):
         self.progress = progress
         self.statusMsg = statusMsg
-        wx.MilliSleep(50)
         wx.Yield()
         keepGoing, _ = self.prgDlg.Update(self.progress, self.statusMsg)
         return not keepGoing
@@ -93,31 +115,41 @@ class ILFrame(wx.Frame):
 
 
 class ILBookView(wx.Simplebook):
+    """Steps through the pages of the form. Only the first page is built up front, the rest on first visit."""
+    pageSpecs = [("ILDirSelectPage", "Choose folders", "Choose folders containing audio files to interleave"),
+                 ("ILFilesFoundPage", "Confirm files", "Files found"),
+                 ("ILAudioSettingsPage", "Select output format", "Output and segmentation settings")]
+
     def __init__(self, parent, title):
         wx.Simplebook.__init__(self, parent)
         self.title = title
 
-        # Create Pages
-        dirPage = ILPage(self, "ILDirSelectPage", self.OnNextPage, self.OnPrevPage,
-                              isFirstPage=True, headerText="Choose folders containing audio files to interleave")
-        reorderPage = ILPage(self, "ILFilesFoundPage", self.OnNextPage, self.OnPrevPage, headerText="Files found")
-        audioPage = ILPage(self, "ILAudioSettingsPage", self.OnNextPage, self.OnPrevPage, headerText="Output and segmentation settings", isLastPage=True)
-        self.AddPage(dirPage, "Choose folders")
-        self.AddPage(reorderPage, "Confirm files")
-        self.AddPage(audioPage, "Select output format")
+        # Create the first page
+        dirPage = self.CreatePage(0)
 
         # Sizer
         self.windowSizer = wx.BoxSizer()
         self.windowSizer.Add(dirPage, 1, wx.ALL | wx.EXPAND, 4)
         self.SetSizerAndFit(self.windowSizer)
 
+    def CreatePage(self, pageIdx):
+        """Builds the page at pageIdx and tells the controller, which sends it the current model state."""
+        pageType, pageName, headerText = self.pageSpecs[pageIdx]
+        page = ILPage(self, pageType, self.OnNextPage, self.OnPrevPage, isFirstPage=pageIdx == 0,
+                      isLastPage=pageIdx == len(self.pageSpecs) - 1, headerText=headerText)
+        self.AddPage(page, pageName)
+        pub.sendMessage("PageCreated", pageType=pageType)
+        return page
+
     def OnNextPage(self, e):
         pageIdx = self.GetSelection()
         nextPage = pageIdx + 1
-        if nextPage < self.GetPageCount():
+        if nextPage < len(self.pageSpecs):
             if self.GetPage(pageIdx).Submit() == wx.ID_OK:
+                if nextPage == self.GetPageCount():
+                    self.CreatePage(nextPage)
                 self.ChangeSelection(nextPage)
-        elif pageIdx == (self.GetPageCount() - 1):
+        elif pageIdx == (len(self.pageSpecs) - 1):
             if self.GetPage(pageIdx).Submit() == wx.ID_OK:
                 self.ChangeSelection(0)
                 self.Reset()
@@ -379,16 +411,26 @@ class ILAudioSettingsPage(wx.Panel, ILForm):
         # Write to disk
         self.writeSegmentsChk = wx.CheckBox(self, wx.ID_ANY, label="Write speech segments to disk as 48k wav files")
 
+        # Virtual chapters
+        self.shardChk = wx.CheckBox(self, wx.ID_ANY, label="Split single-file books into virtual chapters")
+
+        # Preview
+        self.previewBtn = wx.Button(self, wx.ID_ANY, label="Preview")
+        previewLabel = wx.StaticText(self, wx.ID_ANY, f"Listen to the first {PREVIEW_MINUTES} minutes of chapter 1")
+
         # Bindings
         self.sampleRateChoice.Bind(wx.EVT_CHOICE, self.OnSampleRateChosen)
         self.fileFormatChoice.Bind(wx.EVT_CHOICE, self.OnFileFormatChosen)
         self.segMinSpinCtrl.Bind(wx.EVT_SPINCTRL, self.OnMinSegmentChanged)
         self.segMaxSpinCtrl.Bind(wx.EVT_SPINCTRL, self.OnMaxSegmentChanged)
         self.writeSegmentsChk.Bind(wx.EVT_CHECKBOX, self.OnWriteBoxToggled)
+        self.shardChk.Bind(wx.EVT_CHECKBOX, self.OnShardBoxToggled)
+        self.previewBtn.Bind(wx.EVT_BUTTON, self.OnPreviewClicked)
 
         # Subscribe
         pub.subscribe(self.OnSegmentRangeChanged, "SegmentRangeChanged")
         pub.subscribe(self.OnWriteSegmentsChanged, "WriteSegmentsChanged")
+        pub.subscribe(self.OnShardSingleFilesChanged, "ShardSingleFilesChanged")
 
         # Sizers
         hbox = wx.BoxSizer(wx.HORIZONTAL)
@@ -397,6 +439,10 @@ class ILAudioSettingsPage(wx.Panel, ILForm):
         hbox.Add(segMaxLabel, 0, wx.ALL | wx.CENTER, 2)
         hbox.Add(self.segMaxSpinCtrl, 0, wx.ALL, 2)
 
+        previewBox = wx.BoxSizer(wx.HORIZONTAL)
+        previewBox.Add(self.previewBtn, 0, wx.ALL, 2)
+        previewBox.Add(previewLabel, 0, wx.ALL | wx.CENTER, 2)
+
         vbox = wx.BoxSizer(wx.VERTICAL)
         vbox.Add(sampleRateLabel, 0, wx.ALL | wx.EXPAND, 2)
         vbox.Add(self.sampleRateChoice, 0, wx.ALL | wx.EXPAND, 2)
@@ -407,6 +453,9 @@ class ILAudioSettingsPage(wx.Panel, ILForm):
         vbox.Add(hbox, 0, wx.ALL | wx.EXPAND, 2)
         vbox.AddSpacer(8)
         vbox.Add(self.writeSegmentsChk, 0, wx.ALL | wx.EXPAND, 2)
+        vbox.Add(self.shardChk, 0, wx.ALL | wx.EXPAND, 2)
+        vbox.AddSpacer(8)
+        vbox.Add(previewBox, 0, wx.ALL | wx.EXPAND, 2)
 
         self.SetAutoLayout(1)
         self.SetSizerAndFit(vbox)
@@ -450,6 +499,15 @@ class ILAudioSettingsPage(wx.Panel, ILForm):
         chkState = self.writeSegmentsChk.GetValue()
         pub.sendMessage("WriteSegmentsChanging", should_write_segments=chkState)
 
+    def OnShardSingleFilesChanged(self, should_shard):
+        self.shardChk.SetValue(should_shard)
+
+    def OnShardBoxToggled(self, e):
+        pub.sendMessage("ShardSingleFilesChanging", should_shard=self.shardChk.GetValue())
+
+    def OnPreviewClicked(self, e):
+        pub.sendMessage("Preview", minutes=PREVIEW_MINUTES)
+
     def Reset(self):
         self.sampleRateChoice.SetSelection(0)
         self.fileFormatChoice.SetSelection(0)
@@ -543,67 +601,3 @@ class ILTextWidget(wx.Panel):
 
     def GetValue(self):
         return self.pathCtrl.GetValue()
-
-
-class ILAboutDialog(wx.Dialog):
-    aboutText = f"""
-    <html>
-    <body>
-    <center>
-    <h1>{APP_NAME}</h1>
-    <p>{VERSION}</p>
-    <p><b>{APP_NAME}</b> is a short hobby project I wrote in Summer, 2024 to splice together English and French versions
-    of audiobooks.</p>
-    <p>I hope it can be helpful to others. However, be warned, I wrote this quickly and tested
-    it lightly... use it at your own risk!</p>
-    <p><b>{APP_NAME}</b> Copyright (c) {COPYRIGHT} <b>{AUTHOR}</b></p>
-    <p>{CONTACT}</p>
-    <hr>
-    <p><font size="-1"> This program comes with ABSOLUTELY NO WARRANTY and is released under the GNU General Public
-    License, version 3: <a href={LICENSE_URL}>{LICENSE_URL}</a>.
-    Please see <i>{LICENSE_FILE}</i>, distributed with <b>{APP_NAME}</b>, for details and license information.
-    </font>
-    </p>
-    <hr>
-    <p><font size="-1"><b>{APP_NAME}</b> is written in Python and uses the following tools/libraries, which have their 
-    own licenses available at the links below and reproduced in the <i>{DEPENDENCY_LICENSE_INFO}</i> file, distributed
-    with <b>{APP_NAME}</b>:</font></p>
-    <p><font size="-1">%s</font></p>
-    </center>
-    </body>
-    </html>
-    """
-    def __init__(self, parent):
-        wx.Dialog.__init__(self, parent, -1, "About InterLivre")
-        html = ILHtmlWindow(self, -1)
-        if "gtk2" in wx.PlatformInfo or "gtk3" in wx.PlatformInfo:
-            html.SetStandardFonts()
-        txt = self.aboutText % self.GetDependencyLicenseHtml(DEPENDENCY_URLS)
-        html.SetPage(txt)
-        ir = html.GetInternalRepresentation()
-        html.SetSize((ir.GetWidth()+25, ir.GetHeight()+25))
-        self.SetClientSize(html.GetSize())
-        self.CentreOnParent(wx.BOTH)
-
-    def GetDependencyLicenseHtml(self, depInfo):
-        res = "<table>"
-        for dep, urls in depInfo.items():
-            depStr = f"""
-            <tr>
-            <td><a href={urls['home']} style="color: black">{dep}</a>:</td>
-            <td><a href={urls['license']}>{urls['license']}</a></td>
-            </tr>
-            """
-            res += depStr
-        res += "</table>"
-        return res
-
-
-class ILHtmlWindow(wx.html.HtmlWindow):
-    def __init__(self, parent, id):
-        wx.html.HtmlWindow.__init__(self, parent, id, size=(420, -1), style=wx.NO_FULL_REPAINT_ON_RESIZE)
-        if "gtk2" in wx.PlatformInfo or "gtk3" in wx.PlatformInfo:
-            self.SetStandardFonts()
-
-    def OnLinkClicked(self, linkInfo):
-        web_open(linkInfo.GetHref())
@@ -0,0 +1,252 @@
+"""
+InterLivre, audiobook splicer
+
+Command line interface for headless hosts. Never imports wx.
+
+Example:
+    python ilcli.py interleave SRC1 SRC2 DST --name MyBook --seg 5:18 --format mp3 --rate 44100 --jobs 4
+    python ilcli.py batch library.json --books 2 --jobs 8
+
+Progress is printed to stdout as one JSON object per line, at most four times a second, for example
+    {"event": "progress", "progress": 42, "message": "Processing chapters, 5/12 done",
+     "audio_seconds_per_second": 95.3, "eta_seconds": 310}
+followed by a final "finished", "cancelled" or "error" event. eta_seconds is null until it can be estimated. A batch
+prints its overall progress without the throughput and time left, and its final event lists the result of each book.
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import json
+import logging
+import signal
+import sys
+import threading
+from os.path import abspath, basename, isdir
+import startupprofile
+
+# Subcommands, used by InterLivre.py to tell command line runs from GUI launches
+COMMANDS = ('interleave', 'batch')
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_PREFLIGHT = 3
+EXIT_CANCELLED = 130
+
+
+class JsonStatusQueue:
+    """Prints (progress, message) status tuples to a stream as JSON lines."""
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def put(self, status):
+        self.event("progress", progress=int(round(status[0])), message=status[1])
+
+    def put_progress(self, snapshot):
+        """Prints a ProgressTracker snapshot with its throughput and time left."""
+        eta = snapshot["eta_seconds"]
+        self.event("progress", progress=min(max(int(snapshot["progress"]), 1), 99), message=snapshot["message"],
+                   audio_seconds_per_second=round(snapshot["audio_seconds_per_second"], 1),
+                   eta_seconds=int(round(eta)) if eta is not None else None)
+
+    def event(self, name, **fields):
+        """Prints an event with any extra fields."""
+        self.stream.write(json.dumps(dict(event=name, **fields)) + "\n")
+        self.stream.flush()
+
+
+class TextStatusQueue(JsonStatusQueue):
+    """Prints status tuples and events as plain text for people watching a terminal."""
+
+    def put(self, status):
+        self.stream.write(f"{int(round(status[0])):3d}% {status[1]}\n")
+        self.stream.flush()
+
+    def put_progress(self, snapshot):
+        from progress import ProgressTracker
+        self.put((min(max(int(snapshot["progress"]), 1), 99), ProgressTracker.format_message(snapshot)))
+
+    def event(self, name, **fields):
+        details = " ".join(f"{k}={v}" for k, v in fields.items())
+        self.stream.write(f"{name} {details}".rstrip() + "\n")
+        self.stream.flush()
+
+
+def parse_segment_range(s):
+    """Parses a 'MIN:MAX' segment length range in seconds for argparse."""
+    try:
+        seg_min, seg_max = [int(x) for x in s.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected MIN:MAX in seconds, got '{s}'")
+    if seg_min < 1 or seg_max <= seg_min:
+        raise argparse.ArgumentTypeError("MIN must be at least 1 and less than MAX")
+    return seg_min, seg_max
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="interlivre", description="InterLivre audiobook splicer",
+                                     epilog=f"Add {startupprofile.STARTUP_PROFILE_FLAG} to any command line to print "
+                                            f"import and start up times to stderr")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    interleave = sub.add_parser('interleave', help="Interleave the chapters of two recordings of a book")
+    interleave.add_argument('src1', help="Directory containing the book 1 audio files")
+    interleave.add_argument('src2', help="Directory containing the book 2 audio files")
+    interleave.add_argument('dst', help="Directory to write the interleaved audio files")
+    interleave.add_argument('--name', default=None, help="Output file name prefix, defaults to the DST folder name")
+    interleave.add_argument('--seg', type=parse_segment_range, default=(5, 18), metavar="MIN:MAX",
+                            help="Seconds to wait before switching between recordings (default 5:18)")
+    interleave.add_argument('--format', default='wav', choices=['wav', 'mp3'], help="Output file format")
+    interleave.add_argument('--rate', type=int, default=48000, choices=[48000, 44100, 16000],
+                            help="Output sample rate")
+    interleave.add_argument('--jobs', type=int, default=None, help="Number of chapter worker processes")
+    interleave.add_argument('--memory-budget', type=int, default=None, metavar="MB",
+                            help="RAM budget for the chapter workers in megabytes")
+    interleave.add_argument('--shard', action='store_true', help="Split single-file books into virtual chapters")
+    interleave.add_argument('--shard-seconds', type=int, default=1800, help="Length of each virtual chapter")
+    interleave.add_argument('--write-segments', action='store_true', help="Write each speech segment to disk")
+    interleave.add_argument('--progress', default='json', choices=['json', 'text'],
+                            help="Format of the progress printed to stdout")
+    interleave.add_argument('--trace', default=None, metavar='PATH',
+                            help="Save a Chrome trace-event JSON file of the stages, viewable in Perfetto")
+    interleave.add_argument('--metrics-json', default=None, metavar='PATH',
+                            help="Save the job's counters and histograms as JSON")
+    interleave.add_argument('--metrics-textfile', default=None, metavar='PATH',
+                            help="Save the job's metrics for the Prometheus node exporter's textfile collector")
+
+    batch = sub.add_parser('batch', help="Interleave many book pairs listed in a JSON batch file on one pool of "
+                                         "chapter workers")
+    batch.add_argument('batch_file', help="JSON file listing the books, see batch.py")
+    batch.add_argument('--books', type=int, default=None,
+                       help="Number of books to check, convert and queue at the same time (default 2)")
+    batch.add_argument('--jobs', type=int, default=None, help="Number of chapter worker processes")
+    batch.add_argument('--memory-budget', type=int, default=None, metavar="MB",
+                       help="RAM budget for the chapter workers in megabytes")
+    batch.add_argument('--progress', default='json', choices=['json', 'text'],
+                       help="Format of the progress printed to stdout")
+    batch.add_argument('--metrics-json', default=None, metavar='PATH',
+                       help="Save the batch's counters and histograms as JSON")
+    batch.add_argument('--metrics-textfile', default=None, metavar='PATH',
+                       help="Save the batch's metrics for the Prometheus node exporter's textfile collector")
+    return parser
+
+
+def get_job_settings(args):
+    """Returns the JobSettings for the parsed interleave arguments."""
+    from pipeline import JobSettings
+    name = args.name if args.name is not None else basename(abspath(args.dst))
+    return JobSettings(src1_dir=args.src1, src2_dir=args.src2, dst_dir=args.dst, dst_name=name,
+                       seg_size_min=args.seg[0], seg_size_max=args.seg[1], write_segments=args.write_segments,
+                       shard_single_files=args.shard, shard_seconds=args.shard_seconds, dst_sample_rate=args.rate,
+                       dst_file_format=args.format, max_jobs=args.jobs,
+                       memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None,
+                       trace_path=abspath(args.trace) if args.trace else None)
+
+
+def run_interleave(args):
+    status_queue = TextStatusQueue() if args.progress == 'text' else JsonStatusQueue()
+    for path in (args.src1, args.src2, args.dst):
+        if not isdir(path):
+            status_queue.event("error", message=f"Directory not found ({path})")
+            return EXIT_USAGE
+
+    # Cancel cleanly on Ctrl+C or when the host asks the job to stop
+    cancel = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: cancel.set())
+
+    from pipeline import Pipeline
+    from preflight import PreflightError
+    pipeline = Pipeline(get_job_settings(args), status_queue=status_queue, cancel=cancel)
+    startupprofile.finish("Command line ready")
+    try:
+        pipeline.run()
+    except PreflightError as e:
+        status_queue.event("error", message=str(e))
+        return EXIT_PREFLIGHT
+    except Exception as e:
+        logging.exception(e)
+        status_queue.event("error", message=str(e))
+        return EXIT_FAILED
+    finally:
+        write_metrics(args)
+    if cancel.is_set():
+        status_queue.event("cancelled", outputs=pipeline.output_paths)
+        return EXIT_CANCELLED
+    status_queue.event("finished", outputs=pipeline.output_paths)
+    return EXIT_OK
+
+
+def run_batch(args):
+    status_queue = TextStatusQueue() if args.progress == 'text' else JsonStatusQueue()
+    from batch import BatchJob, BatchRunner, DEFAULT_ACTIVE_BOOKS
+    try:
+        batch = BatchJob.load(args.batch_file)
+    except (OSError, ValueError) as e:
+        status_queue.event("error", message=f"Invalid batch file: {e}")
+        return EXIT_USAGE
+    if args.jobs is not None:
+        batch.settings.max_jobs = args.jobs
+    if args.memory_budget:
+        batch.settings.memory_budget = args.memory_budget * 1024 * 1024
+
+    cancel = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: cancel.set())
+
+    runner = BatchRunner(batch, status_queue=status_queue, cancel=cancel,
+                         max_active_books=args.books if args.books is not None else DEFAULT_ACTIVE_BOOKS)
+    startupprofile.finish("Command line ready")
+    try:
+        results = runner.run()
+    except Exception as e:
+        logging.exception(e)
+        status_queue.event("error", message=str(e))
+        return EXIT_FAILED
+    finally:
+        write_metrics(args)
+    if cancel.is_set():
+        status_queue.event("cancelled", books=results)
+        return EXIT_CANCELLED
+    failed = [r for r in results if r["result"] != "finished"]
+    if len(failed) > 0:
+        status_queue.event("error", message=f"{len(failed)} of {len(results)} books failed", books=results)
+        return EXIT_FAILED
+    status_queue.event("finished", books=results)
+    return EXIT_OK
+
+
+def write_metrics(args):
+    """Saves the metrics of the job to the paths given on the command line."""
+    if args.metrics_json is None and args.metrics_textfile is None:
+        return
+    import metrics
+    try:
+        if args.metrics_json is not None:
+            metrics.REGISTRY.dump_json(args.metrics_json)
+        if args.metrics_textfile is not None:
+            metrics.REGISTRY.write_prometheus_textfile(args.metrics_textfile)
+    except OSError as e:
+        logging.exception(e)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Logs go to stderr so stdout only has progress
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    if args.command == 'interleave':
+        return run_interleave(args)
+    if args.command == 'batch':
+        return run_batch(args)
+    return EXIT_USAGE
+
+
+if __name__ == '__main__':
+    from multiprocessing import freeze_support
+    freeze_support()
+    startupprofile.enable()
+    sys.exit(main())
@@ -9,7 +9,6 @@ from pubsub import pub
 import utils
 from filemanager import FileManager
 from audiotools import AudioFormat
-from interleaver import Interleaver
 
 
 class ILModel:
@@ -19,11 +18,15 @@ class ILModel:
         self._dst_audio_format = AudioFormat(48000, 16, 1, 'wav')
         self.tmp_audio_format = AudioFormat(48000, 16, 1, 'wav')
         self._dst_name = None
-        self.intersplicer = Interleaver()
         self._is_each_dir_valid = False
         self._seg_size_min = 5
         self._seg_size_max = 18
         self._write_segments = False
+        self._shard_single_files = False
+        self.shard_seconds = 1800
+        # Chapter worker processes and their RAM budget in bytes, None picks a default based on the host
+        self.max_jobs = None
+        self.memory_budget = None
         pub.subscribe(self.OnNotifyPropertyChanged, "NotifyPropertyChanged")
 
     @property
@@ -92,6 +95,17 @@ class ILModel:
             pub.sendMessage("WriteSegmentsChanged", should_write_segments=self._write_segments)
             pub.sendMessage("NotifyPropertyChanged", prop="write_segments")
 
+    @property
+    def shard_single_files(self):
+        return self._shard_single_files
+
+    @shard_single_files.setter
+    def shard_single_files(self, val):
+        if val != self._shard_single_files:
+            self._shard_single_files = val
+            pub.sendMessage("ShardSingleFilesChanged", should_shard=self._shard_single_files)
+            pub.sendMessage("NotifyPropertyChanged", prop="shard_single_files")
+
     def OnNotifyPropertyChanged(self, prop):
         """Quick hack to update properties"""
         is_each_dir_valid = self.is_each_dir_valid
@@ -99,16 +113,10 @@ class ILModel:
             filelist = self.filemanager.src_file_list
 
     def get_tmp_output_filename(self, filename_prefix, idx, section_count):
-        return self.get_output_filename(f"tmp_{filename_prefix}", idx, section_count)
+        return self.filemanager.get_tmp_output_filename(filename_prefix, idx, section_count)
 
     def get_output_filename(self, filename_prefix, idx, section_count):
-        res = filename_prefix
-        if section_count > 99:
-            res += f"_{idx:05d}"
-        elif section_count > 1:
-            res += f"_{idx:02d}"
-        res += ".wav"
-        return res
+        return self.filemanager.get_output_filename(filename_prefix, idx, section_count)
 
     def create_workspace(self):
         src_files = self.filemanager.src_files_selected
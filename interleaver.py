@@ -8,10 +8,18 @@ See LICENSE for license information.
 InterLivreApp@gmail.com
 """
 
+from os.path import getsize
 import numpy as np
 from scipy.io import wavfile as wav
+from edl import EditDecisionList
+from silencemap import SilenceMap, SilenceMapCache, MIN_SILENCE_SECONDS
+import metrics
+import tracing
 import utils
 
+# Share of a chapter's progress spent assembling and writing the output, the rest is segmenting the sources
+ASSEMBLE_PROGRESS_SHARE = 0.2
+
 
 class Interleaver:
     """Combines two audiobooks by interleaving."""
@@ -28,7 +36,8 @@ class Interleaver:
                  segments_path="InterLivre_Segments",
                  dst_name="out",
                  status_queue=None,
-                 cancel=None):
+                 cancel=None,
+                 analysis_dir=None):
         self.sample_rate = sample_rate
         self.min_seg_len = min_seg_seconds * sample_rate
         self.max_seg_len = max_seg_seconds * sample_rate
@@ -41,7 +50,12 @@ class Interleaver:
         # Used by ILViewController thread for progress bar and status messages
         self.status_queue = status_queue
         self.status_msg = ""
+        # Part of the 0 to 100 progress range covered by the current step, set per source by interleave()
+        self.progress_range = (0.0, 100.0)
+        self._last_status = None
         self.cancel_event = cancel
+        # Silence analysis of each source is saved here and reused by later runs, None to analyze every time
+        self.silence_maps = SilenceMapCache(analysis_dir) if analysis_dir else None
 
     def read(self, file_path):
         """Read a 48k, mono or stereo wav file from disk.
@@ -56,6 +70,7 @@ class Interleaver:
             ValueError: If sample rate != 48000 or channel count is not mono or stereo.
         """
         file_sr, buf = wav.read(file_path)
+        metrics.record_bytes("interleave", read=getsize(file_path))
         if file_sr != self.sample_rate:
             raise ValueError(f'Invalid sample rate, expected {self.sample_rate}')
         if buf.ndim != self.channel_cnt:
@@ -71,10 +86,16 @@ class Interleaver:
         Returns:
             bool: True if interleaving process should continue.
         """
-        utils.update_progress(self.status_queue, progress, self.status_msg)
+        lo, hi = self.progress_range
+        progress = lo + (hi - lo) * progress / 100.0
+        # Called for every split point and segment, only whole percent changes are worth reporting
+        status = (int(progress), self.status_msg)
+        if status != self._last_status:
+            self._last_status = status
+            utils.update_progress(self.status_queue, progress, self.status_msg)
         return not utils.is_cancelled(self.cancel_event)
 
-    def interleave(self, src_path_1, src_path_2, dst_path, status_msg=""):
+    def interleave(self, src_path_1, src_path_2, dst_path, status_msg="", edl_path=None, edl_sources=None):
         """Interleave audiobook chapters into a new combined file and write it to disk.
 
         Reads wav files from disk for the corresponding chapters from each source, segments the chapters into sections,
@@ -85,89 +106,99 @@ class Interleaver:
             src_path_2 (str): Path to book 2 chapter
             dst_path (str): Output path for combined chapter
             status_msg (str): Start of the message to be displayed by the progress dialogue. (e.g. 'file 1/24')
+            edl_path (str): If set, the chapter's EditDecisionList is saved here.
+            edl_sources (list(str)): Source files recorded in the EditDecisionList, defaults to the chapter paths.
         """
 
-        # Segment Src 1
-        src1 = self.read(src_path_1)
-        self.status_msg = f"{status_msg}, segmenting source 1"
-        split_points_1 = self.segment(src1)
+        with tracing.span("interleave", cat="interleave", chapter=self.dst_name):
+            ranges = self.get_progress_ranges([getsize(src_path_1), getsize(src_path_2)])
+            # Segment Src 1
+            with tracing.span("read", cat="interleave", chapter=self.dst_name, source=1):
+                src1 = self.read(src_path_1)
+            self.status_msg = f"{status_msg}, segmenting source 1"
+            self.progress_range = ranges[0]
+            fades_1 = []
+            with tracing.span("segment", cat="interleave", chapter=self.dst_name, source=1):
+                split_points_1 = self.segment(src1, self.get_silence_map(src_path_1, src1), fades_1)
+            if split_points_1 is None:
+                return
+
+            # Segment Src 2
+            with tracing.span("read", cat="interleave", chapter=self.dst_name, source=2):
+                src2 = self.read(src_path_2)
+            self.status_msg = f"{status_msg}, segmenting source 2"
+            self.progress_range = ranges[1]
+            fades_2 = []
+            with tracing.span("segment", cat="interleave", chapter=self.dst_name, source=2):
+                split_points_2 = self.segment(src2, self.get_silence_map(src_path_2, src2), fades_2)
+            if split_points_2 is None:
+                return
 
-        # Segment Src 2
-        src2 = self.read(src_path_2)
-        self.status_msg = f"{status_msg}, segmenting source 2"
-        split_points_2 = self.segment(src2)
+            # Assemble new file
+            self.status_msg = f"{status_msg}, interleaving audio"
+            self.progress_range = ranges[2]
+            with tracing.span("assemble_segments", cat="interleave", chapter=self.dst_name):
+                plan = self.plan_segments(len(src1), len(src2), split_points_1, split_points_2)
+                spliced_audio = self.render_segments(src1, src2, plan)
+            if spliced_audio is None:
+                return
+            with tracing.span("write", cat="interleave", chapter=self.dst_name):
+                wav.write(dst_path, self.sample_rate, spliced_audio.astype(np.int16))
+            metrics.record_bytes("interleave", written=getsize(dst_path))
+            self.record_segment_lengths(plan)
+            if edl_path is not None:
+                sources = edl_sources if edl_sources is not None else [src_path_1, src_path_2]
+                edl = EditDecisionList(self.sample_rate, self.channel_cnt, [len(src1), len(src2)], plan,
+                                       [fades_1, fades_2], sources, [utils.fingerprint_file(p) for p in sources])
+                edl.save(edl_path)
+
+    @classmethod
+    def get_progress_ranges(cls, source_bytes):
+        """Splits the chapter's 0 to 100 progress between segmenting each source, by size, and assembling the output.
 
-        # Assemble new file
-        self.status_msg = f"{status_msg}, interleaving audio"
-        spliced_audio = self.assemble_segments(src1, src2, split_points_1, split_points_2)
-        wav.write(dst_path, self.sample_rate, spliced_audio.astype(np.int16))
+        Returns:
+            list(tuple): (start, end) progress of segmenting source 1, segmenting source 2, and assembling.
+        """
+        segmenting = 100.0 * (1.0 - ASSEMBLE_PROGRESS_SHARE)
+        total = sum(source_bytes)
+        split = segmenting * source_bytes[0] / total if total > 0 else segmenting / 2
+        return [(0.0, split), (split, segmenting), (segmenting, 100.0)]
 
     # region Segmentation
 
-    def find_start_point(self, buffer, threshold=1000, step_size=480):
-        """Returns index of first sample over the given amplitude threshold using a given step size."""
-        for i in range(0, len(buffer), step_size):
-            if abs(buffer[i]) > threshold:
-                while i > 0:
-                    i -= 1
-                    if buffer[i] < threshold:
-                        return i + 1
-        return -1
-
-    def find_end_point(self, buffer, threshold=1000, step_size=480):
-        """Returns index of last sample over the given amplitude threshold using a given step size."""
-        for i in reversed(range(0, len(buffer), step_size)):
-            if abs(buffer[i]) > threshold:
-                while i < len(buffer):
-                    i += 1
-                    if buffer[i] < threshold:
-                        return i - 1
-        return 0
-
-    def find_split_point(self, buffer, start=0, end=np.inf, threshold=1000, sample_stride=1):
-        """Finds the longest window of silence in buffer[start:end]
+    def get_silence_map(self, file_path, buffer):
+        """Returns the SilenceMap of a source, loading it from its sidecar if an earlier run saved one.
 
         Args:
-            buffer (np.array): Audio data.
-            start (int): Index in buffer to begin search.
-            end (int): Index in buffer to stop search.
-            threshold (int): Noise gate threshold.
+            file_path (str): Path the buffer was read from.
+            buffer (np.array): Audio data read from file_path.
 
         Returns:
-            A tuple containing the start, middle, and end indices in buffer describing the longest window of silence
+            SilenceMap: Silence analysis of buffer, or None if cancelled.
+        """
+        min_run = int(MIN_SILENCE_SECONDS * self.sample_rate)
+        if self.silence_maps is None:
+            return SilenceMap.analyze(buffer, self.noise_threshold, min_run, self.cancel_event)
+        return self.silence_maps.get_or_analyze(file_path, buffer, self.noise_threshold, min_run, self.cancel_event)
+
+    def segment(self, buffer, silence_map=None, fades=None):
+        """Returns a list of suitable points at which to switch from the current audiobook to another
+
+        Args:
+            buffer (np.array): Audio data. Fades are applied around each split point in place.
+            silence_map (SilenceMap): Silence analysis of buffer, analyzed here if None.
+            fades (list): If given, the (start, split, end) of each fade is appended to it.
         """
-        if end == np.inf:
-            end = len(buffer)
-        max_gap = 0
-        start_idx = start
-        end_idx = start
-        i = start
-        while i < end:
-            curr_start = i
-            # Increment i by some small stride until the next sample over the threshold
-            # If the stride is too large, this adds a chance of error by matching speaker frequency
-            while i < end and abs(buffer[i]) < threshold:
-                i += 6
-            # Update the start and end points for the window of silence
-            curr_end = i
-            curr_max = curr_end - curr_start
-            # Update the result variables when a new max gap is found
-            if curr_max > max_gap:
-                max_gap = curr_max
-                start_idx = curr_start
-                end_idx = curr_end
-            i += sample_stride
-        # Return a tuple containing the split point, start point, and end point
-        mid_idx = int((end_idx - start_idx) / 2) + start_idx
-        return start_idx, mid_idx, end_idx
-
-    def segment(self, buffer):
-        """Returns a list of suitable points at which to switch from the current audiobook to another"""
+        if silence_map is None:
+            silence_map = SilenceMap.analyze(buffer, self.noise_threshold, int(MIN_SILENCE_SECONDS * self.sample_rate),
+                                             self.cancel_event)
+        if silence_map is None or utils.is_cancelled(self.cancel_event):
+            return
         # Filename vars
         segment_count = 0
         split_points = []
-        speech_start_idx = self.find_start_point(buffer, self.noise_threshold)
-        speech_end_idx = self.find_end_point(buffer, self.noise_threshold)
+        speech_start_idx = silence_map.speech_start
+        speech_end_idx = silence_map.speech_end
 
         # Trim leading silence
         if speech_start_idx > self.sample_rate * 2:
@@ -182,10 +213,27 @@ class Interleaver:
         while (i + self.max_seg_len) < speech_end_idx:
             window_start = min(i + self.min_seg_len, len(buffer))
             window_end = min(i + self.max_seg_len, len(buffer))
-            start, split, end = self.find_split_point(buffer, window_start, window_end, self.noise_threshold, 360)
+            start, split, end = silence_map.longest_silence(window_start, window_end)
+            metrics.counter("segment_windows_total", "Windows searched for a split point").inc()
+            if end == start:
+                # No pause long enough to be kept in the map, split in the longest gap within speech instead
+                run = utils.find_longest_silence(buffer, self.noise_threshold, window_start, window_end)
+                if run is not None:
+                    start, end = run
+                    split = (end - start) // 2 + start
+                    metrics.counter("segment_windows_short_silence_total",
+                                    "Windows split in a quiet run shorter than MIN_SILENCE_SECONDS").inc()
+            if end == start:
+                metrics.counter("segment_windows_without_silence_total",
+                                "Windows with no silence to split at, split at the window start").inc()
+            else:
+                metrics.histogram("segment_silence_seconds", "Length of the silence chosen for each split",
+                                  metrics.SILENCE_SECONDS_BUCKETS).observe((end - start) / self.sample_rate)
             # Fade in/out around split point
             utils.apply_lin_env(buffer, start, split, 1.0, 0.0)
             utils.apply_lin_env(buffer, split, end, 0.0, 1.0)
+            if fades is not None:
+                fades.append((start, split, end))
             split_points.append(split)
             segment_count += 1
             i = end
@@ -200,79 +248,114 @@ class Interleaver:
 
         return split_points
 
+    def record_segment_lengths(self, plan):
+        """Adds the length of each planned segment to the segment length histogram."""
+        segment_seconds = metrics.histogram("segment_seconds", "Length of each interleaved segment",
+                                            metrics.SEGMENT_SECONDS_BUCKETS)
+        for src, start, end in plan:
+            segment_seconds.observe((end - start) / self.sample_rate, source=src + 1)
+
     # endregion
 
-    def append_segment(self, dst_book, segment, isSrc1, seg_idx, total_idx):
+    def write_segment(self, segment, isSrc1, seg_idx, total_idx):
+        """Writes a segment to the segments directory as a wav file, if segments should be written."""
         if self.should_write_segments:
             src_str = "src1" if isSrc1 else "src2"
             segment_name = f"{self.dst_name}_{total_idx:06d}_{src_str}_{seg_idx:06d}.wav"
             seg_path = utils.pjoin(self.segments_path, self.dst_name)
             seg_path = utils.pjoin(seg_path, segment_name)
-            wav.write(seg_path, self.sample_rate, segment.astype(np.int16))
-        return np.append(dst_book, segment)
+            with tracing.span("write_segment", cat="interleave", chapter=self.dst_name, source=1 if isSrc1 else 2):
+                wav.write(seg_path, self.sample_rate, segment.astype(np.int16))
+            metrics.record_bytes("interleave", written=getsize(seg_path))
 
     def assemble_segments(self, src1, src2, splits1, splits2, status_msg=""):
         """Interleaves audio from two sources using the given split points"""
-        res = np.array([])
-        i = 0
+        return self.render_segments(src1, src2, self.plan_segments(len(src1), len(src2), splits1, splits2))
+
+    def plan_segments(self, src1_samples, src2_samples, splits1, splits2):
+        """Decides the order of the segments from two sources with the given lengths and split points.
+
+        Returns:
+            list(tuple): (source, start, end) for each segment in output order, where source is 0 for source 1 and
+                1 for source 2.
+        """
+        plan = []
 
         # Trim off any leading or trailing silence
         leading_silence_1 = splits1[0]
         leading_silence_2 = splits2[0]
-        trailing_silence_1 = len(src1) - splits1[-1]
-        trailing_silence_2 = len(src2) - splits2[-1]
+        trailing_silence_1 = src1_samples - splits1[-1]
+        trailing_silence_2 = src2_samples - splits2[-1]
         endpoints_silence_1 = leading_silence_1 + trailing_silence_1
         endpoints_silence_2 = leading_silence_2 + trailing_silence_2
-        src1_len = len(src1) - endpoints_silence_1
-        src2_len = len(src2) - endpoints_silence_2
+        src1_len = src1_samples - endpoints_silence_1
+        src2_len = src2_samples - endpoints_silence_2
         src1_seg_cnt = len(splits1) - 1
         src2_seg_cnt = len(splits2) - 1
         src1_curr_idx = 1
         src2_curr_idx = 1
-        total_segments = 1
         src2_ratio = float(splits2[src2_curr_idx] - endpoints_silence_2) / float(src2_len)
 
         while src1_curr_idx < src1_seg_cnt:
-            # Read and append src1 segment
-            seg_start = splits1[src1_curr_idx - 1]
+            # Add a src1 segment
             seg_end = splits1[src1_curr_idx]
-            seg1 = src1[seg_start:seg_end]
-            res = self.append_segment(res, seg1, True, src1_curr_idx, total_segments)
-
-            # Update src1 counters
+            plan.append((0, splits1[src1_curr_idx - 1], seg_end))
             src1_ratio = float(seg_end - endpoints_silence_1) / float(src1_len)
             src1_curr_idx += 1
-            total_segments += 1
 
             while src1_ratio > src2_ratio and src2_curr_idx < src2_seg_cnt:
-                # Read and append source 2 segment
-                seg_start = splits2[src2_curr_idx - 1]
-                seg_end = splits2[src2_curr_idx]
-                seg2 = src2[seg_start:seg_end]
-                res = self.append_segment(res, seg2, False, src2_curr_idx, total_segments)
-
-                # Update src2 counters
+                # Add source 2 segments until it catches up with source 1
+                plan.append((1, splits2[src2_curr_idx - 1], splits2[src2_curr_idx]))
                 src2_curr_idx += 1
                 src2_ratio = float(splits2[src2_curr_idx] - endpoints_silence_2) / float(src2_len)
-                total_segments += 1
 
+        # Add remaining src2 segments up to the penultimate segment
+        while src2_curr_idx < src2_seg_cnt:
+            plan.append((1, splits2[src2_curr_idx - 1], splits2[src2_curr_idx]))
+            src2_curr_idx += 1
+
+        # Add the final segments
+        plan.append((0, splits1[-2], splits1[-1]))
+        plan.append((1, splits2[-2], splits2[-1]))
+        return plan
+
+    def render_segments(self, src1, src2, plan):
+        """Joins the segments of two sources in the order given by plan_segments().
+
+        Returns:
+            numpy array: The interleaved audio, or None if cancelled.
+        """
+        sources = (src1, src2)
+        seg_counts = [0, 0]
+        parts = []
+        for total_idx, (src, start, end) in enumerate(plan, start=1):
+            seg_counts[src] += 1
+            segment = sources[src][start:end]
+            self.write_segment(segment, src == 0, seg_counts[src], total_idx)
+            parts.append(segment)
             # Update state so GUI can update its progress bar
-            if self.update_progress((src1_ratio + src2_ratio) * 50.0) != Interleaver.SHOULD_CONTINUE:
+            if self.update_progress(total_idx / len(plan) * 100.0) != Interleaver.SHOULD_CONTINUE:
                 return
+        return np.concatenate(parts) if len(parts) > 0 else np.array([])
 
-        # Append remaining src2 segments up to the penultimate segment
-        while src2_curr_idx < src2_seg_cnt:
-            seg_start = splits2[src2_curr_idx-1]
-            seg_end = splits2[src2_curr_idx]
-            seg2 = src2[seg_start:seg_end]
-            res = self.append_segment(res, seg2, False, src2_curr_idx, total_segments)
-            src2_curr_idx += 1
-            total_segments += 1
+    def render_edl(self, edl, src1, src2):
+        """Rebuilds an interleaved chapter from its EditDecisionList and source audio without any analysis.
+
+        Args:
+            edl (EditDecisionList): Plan of the chapter.
+            src1 (np.array): Book 1 source audio. Fades are applied in place.
+            src2 (np.array): Book 2 source audio. Fades are applied in place.
 
-        # Append the final segments
-        seg1 = src1[splits1[-2]:splits1[-1]]
-        res = self.append_segment(res, seg1, True, src1_curr_idx, total_segments)
-        seg2 = src2[splits2[-2]:splits2[-1]]
-        res = self.append_segment(res, seg2, False, src2_curr_idx, total_segments+1)
+        Returns:
+            numpy array: The interleaved audio, or None if cancelled.
 
-        return res
+        Raises:
+            ValueError: If the source lengths don't match the plan.
+        """
+        if [len(src1), len(src2)] != edl.lengths:
+            raise ValueError("Source audio doesn't match the edit decision list")
+        for buffer, fades in zip((src1, src2), edl.fades):
+            for start, split, end in fades:
+                utils.apply_lin_env(buffer, start, split, 1.0, 0.0)
+                utils.apply_lin_env(buffer, split, end, 0.0, 1.0)
+        return self.render_segments(src1, src2, edl.segments)
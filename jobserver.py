@@ -0,0 +1,468 @@
+"""
+InterLivre, audiobook splicer
+
+Local HTTP job server that queues interleave jobs by priority and runs their chapters on one shared pool of workers
+
+Jobs are JSON objects of JobSettings, the same settings the app's model holds, with an optional "priority" key. Lower
+priorities run first, and jobs with the same priority run in the order they were submitted.
+
+    POST /jobs                  Queue a job, returns it with its id
+    GET  /jobs                  List every job
+    GET  /jobs/<id>             Status of a job
+    GET  /jobs/<id>/progress    Progress of a job, with the throughput and time left
+    POST /jobs/<id>/cancel      Cancel a queued or running job
+    GET  /metrics               Metrics in the Prometheus text format
+
+The server has no authentication and the paths in a job are paths on the server, so it only listens on localhost
+unless told otherwise. Use --root to only allow books and outputs under the given folders.
+
+Example:
+    python jobserver.py --port 8765 --books 2 --root /srv/audiobooks
+    curl -X POST localhost:8765/jobs -d '{"src1_dir": "...", "src2_dir": "...", "dst_dir": "...", "dst_name": "book"}'
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import isdir, realpath
+from uuid import uuid4
+from pipeline import JobSettings, Pipeline
+from preflight import PreflightError
+from scheduler import ChapterScheduler
+import metrics
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Books whose inputs are converted and whose chapters are queued at the same time. Their chapters all share one pool
+# of workers, so a couple are enough to keep it busy while another book is converting its inputs.
+DEFAULT_ACTIVE_JOBS = 2
+# Finished, failed and cancelled jobs kept for the status endpoints, oldest are forgotten first
+FINISHED_JOBS_KEPT = 1000
+MAX_REQUEST_BYTES = 1024 * 1024
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+DONE_STATES = (FINISHED, FAILED, CANCELLED)
+
+
+def is_valid_name(name):
+    """Returns True if name can only make output files directly inside dst_dir, i.e. it has no path separators."""
+    if not isinstance(name, str) or name in ("", ".", ".."):
+        return False
+    return not any(c in name for c in ("/", "\\", "\0", os.sep, os.altsep) if c is not None)
+
+
+class JobSpecError(ValueError):
+    """Raised when a submitted job can't be parsed or refers to paths it isn't allowed to use."""
+    pass
+
+
+class _JobStatusQueue:
+    """Keeps the latest status message and progress snapshot of one job."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def put(self, status):
+        progress, msg = status
+        with self.job.lock:
+            if progress >= 0:
+                self.job.progress["progress"] = float(progress)
+            self.job.progress["message"] = msg
+
+    def put_progress(self, snapshot):
+        with self.job.lock:
+            self.job.progress = dict(snapshot)
+
+
+class Job:
+    """An interleave job submitted to the server.
+
+    Attributes:
+        id (str): Identifier used in the job's URLs.
+        settings (JobSettings): Job to run.
+        priority (int): Lower values run first, for both the job and its chapters.
+        state (str): One of queued, running, finished, failed or cancelled.
+        progress (dict): Latest progress snapshot, see ProgressTracker.snapshot().
+        error (str): Why the job failed, or None.
+        output_paths (list(str)): Output chapters written by the job.
+        cancel_event (threading.Event): Set to cancel the job.
+    """
+
+    def __init__(self, settings, priority=0):
+        self.id = uuid4().hex[:12]
+        self.settings = settings
+        self.priority = priority
+        self.state = QUEUED
+        self.progress = {"progress": 0.0, "message": "Queued"}
+        self.error = None
+        self.output_paths = []
+        self.cancel_event = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.state in DONE_STATES
+
+    def progress_dict(self):
+        """Returns the job's state and latest progress snapshot as a JSON-serializable dictionary."""
+        with self.lock:
+            return {"id": self.id, "state": self.state, **self.progress}
+
+    def to_dict(self):
+        """Returns the job as a JSON-serializable dictionary."""
+        with self.lock:
+            return {"id": self.id, "state": self.state, "priority": self.priority,
+                    "progress": self.progress.get("progress", 0.0), "message": self.progress.get("message", ""),
+                    "eta_seconds": self.progress.get("eta_seconds"), "error": self.error,
+                    "submitted_at": self.submitted_at, "started_at": self.started_at,
+                    "finished_at": self.finished_at, "output_paths": list(self.output_paths),
+                    "settings": self.settings.to_dict()}
+
+
+class JobServer:
+    """Queues jobs by priority and runs a few at a time, with every job's chapters on one ChapterScheduler.
+
+    The scheduler has one worker per core (or settings.max_jobs) and a single memory budget, so adding jobs adds to
+    the queue rather than to the number of processes. Chapters are admitted by their job's priority, so an urgent job
+    overtakes the queued chapters of the jobs already running.
+
+    Jobs writing to the same output folder would clobber each other's workspace and manifest, so a job whose dst_dir
+    is in use by a running job is held in the queue until that job is done.
+
+    Attributes:
+        base_settings (JobSettings): Defaults for every job, and the scheduler's workers and memory budget.
+        max_active_jobs (int): Number of jobs run at the same time.
+        allowed_roots (list(str)): Folders every job's paths must be inside, or None to allow any path.
+        chapter_scheduler (ChapterScheduler): Runs the chapters of every job.
+    """
+
+    def __init__(self, base_settings=None, max_active_jobs=DEFAULT_ACTIVE_JOBS, allowed_roots=None):
+        self.base_settings = base_settings if base_settings is not None else JobSettings()
+        self.max_active_jobs = max(1, max_active_jobs)
+        self.allowed_roots = [realpath(r) for r in allowed_roots] if allowed_roots else None
+        self.chapter_scheduler = ChapterScheduler(memory_budget=self.base_settings.memory_budget,
+                                                  max_workers=self.base_settings.max_jobs)
+        self._jobs = {}
+        self._queue = []
+        self._seq = 0
+        # Real paths of the output folders of the running jobs
+        self._active_dirs = set()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._runners = [threading.Thread(target=self._run_jobs, name=f"InterLivreJob-{i}", daemon=True)
+                         for i in range(self.max_active_jobs)]
+        for t in self._runners:
+            t.start()
+
+    def parse_job(self, spec):
+        """Returns the JobSettings and priority of a job submitted as a dictionary.
+
+        Raises:
+            JobSpecError: If the job has unknown settings, missing paths, paths outside the allowed roots, or an output
+                name that isn't a plain file name.
+        """
+        if not isinstance(spec, dict):
+            raise JobSpecError("A job must be a JSON object of settings")
+        spec = dict(spec)
+        priority = spec.pop("priority", 0)
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise JobSpecError("priority must be an integer")
+        d = self.base_settings.to_dict()
+        d.update(spec)
+        try:
+            settings = JobSettings.from_dict(d)
+        except TypeError as e:
+            raise JobSpecError(f"Unknown setting: {e}")
+        if not settings.is_valid():
+            raise JobSpecError("src1_dir, src2_dir, dst_dir and dst_name are required")
+        if not is_valid_name(settings.dst_name):
+            raise JobSpecError(f"dst_name must be a file name, not a path: {settings.dst_name}")
+        for key in ("src1_dir", "src2_dir"):
+            if not isdir(getattr(settings, key)):
+                raise JobSpecError(f"{key} is not a folder: {getattr(settings, key)}")
+        for key in ("src1_dir", "src2_dir", "dst_dir", "trace_path"):
+            path = getattr(settings, key)
+            if path and not self.is_allowed_path(path):
+                raise JobSpecError(f"{key} is outside the folders this server may use: {path}")
+        return settings, priority
+
+    def is_allowed_path(self, path):
+        if self.allowed_roots is None:
+            return True
+        path = realpath(path)
+        return any(path == root or path.startswith(root + os.sep) for root in self.allowed_roots)
+
+    def submit(self, spec):
+        """Queues a job from a dictionary of JobSettings with an optional priority, and returns the Job."""
+        settings, priority = self.parse_job(spec)
+        job = Job(settings, priority)
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError("The server is shutting down")
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (priority, self._seq, job))
+            self._seq += 1
+            self._condition.notify()
+        logging.info(f"{job.id}: queued {settings.dst_name} with priority {priority}")
+        return job
+
+    def get(self, job_id):
+        """Returns the Job with the given id, or None."""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        """Returns every job the server knows of, in the order they were submitted."""
+        with self._condition:
+            return sorted(self._jobs.values(), key=lambda j: j.submitted_at)
+
+    def cancel(self, job_id):
+        """Cancels a job. A queued job is dropped right away, a running one stops at its next check.
+
+        Returns:
+            Job: The job, or None if there is no job with that id.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_event.set()
+            if job.state == QUEUED:
+                self._finish(job, CANCELLED)
+        return job
+
+    def shutdown(self):
+        """Cancels every job, waits for the running ones to stop and shuts down the worker processes."""
+        with self._condition:
+            self._stopping = True
+            for job in self._jobs.values():
+                job.cancel_event.set()
+                if job.state == QUEUED:
+                    self._finish(job, CANCELLED)
+            self._condition.notify_all()
+        for t in self._runners:
+            t.join()
+        self.chapter_scheduler.shutdown()
+
+    def _next_job(self):
+        """Waits for the next queued job in priority order whose output folder isn't in use.
+
+        Returns None once the server is shutting down.
+        """
+        with self._condition:
+            while True:
+                job = None
+                held = []
+                while len(self._queue) > 0:
+                    entry = heapq.heappop(self._queue)
+                    if entry[2].state != QUEUED:
+                        continue
+                    if realpath(entry[2].settings.dst_dir) in self._active_dirs:
+                        held.append(entry)
+                        continue
+                    job = entry[2]
+                    break
+                for entry in held:
+                    heapq.heappush(self._queue, entry)
+                if job is not None:
+                    job.state = RUNNING
+                    job.started_at = time.time()
+                    self._active_dirs.add(realpath(job.settings.dst_dir))
+                    return job
+                if self._stopping:
+                    return None
+                self._condition.wait()
+
+    def _run_jobs(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def _run_job(self, job):
+        name = job.settings.dst_name
+        logging.info(f"{job.id}: starting {name}")
+        pipeline = Pipeline(job.settings, status_queue=_JobStatusQueue(job), cancel=job.cancel_event,
+                            chapter_scheduler=self.chapter_scheduler, priority=job.priority)
+        state = FAILED
+        try:
+            os.makedirs(job.settings.dst_dir, exist_ok=True)
+            pipeline.run()
+            state = CANCELLED if job.cancel_event.is_set() else FINISHED
+        except PreflightError as e:
+            job.error = str(e)
+            logging.error(f"{job.id}: {e}")
+        except Exception as e:
+            job.error = str(e)
+            logging.exception(e)
+        finally:
+            job.output_paths = list(pipeline.output_paths)
+            metrics.counter("server_jobs_total", "Jobs run by the job server").inc(result=state)
+            with self._condition:
+                self._finish(job, state)
+                self._active_dirs.discard(realpath(job.settings.dst_dir))
+                # Wake the runners waiting on a job held back for this output folder
+                self._condition.notify_all()
+            logging.info(f"{job.id}: {state}")
+
+    def _finish(self, job, state):
+        """Marks a job as done and forgets the oldest done jobs. Must be called with the condition held."""
+        with job.lock:
+            job.state = state
+            job.finished_at = time.time()
+            if state == FINISHED:
+                job.progress.update({"progress": 100.0, "eta_seconds": 0.0})
+            elif state == CANCELLED:
+                job.progress["message"] = "Cancelled"
+        done = [j for j in self._jobs.values() if j.done]
+        for old in sorted(done, key=lambda j: j.finished_at)[:max(0, len(done) - FINISHED_JOBS_KEPT)]:
+            del self._jobs[old.id]
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Routes the REST API to the JobServer set on the HTTP server."""
+
+    server_version = "InterLivre"
+
+    @property
+    def jobs(self):
+        return self.server.job_server
+
+    def do_GET(self):
+        parts = self.path_parts()
+        if parts == ["jobs"]:
+            self.send_json(HTTPStatus.OK, {"jobs": [j.to_dict() for j in self.jobs.list_jobs()]})
+        elif len(parts) in (2, 3) and parts[0] == "jobs" and parts[2:] in ([], ["progress"]):
+            job = self.jobs.get(parts[1])
+            if job is None:
+                self.send_error_json(HTTPStatus.NOT_FOUND, f"No job {parts[1]}")
+            else:
+                self.send_json(HTTPStatus.OK, job.to_dict() if len(parts) == 2 else job.progress_dict())
+        elif parts == ["metrics"]:
+            self.send_text(HTTPStatus.OK, metrics.REGISTRY.prometheus_text(), "text/plain; version=0.0.4")
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"No such endpoint: {self.path}")
+
+    def do_POST(self):
+        parts = self.path_parts()
+        if parts == ["jobs"]:
+            try:
+                job = self.jobs.submit(self.read_json())
+            except JobSpecError as e:
+                self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+                return
+            except RuntimeError as e:
+                self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+                return
+            self.send_json(HTTPStatus.CREATED, job.to_dict(), headers={"Location": f"/jobs/{job.id}"})
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            job = self.jobs.cancel(parts[1])
+            if job is None:
+                self.send_error_json(HTTPStatus.NOT_FOUND, f"No job {parts[1]}")
+            else:
+                self.send_json(HTTPStatus.ACCEPTED, job.to_dict())
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"No such endpoint: {self.path}")
+
+    def path_parts(self):
+        return [p for p in self.path.split("?", 1)[0].split("/") if p]
+
+    def read_json(self):
+        """Returns the JSON body of the request.
+
+        Raises:
+            JobSpecError: If the body is too large or isn't JSON.
+        """
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise JobSpecError("Invalid Content-Length")
+        if length > MAX_REQUEST_BYTES:
+            raise JobSpecError("Request body is too large")
+        try:
+            return json.loads(self.rfile.read(length) or b"null")
+        except ValueError as e:
+            raise JobSpecError(f"Invalid JSON: {e}")
+
+    def send_json(self, status, d, headers=None):
+        self.send_text(status, json.dumps(d, indent=2) + "\n", "application/json", headers)
+
+    def send_error_json(self, status, msg):
+        self.send_json(status, {"error": msg})
+
+    def send_text(self, status, text, content_type, headers=None):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def create_http_server(job_server, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Returns an HTTP server for the REST API of a JobServer. Call serve_forever() on it to start serving."""
+    httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+    httpd.daemon_threads = True
+    httpd.job_server = job_server
+    return httpd
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a REST API that queues interleave jobs on this machine.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Address to listen on, e.g. 0.0.0.0 for every interface")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--settings', default=None,
+                        help="Path to a JSON file of JobSettings used as every job's defaults")
+    parser.add_argument('--books', type=int, default=DEFAULT_ACTIVE_JOBS, help="Number of jobs to run at the same time")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of chapter worker processes shared by every job")
+    parser.add_argument('--root', action='append', default=None, metavar='DIR',
+                        help="Only allow books and outputs inside this folder, may be given more than once")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    settings = JobSettings()
+    if args.settings is not None:
+        with open(args.settings) as f:
+            settings = JobSettings.from_dict(json.load(f))
+    if args.jobs is not None:
+        settings.max_jobs = args.jobs
+    job_server = JobServer(settings, max_active_jobs=args.books, allowed_roots=args.root)
+    httpd = create_http_server(job_server, args.host, args.port)
+    logging.info(f"Serving jobs on http://{args.host}:{httpd.server_address[1]} with "
+                 f"{job_server.chapter_scheduler.max_workers} chapter workers")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        job_server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+InterLivre, audiobook splicer
+
+Per-output manifest that lets an interrupted or repeated job skip chapters that are already done
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import json
+import logging
+import os
+import threading
+from hashlib import blake2b
+from os.path import isfile, join as pjoin
+from uuid import uuid4
+import utils
+
+MANIFEST_FILENAME = "interlivre-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def settings_digest(settings):
+    """Returns a digest of the JobSettings that change the contents of an interleaved chapter."""
+    tmp_format = settings.tmp_audio_format
+    d = {"version": MANIFEST_VERSION,
+         "seg_size_min": settings.seg_size_min,
+         "seg_size_max": settings.seg_size_max,
+         "shard_single_files": settings.shard_single_files,
+         "shard_seconds": settings.shard_seconds,
+         "tmp_format": [tmp_format.sample_rate, tmp_format.bit_depth, tmp_format.channels],
+         "dst_sample_rate": settings.dst_sample_rate,
+         "dst_file_format": settings.dst_file_format}
+    return blake2b(json.dumps(d, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class Manifest:
+    """Records how each output chapter in a directory was made, saved as JSON next to the outputs.
+
+    Each entry is keyed by the output file name and holds the fingerprints of the book 1 and book 2 input files,
+    a digest of the settings, and a checksum of the output. A chapter is up to date if all three still match.
+
+    Attributes:
+        path (str): Path to the JSON manifest.
+        entries (dict): Entry per output file name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # Outputs may be recorded from several threads at once, e.g. by the asyncio job's executor
+        self._lock = threading.Lock()
+        if isfile(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.entries = data.get("chapters", {})
+            except (OSError, ValueError) as e:
+                logging.exception(e)
+
+    @classmethod
+    def for_directory(cls, dst_dir):
+        """Returns the manifest for the outputs in dst_dir."""
+        return cls(pjoin(dst_dir, MANIFEST_FILENAME))
+
+    def is_current(self, out_path, inputs, digest):
+        """Returns True if the output file exists and was made from the same inputs and settings.
+
+        The output is checksummed in place, so a truncated or modified output is made again.
+
+        Args:
+            out_path (str): Path to the output chapter.
+            inputs (list(str)): Fingerprints of the book 1 and book 2 input files.
+            digest (str): Settings digest from settings_digest().
+        """
+        entry = self.entries.get(os.path.basename(out_path))
+        if entry is None or entry["inputs"] != list(inputs) or entry["settings"] != digest:
+            return False
+        try:
+            if os.path.getsize(out_path) != entry["size"]:
+                return False
+            return utils.checksum_file(out_path) == entry["checksum"]
+        except OSError:
+            return False
+
+    def record(self, out_path, inputs, digest):
+        """Checksums a finished output chapter and saves its entry. Safe to call from several threads."""
+        entry = {"inputs": list(inputs),
+                 "settings": digest,
+                 "size": os.path.getsize(out_path),
+                 "checksum": utils.checksum_file(out_path)}
+        with self._lock:
+            self.entries[os.path.basename(out_path)] = entry
+            self._save()
+
+    def save(self):
+        """Writes the manifest, replacing the old one atomically."""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.{uuid4().hex}.part"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"version": MANIFEST_VERSION, "chapters": self.entries}, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.exception(e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
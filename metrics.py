@@ -0,0 +1,349 @@
+"""
+InterLivre, audiobook splicer
+
+In-process registry of counters, histograms and maximums describing pipeline health, with a JSON dump and a Prometheus
+textfile writer for the node exporter's textfile collector
+
+Example:
+    metrics.counter("ffmpeg_processes_total", "FFmpeg and ffprobe processes started").inc(tool="ffmpeg")
+    metrics.REGISTRY.write_prometheus_textfile("/var/lib/node_exporter/interlivre.prom")
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+from os.path import isdir, join as pjoin
+from uuid import uuid4
+
+METRICS_DIRECTORY = "metrics"
+METRICS_EXTENSION = "metrics.json"
+# Prefix of every metric name in the Prometheus output
+PROMETHEUS_NAMESPACE = "interlivre"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets of the pipeline's own histograms
+SILENCE_SECONDS_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0)
+SEGMENT_SECONDS_BUCKETS = (1.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 120.0)
+SCAN_RATE_BUCKETS = (1e6, 3e6, 1e7, 3e7, 1e8, 3e8, 1e9, 3e9, 1e10)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + ([extra] if extra is not None else [])
+    if len(pairs) == 0:
+        return ""
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    """A value that only goes up, kept separately for each combination of labels.
+
+    Attributes:
+        name (str): Metric name.
+        help (str): Description of the metric.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def to_dict(self, clear=False):
+        """Returns the counter as a JSON-serializable dictionary, and resets it to zero if clear is True."""
+        with self._lock:
+            d = {"type": self.kind, "help": self.help,
+                 "values": [{"labels": dict(k), "value": v} for k, v in sorted(self._values.items())]}
+            if clear:
+                self._values = {}
+            return d
+
+    def merge(self, d):
+        """Adds the values of a dictionary from to_dict() to this counter."""
+        for item in d["values"]:
+            self.inc(item["value"], **item["labels"])
+
+    def prometheus_lines(self, name):
+        with self._lock:
+            return [f"{name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self._values.items())]
+
+
+class Maximum:
+    """The highest value observed, kept separately for each combination of labels, e.g. a peak across processes.
+
+    Attributes:
+        name (str): Metric name.
+        help (str): Description of the metric.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            if key not in self._values or value > self._values[key]:
+                self._values[key] = value
+
+    def get(self, **labels):
+        """Returns the highest value observed with the given labels, or None if there was none."""
+        return self._values.get(_label_key(labels))
+
+    def to_dict(self, clear=False):
+        """Returns the maximum as a JSON-serializable dictionary, and forgets the values if clear is True."""
+        with self._lock:
+            d = {"type": self.kind, "help": self.help,
+                 "values": [{"labels": dict(k), "value": v} for k, v in sorted(self._values.items())]}
+            if clear:
+                self._values = {}
+            return d
+
+    def merge(self, d):
+        """Keeps the higher of this maximum's values and those of a dictionary from to_dict()."""
+        for item in d["values"]:
+            self.observe(item["value"], **item["labels"])
+
+    def prometheus_lines(self, name):
+        with self._lock:
+            return [f"{name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, kept separately for each combination of labels.
+
+    Attributes:
+        name (str): Metric name.
+        help (str): Description of the metric.
+        buckets (tuple(float)): Upper bound of each bucket, in increasing order. +Inf is implied.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Label key -> [per bucket counts (last is +Inf), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _series(self, key):
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return series
+
+    def observe(self, value, **labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series(_label_key(labels))
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get(self, **labels):
+        """Returns (sum, count) of the observations with the given labels."""
+        series = self._values.get(_label_key(labels))
+        return (series[1], series[2]) if series is not None else (0.0, 0)
+
+    def to_dict(self, clear=False):
+        """Returns the histogram as a JSON-serializable dictionary, and empties it if clear is True."""
+        with self._lock:
+            d = {"type": self.kind, "help": self.help, "buckets": list(self.buckets),
+                 "values": [{"labels": dict(k), "counts": list(s[0]), "sum": s[1], "count": s[2]}
+                            for k, s in sorted(self._values.items())]}
+            if clear:
+                self._values = {}
+            return d
+
+    def merge(self, d):
+        """Adds the observations of a dictionary from to_dict() to this histogram. The buckets must match."""
+        if list(d["buckets"]) != list(self.buckets):
+            raise ValueError(f"Bucket mismatch merging histogram {self.name}")
+        with self._lock:
+            for item in d["values"]:
+                series = self._series(_label_key(item["labels"]))
+                series[0] = [a + b for a, b in zip(series[0], item["counts"])]
+                series[1] += item["sum"]
+                series[2] += item["count"]
+
+    def prometheus_lines(self, name):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', _format_value(float(bound))))} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(float(total))}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric of this process by name.
+
+    Metrics are created on first use, so code can ask for the same metric wherever it's updated. Worker processes
+    save their metrics with save_snapshot() and the coordinating process adds them to its own with
+    merge_directory().
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = cls(name, help, **kwargs)
+        if not isinstance(metric, cls):
+            raise TypeError(f"Metric {name} is a {metric.kind}")
+        return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def maximum(self, name, help=""):
+        return self._get(Maximum, name, help)
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def to_dict(self):
+        """Returns every metric as a JSON-serializable dictionary keyed by name."""
+        return {name: metric.to_dict() for name, metric in sorted(self._metrics.items())}
+
+    def merge(self, d):
+        """Adds the metrics of a dictionary from to_dict() to this registry."""
+        for name, m in d.items():
+            if m["type"] == Counter.kind:
+                self.counter(name, m.get("help", "")).merge(m)
+            elif m["type"] == Histogram.kind:
+                self.histogram(name, m.get("help", ""), m["buckets"]).merge(m)
+            elif m["type"] == Maximum.kind:
+                self.maximum(name, m.get("help", "")).merge(m)
+
+    def dump_json(self, path=None):
+        """Returns the metrics as JSON text, and writes them to path if given."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            _write_atomic(path, text)
+        return text
+
+    def prometheus_text(self, namespace=PROMETHEUS_NAMESPACE):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            full_name = f"{namespace}_{name}" if namespace else name
+            if metric.help:
+                lines.append(f"# HELP {full_name} {metric.help}")
+            lines.append(f"# TYPE {full_name} {metric.kind}")
+            lines += metric.prometheus_lines(full_name)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path, namespace=PROMETHEUS_NAMESPACE):
+        """Writes the metrics for the node exporter's textfile collector.
+
+        The file is replaced atomically, so the collector never reads a half written file.
+        """
+        _write_atomic(path, self.prometheus_text(namespace))
+
+    def save_snapshot(self, metrics_dir):
+        """Saves this process's metrics to a new file in metrics_dir and clears them, so they're only counted once."""
+        d = {name: metric.to_dict(clear=True) for name, metric in list(self._metrics.items())}
+        d = {name: m for name, m in d.items() if len(m["values"]) > 0}
+        if len(d) == 0:
+            return
+        try:
+            _write_atomic(pjoin(metrics_dir, f"{os.getpid()}-{uuid4().hex[:8]}.{METRICS_EXTENSION}"), json.dumps(d))
+        except OSError as e:
+            logging.exception(e)
+
+    def merge_directory(self, metrics_dir):
+        """Adds every snapshot saved in metrics_dir to this registry and removes the snapshots."""
+        if metrics_dir is None or not isdir(metrics_dir):
+            return
+        for f in sorted(os.listdir(metrics_dir)):
+            if not f.endswith(METRICS_EXTENSION):
+                continue
+            path = pjoin(metrics_dir, f)
+            try:
+                with open(path) as fp:
+                    d = json.load(fp)
+                os.remove(path)
+            except (OSError, ValueError) as e:
+                logging.exception(e)
+                continue
+            self.merge(d)
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Registry of this process
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help=""):
+    """Returns the Counter called name in the process registry, creating it on first use."""
+    return REGISTRY.counter(name, help)
+
+
+def histogram(name, help="", buckets=DEFAULT_BUCKETS):
+    """Returns the Histogram called name in the process registry, creating it on first use."""
+    return REGISTRY.histogram(name, help, buckets)
+
+
+def maximum(name, help=""):
+    """Returns the Maximum called name in the process registry, creating it on first use."""
+    return REGISTRY.maximum(name, help)
+
+
+def record_bytes(stage, read=0, written=0):
+    """Adds to the bytes read and written by a pipeline stage."""
+    if read:
+        counter("stage_bytes_read_total", "Bytes read by each pipeline stage").inc(read, stage=stage)
+    if written:
+        counter("stage_bytes_written_total", "Bytes written by each pipeline stage").inc(written, stage=stage)
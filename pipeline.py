@@ -0,0 +1,757 @@
+"""
+InterLivre, audiobook splicer
+
+Headless audiobook interleaving pipeline and the chapter tasks it runs in worker processes
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import logging
+import os
+import shutil
+import time
+import tracemalloc
+from concurrent.futures import wait, FIRST_COMPLETED
+from os import remove
+from os.path import basename, isdir, isfile, join as pjoin
+from uuid import uuid4
+from audiotools import AudioConvertor, AudioFormat, CancelledError, remove_partial
+from convcache import ConversionCache, CACHE_DIRECTORY
+from edl import EditDecisionList, EDL_DIRECTORY, EDL_EXTENSION
+from filemanager import FileManager
+from manifest import Manifest, settings_digest
+from preflight import Preflight, PreflightError, ThroughputHistory, THROUGHPUT_FILENAME
+from probecache import ProbeCache, PROBE_CACHE_FILENAME
+from progress import ChapterProgressQueue, ProgressTracker
+from metrics import METRICS_DIRECTORY
+from scheduler import ChapterScheduler, estimate_chapter_bytes
+from tracing import TRACE_DIRECTORY
+import metrics
+import scheduler
+import tracing
+import utils
+
+# Name of the file that stops a run's chapters, followed by an id of the run
+CANCEL_FILE_PREFIX = "cancel-"
+# Longest time a cancelled run on a shared scheduler waits for its running chapters to stop
+CANCEL_WAIT_SECONDS = 5.0
+# Environment variable that makes the chapter workers trace their allocations with tracemalloc
+TRACEMALLOC_ENV = "INTERLIVRE_TRACEMALLOC"
+
+
+class JobSettings:
+    """Settings for interleaving one pair of books.
+
+    JobSettings only holds plain data so it can be pickled, sent to another process, or saved as JSON.
+
+    Attributes:
+        src1_dir (str): Path to a directory containing the book 1 audio files.
+        src2_dir (str): Path to a directory containing the book 2 audio files.
+        dst_dir (str): Path to a directory to write the interleaved audio files.
+        dst_name (str): Output file name prefix.
+        src_files_selected (list(list(str))): Book 1 and book 2 files to include, or None to include every file found.
+        seg_size_min (int): Minimum number of seconds to wait before switching between recordings.
+        seg_size_max (int): Maximum number of seconds to wait before switching between recordings.
+        write_segments (bool): Write each speech segment to disk as a wav file.
+        shard_single_files (bool): Split single-file books into virtual chapters.
+        shard_seconds (int): Target length of each virtual chapter in seconds.
+        dst_sample_rate (int): Output sample rate.
+        dst_file_format (str): Output file format.
+        max_jobs (int): Number of chapter worker processes, None for one per core.
+        memory_budget (int): RAM budget in bytes for the chapter workers, None for a default based on the host.
+        cache_max_bytes (int): Size cap for the cache of converted input files, None for the default.
+        trace_path (str): If set, run() saves a Chrome trace-event JSON file of its stages here.
+    """
+
+    def __init__(self, src1_dir="", src2_dir="", dst_dir="", dst_name="", src_files_selected=None,
+                 seg_size_min=5, seg_size_max=18, write_segments=False, shard_single_files=False,
+                 shard_seconds=1800, dst_sample_rate=48000, dst_file_format='wav', max_jobs=None, memory_budget=None,
+                 cache_max_bytes=None, trace_path=None):
+        self.src1_dir = src1_dir
+        self.src2_dir = src2_dir
+        self.dst_dir = dst_dir
+        self.dst_name = dst_name
+        self.src_files_selected = src_files_selected
+        self.seg_size_min = seg_size_min
+        self.seg_size_max = seg_size_max
+        self.write_segments = write_segments
+        self.shard_single_files = shard_single_files
+        self.shard_seconds = shard_seconds
+        self.dst_sample_rate = dst_sample_rate
+        self.dst_file_format = dst_file_format
+        self.max_jobs = max_jobs
+        self.memory_budget = memory_budget
+        self.cache_max_bytes = cache_max_bytes
+        self.trace_path = trace_path
+
+    @classmethod
+    def from_model(cls, model):
+        """Returns a JobSettings snapshot of an ILModel."""
+        fm = model.filemanager
+        return cls(src1_dir=fm.src1_dir, src2_dir=fm.src2_dir, dst_dir=fm.dst_dir, dst_name=model.dst_name,
+                   src_files_selected=fm.src_files_selected, seg_size_min=model.seg_size_min,
+                   seg_size_max=model.seg_size_max, write_segments=model.write_segments,
+                   shard_single_files=model.shard_single_files, shard_seconds=model.shard_seconds,
+                   dst_sample_rate=model.dst_audio_format.sample_rate,
+                   dst_file_format=model.dst_audio_format.file_format, max_jobs=model.max_jobs,
+                   memory_budget=model.memory_budget)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Returns JobSettings from a dictionary, such as one loaded from JSON. Unknown keys raise a TypeError."""
+        return cls(**d)
+
+    def to_dict(self):
+        """Returns the settings as a JSON-serializable dictionary."""
+        return dict(vars(self))
+
+    @property
+    def tmp_audio_format(self):
+        """AudioFormat: Format the input files are converted to before interleaving."""
+        return AudioFormat(48000, 16, 1, 'wav')
+
+    @property
+    def dst_audio_format(self):
+        """AudioFormat: Format of the interleaved output files."""
+        return AudioFormat(self.dst_sample_rate, 16, 1, self.dst_file_format)
+
+    def is_valid(self):
+        """Returns True if every required path and the output name are set."""
+        return not any(utils.is_blank(f) for f in [self.src1_dir, self.src2_dir, self.dst_dir, self.dst_name])
+
+
+class ChapterTask:
+    """A pair of chapter files to interleave into a single output file.
+
+    ChapterTask only holds plain data so it can be pickled and sent to a worker process.
+
+    Attributes:
+        src_path_1 (str): Path to book 1 chapter.
+        src_path_2 (str): Path to book 2 chapter.
+        dst_path (str): Output path for the combined chapter.
+        dst_name (str): Name used for the chapter's segment files.
+        interleaver_args (dict): Keyword arguments used to construct the Interleaver.
+        estimated_bytes (int): Estimated peak memory used to interleave the chapter.
+        edl_path (str): Path to save the chapter's EditDecisionList, None to not save one.
+        source_paths (list(str)): Book 1 and book 2 source files recorded in the EditDecisionList.
+        trace_dir (str): Directory the worker flushes its trace events to, None if the job isn't traced.
+        metrics_dir (str): Directory the worker saves its metrics to, None to keep them in the worker.
+        cancel_path (str): The worker stops the task once this file exists, None to only stop with the scheduler.
+    """
+
+    def __init__(self, src_path_1, src_path_2, dst_path, dst_name, interleaver_args=None, estimated_bytes=0,
+                 edl_path=None, source_paths=None, trace_dir=None, metrics_dir=None, cancel_path=None):
+        self.src_path_1 = src_path_1
+        self.src_path_2 = src_path_2
+        self.dst_path = dst_path
+        self.dst_name = dst_name
+        self.interleaver_args = interleaver_args if interleaver_args is not None else {}
+        self.estimated_bytes = estimated_bytes
+        self.edl_path = edl_path
+        self.source_paths = source_paths
+        self.trace_dir = trace_dir
+        self.metrics_dir = metrics_dir
+        self.cancel_path = cancel_path
+
+    @classmethod
+    def from_dict(cls, d):
+        """Returns a ChapterTask from a dictionary, such as one loaded from JSON."""
+        return cls(**d)
+
+    def to_dict(self):
+        """Returns the task as a JSON-serializable dictionary."""
+        return dict(vars(self))
+
+
+def run_chapter_task(task):
+    """Interleaves a single chapter. Runs in a worker process started by ChapterScheduler.
+
+    Args:
+        task (ChapterTask): Chapter to interleave.
+
+    Returns:
+        str: Path to the interleaved chapter.
+    """
+    # numpy and scipy are imported on first use, which keeps them out of the GUI and command line start up
+    from interleaver import Interleaver
+    # Workers are reused between jobs, only trace for the jobs that asked for it
+    tracer = tracing.get_tracer()
+    if tracer is not None and tracer.trace_dir != task.trace_dir:
+        tracing.disable()
+    if task.trace_dir is not None:
+        tracing.enable(task.trace_dir)
+    if os.environ.get(TRACEMALLOC_ENV) and not tracemalloc.is_tracing():
+        # Set by the scaling benchmark, which reports the peak memory of the chapters
+        tracemalloc.start()
+    cancel = scheduler.worker_cancel_event()
+    if task.cancel_path is not None:
+        cancel = scheduler.TaskCancelEvent(task.cancel_path, cancel)
+    try:
+        status_queue = ChapterProgressQueue(scheduler.worker_progress_queue(), task.dst_path)
+        interleaver = Interleaver(dst_name=task.dst_name, status_queue=status_queue, cancel=cancel,
+                                  **task.interleaver_args)
+        interleaver.interleave(task.src_path_1, task.src_path_2, task.dst_path, edl_path=task.edl_path,
+                               edl_sources=task.source_paths)
+    finally:
+        tracing.flush()
+        if tracemalloc.is_tracing():
+            metrics.maximum("chapter_tracemalloc_peak_bytes",
+                            "Peak memory traced by tracemalloc while interleaving a chapter").observe(
+                tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        if task.metrics_dir is not None:
+            metrics.REGISTRY.save_snapshot(task.metrics_dir)
+    return task.dst_path
+
+
+class Pipeline:
+    """Interleaves a pair of audiobooks chapter by chapter without any GUI.
+
+    Attributes:
+        settings (JobSettings): Job to run.
+        status_queue: Receives (progress, message) tuples through put(). May be None.
+        cancel_event: Cancels the job when set. May be None.
+        filemanager (FileManager): Workspace and file naming for the job.
+        manifest (Manifest): Record of the finished output chapters, used to skip them on later runs.
+        chapter_numbers (list(int)): 1-based numbers of the chapters this run processes, None until plan_resume().
+        chapter_scheduler (ChapterScheduler): Scheduler shared with other jobs, or None for run() to start its own.
+        output_paths (list(str)): Output chapters finished so far by this run.
+        stage_seconds (dict): Wall clock seconds run() spent in each stage.
+        trace_dir (str): Directory the trace events of a traced run are collected in, None if not tracing.
+        metrics_dir (str): Directory the chapter workers save their metrics to, None until open_caches().
+        progress (ProgressTracker): Progress of the whole run, None until the preflight checks are done.
+        priority (int): Priority of this job's chapters on the scheduler, lower values are admitted first.
+        cancel_path (str): File created to stop this run's chapters running on a shared scheduler, None until
+            open_caches().
+        probe_cache (ProbeCache): ffprobe results, shared with other jobs if passed in, else opened by open_caches().
+        conversion_cache (ConversionCache): Converted input files, shared with other jobs if passed in, else opened
+            by open_caches().
+    """
+
+    def __init__(self, settings, status_queue=None, cancel=None, chapter_scheduler=None, priority=0,
+                 probe_cache=None, conversion_cache=None):
+        self.settings = settings
+        self.status_queue = status_queue
+        self.cancel_event = cancel
+        self.chapter_scheduler = chapter_scheduler
+        self.priority = priority
+        self.output_paths = []
+        self.stage_seconds = {}
+        self.progress = None
+        self.filemanager = FileManager(settings.src1_dir, settings.src2_dir, settings.dst_dir,
+                                       input_file_formats=['wav', 'mp3'])
+        self.section_count = 0
+        self.sharder = None
+        self.shards = None
+        self.probe_cache = probe_cache
+        self.throughput = None
+        self.conversion_cache = conversion_cache
+        self.analysis_dir = None
+        self.edl_dir = None
+        self.trace_dir = None
+        self.metrics_dir = None
+        self.cancel_path = None
+        self.cached_inputs = set()
+        self._uncached_inputs = {}
+        self.manifest = None
+        self.settings_digest = None
+        self.chapter_inputs = {}
+        self.chapter_numbers = None
+        self.chapter_total = 0
+        self._pending_files = None
+
+    def update_status(self, progress, msg):
+        """Sends a progress percentage and status message to the status queue.
+
+        Once the run's progress is tracked, the message goes through the tracker and the percentage comes from it,
+        unless the job has finished or failed.
+        """
+        if self.progress is not None and 0 <= progress < 100:
+            self.progress.update(msg, force=True)
+        elif self.status_queue is not None:
+            self.status_queue.put((progress, msg))
+
+    def open_caches(self):
+        """Opens the caches and throughput history kept in the tmp directory between runs.
+
+        Caches passed to the constructor, e.g. shared by every book of a batch, are used instead of the job's own.
+        """
+        if self.analysis_dir is None:
+            tmp_root = self.filemanager.create_tmp_root()
+            from silencemap import ANALYSIS_DIRECTORY
+            if self.probe_cache is None:
+                self.probe_cache = ProbeCache(pjoin(tmp_root, PROBE_CACHE_FILENAME))
+            self.throughput = ThroughputHistory(pjoin(tmp_root, THROUGHPUT_FILENAME))
+            if self.conversion_cache is None:
+                self.conversion_cache = ConversionCache(pjoin(tmp_root, CACHE_DIRECTORY),
+                                                        self.settings.cache_max_bytes)
+            self.analysis_dir = pjoin(tmp_root, ANALYSIS_DIRECTORY)
+            self.edl_dir = pjoin(tmp_root, EDL_DIRECTORY)
+            os.makedirs(self.edl_dir, exist_ok=True)
+            self.metrics_dir = pjoin(tmp_root, METRICS_DIRECTORY)
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            self.cancel_path = pjoin(tmp_root, f"{CANCEL_FILE_PREFIX}{uuid4().hex[:12]}")
+
+    def get_selected_files(self):
+        """Returns the book 1 and book 2 files to include in the job, only the pending ones after plan_resume()."""
+        if self._pending_files is not None:
+            return [list(self._pending_files[0]), list(self._pending_files[1])]
+        src_files = self.settings.src_files_selected
+        if src_files is None:
+            src_files = self.filemanager.get_input_files(self.settings.src1_dir, self.settings.src2_dir)
+        return [list(src_files[0]), list(src_files[1])]
+
+    def preflight(self):
+        """Probes the selected files and checks the job before any heavy work starts.
+
+        Returns:
+            PreflightReport: Results of the checks.
+
+        Raises:
+            PreflightError: If the job can't run.
+        """
+        self.open_caches()
+        self.update_status(1, "Checking input files")
+        convertor = AudioConvertor(self.settings.tmp_audio_format, self.probe_cache, self.cancel_event)
+        report = Preflight(self.settings, convertor, self.throughput).run(self.get_selected_files())
+        for w in report.warnings:
+            logging.warning(w)
+        if not report.ok:
+            raise PreflightError(report.summary())
+        self.update_status(1, f"Estimated run time: {report.total_estimated_seconds / 60.0:.0f} minutes")
+        return report
+
+    def create_progress_tracker(self, report, audio_seconds):
+        """Returns a ProgressTracker for the chapters this run processes, with the stages weighted by their estimated
+        run time.
+
+        Args:
+            report (PreflightReport): Preflight results, estimated for every selected chapter.
+            audio_seconds (float): Seconds of audio in the chapters this run processes.
+        """
+        book_seconds = sum(sum(d) for d in report.durations)
+        scale = audio_seconds / book_seconds if book_seconds > 0 else 1.0
+        stage_seconds = {stage: seconds * scale for stage, seconds in report.estimated_seconds.items()}
+        return ProgressTracker(self.status_queue, audio_seconds, stage_seconds)
+
+    def plan_resume(self):
+        """Checks the selected chapters against the output manifest and keeps only the ones that need work.
+
+        A chapter needs work if its output is missing or doesn't match its checksum, or if its input files or the
+        settings changed since it was made.
+
+        Returns:
+            int: Number of chapters that are already up to date.
+        """
+        s = self.settings
+        fm = self.filemanager
+        src_files = self.get_selected_files()
+        self.manifest = Manifest.for_directory(s.dst_dir)
+        self.settings_digest = settings_digest(s)
+        self.chapter_total = min(len(src_files[0]), len(src_files[1]))
+        self.chapter_inputs = {}
+        self.chapter_numbers = []
+        pending = [[], []]
+        for i in range(0, self.chapter_total):
+            tmp_name = fm.get_tmp_output_filename(s.dst_name, i + 1, self.chapter_total)
+            out_path = fm.get_output_path(tmp_name, s.dst_file_format)
+            inputs = [utils.fingerprint_file(pjoin(s.src1_dir, src_files[0][i])),
+                      utils.fingerprint_file(pjoin(s.src2_dir, src_files[1][i]))]
+            if self.manifest.is_current(out_path, inputs, self.settings_digest):
+                continue
+            self.chapter_inputs[basename(out_path)] = inputs
+            self.chapter_numbers.append(i + 1)
+            pending[0].append(src_files[0][i])
+            pending[1].append(src_files[1][i])
+        self._pending_files = pending
+        return self.chapter_total - len(self.chapter_numbers)
+
+    def create_workspace(self):
+        """Creates the tmp workspace and copies the selected input files into it.
+
+        Input files that were converted on an earlier run are taken from the conversion cache instead. Their tmp
+        paths are kept in cached_inputs so the conversion step can skip them.
+        """
+        self.open_caches()
+        src_files = self.get_selected_files()
+        self.filemanager.create_tmp_workspace()
+        self.cached_inputs, self._uncached_inputs = self.filemanager.copy_to_workspace(
+            src_files, self.conversion_cache, self.settings.tmp_audio_format)
+
+    def cache_converted_inputs(self):
+        """Adds the input files converted during this run to the conversion cache."""
+        for tmp_wav, key in self._uncached_inputs.items():
+            self.conversion_cache.put(key, tmp_wav)
+        self._uncached_inputs = {}
+
+    def plan_chapters(self):
+        """Splits single-file books into virtual chapters if needed and builds the chapter tasks to interleave.
+
+        Must be called after the input files have been converted in the tmp workspace.
+
+        Returns:
+            list(ChapterTask): Chapters to interleave, in order. Memory estimates are not filled in yet.
+        """
+        fm = self.filemanager
+        tmp_audio_format = self.settings.tmp_audio_format
+        dst_name = self.settings.dst_name
+        filelist = fm.get_input_files(fm.src1_tmp, fm.src2_tmp)
+        book1_files = filelist[0]
+        book2_files = filelist[1]
+        self.section_count = min(len(book1_files), len(book2_files))
+        src_files = self.get_selected_files()
+        source_paths = [[pjoin(self.settings.src1_dir, f1), pjoin(self.settings.src2_dir, f2)]
+                        for f1, f2 in zip(src_files[0], src_files[1])]
+
+        # Number the chapters within the whole book, which may have more chapters than this run processes
+        chapter_numbers = self.chapter_numbers
+        if chapter_numbers is None:
+            chapter_numbers = list(range(1, self.section_count + 1))
+        chapter_total = max(self.chapter_total, self.section_count)
+
+        # Split single-file books into virtual chapters
+        self.shards = None
+        if chapter_total == 1 and self.settings.shard_single_files:
+            self.update_status(99, "Splitting books into virtual chapters")
+            book1_shards, book2_shards, dst_shards = fm.create_shard_workspace()
+            from interleaver import Interleaver
+            from sharding import ChapterSharder
+            # Cut at the same silences the interleaver splits segments at
+            noise_threshold = Interleaver(sample_rate=tmp_audio_format.sample_rate).noise_threshold
+            self.sharder = ChapterSharder(noise_threshold, shard_seconds=self.settings.shard_seconds)
+            self.shards = self.sharder.shard_pair(pjoin(fm.src1_tmp, book1_files[0]),
+                                                  pjoin(fm.src2_tmp, book2_files[0]), book1_shards, book2_shards)
+            if len(self.shards[0]) < 2:
+                self.shards = None
+
+        # Build the list of chapter pairs to interleave
+        chapters = []
+        if self.shards is not None:
+            chapter_name = utils.strip_extension(fm.get_output_filename(dst_name, 1, chapter_total))
+            for i in range(0, len(self.shards[0])):
+                out_shard_path = pjoin(dst_shards, f"tmp_shard_{i + 1:04d}.wav")
+                chapters.append((self.shards[0][i], self.shards[1][i], out_shard_path,
+                                 f"{chapter_name}_shard{i + 1:04d}",
+                                 f"{utils.strip_extension(out_shard_path)}.{EDL_EXTENSION}", None))
+        else:
+            for i in range(0, self.section_count):
+                book1_section_path = pjoin(fm.src1_tmp, book1_files[i])
+                book2_section_path = pjoin(fm.src2_tmp, book2_files[i])
+                number = chapter_numbers[i]
+                out_section_path = pjoin(fm.dst_tmp, fm.get_tmp_output_filename(dst_name, number, chapter_total))
+                chapter_name = utils.strip_extension(fm.get_output_filename(dst_name, number, chapter_total))
+                chapters.append((book1_section_path, book2_section_path, out_section_path, chapter_name,
+                                 self.get_edl_path(chapter_name), source_paths[i] if i < len(source_paths) else None))
+
+        # Create segments directories
+        segdir = ""
+        if self.settings.write_segments:
+            segdir = fm.create_segments_directory([c[3] for c in chapters])
+
+        interleaver_args = {"sample_rate": tmp_audio_format.sample_rate,
+                            "is_stereo": tmp_audio_format.channels == 2,
+                            "min_seg_seconds": self.settings.seg_size_min,
+                            "max_seg_seconds": self.settings.seg_size_max,
+                            "should_write_segments": self.settings.write_segments,
+                            "segments_path": segdir,
+                            "analysis_dir": self.analysis_dir}
+        return [ChapterTask(c[0], c[1], c[2], c[3], interleaver_args, edl_path=c[4], source_paths=c[5],
+                            trace_dir=self.trace_dir, metrics_dir=self.metrics_dir, cancel_path=self.cancel_path)
+                for c in chapters]
+
+    def get_edl_path(self, chapter_name):
+        """Returns the path of a chapter's EditDecisionList, or None if the caches aren't open."""
+        if self.edl_dir is None:
+            return None
+        return pjoin(self.edl_dir, f"{chapter_name}.{EDL_EXTENSION}")
+
+    def estimate_memory(self, task, durations):
+        """Fills in the estimated peak memory of a chapter task from its source durations in seconds."""
+        tmp_audio_format = self.settings.tmp_audio_format
+        task.estimated_bytes = estimate_chapter_bytes(durations, tmp_audio_format.sample_rate,
+                                                      tmp_audio_format.channels)
+        return task.estimated_bytes
+
+    def join_shards(self, tasks):
+        """Joins interleaved virtual chapters back into a single output file. Does nothing if the book wasn't split."""
+        if self.shards is None:
+            return
+        fm = self.filemanager
+        self.update_status(99, "Joining virtual chapters")
+        out_section_path = pjoin(fm.dst_tmp, fm.get_tmp_output_filename(self.settings.dst_name, 1, self.section_count))
+        self.sharder.stitch([t.dst_path for t in tasks], out_section_path)
+
+        # Join the virtual chapters' edit decision lists into one over the whole books
+        chapter_name = utils.strip_extension(fm.get_output_filename(self.settings.dst_name, 1, self.section_count))
+        edl_path = self.get_edl_path(chapter_name)
+        if edl_path is not None:
+            src_files = self.get_selected_files()
+            sources = [pjoin(self.settings.src1_dir, src_files[0][0]), pjoin(self.settings.src2_dir, src_files[1][0])]
+            edl = EditDecisionList.concat([EditDecisionList.load(t.edl_path) for t in tasks], sources,
+                                          [utils.fingerprint_file(p) for p in sources])
+            edl.save(edl_path)
+
+    def finish_chapter(self, tmp_path, convertor):
+        """Converts an interleaved tmp chapter into the output format and records it in the manifest.
+
+        Args:
+            tmp_path (str): Path to the interleaved tmp chapter, which is removed afterwards.
+            convertor (AudioConvertor): Convertor set to the output format.
+
+        Returns:
+            str: Path to the output chapter, or None if the job was cancelled.
+
+        Raises:
+            RuntimeError: If FFmpeg couldn't convert the chapter. The tmp chapter is kept and nothing is recorded.
+        """
+        out_path = self.filemanager.get_output_path(tmp_path, convertor.output_format.file_format)
+        with tracing.span("finish_chapter", chapter=basename(out_path)):
+            ok = convertor.convert(tmp_path, out_path)
+            if utils.is_cancelled(self.cancel_event):
+                # The convertor removed the partial output, leave the chapter for the next run
+                return None
+            if not ok:
+                # Don't leave a partial or stale output where the next run would take it for this chapter
+                remove_partial(out_path)
+                raise RuntimeError(f"Couldn't convert {basename(tmp_path)} into {out_path}")
+            self.filemanager.record_conversion_bytes("convert_outputs", tmp_path, out_path, isfile(out_path))
+            remove(tmp_path)
+            self.record_output(out_path)
+        if self.progress is not None:
+            node = self.progress.stage("convert_outputs").child(tmp_path)
+            if node is not None:
+                node.finish()
+        return out_path
+
+    def record_output(self, out_path):
+        """Records a finished output chapter in the manifest so later runs can skip it."""
+        self.output_paths.append(out_path)
+        inputs = self.chapter_inputs.get(basename(out_path))
+        if self.manifest is not None and inputs is not None:
+            self.manifest.record(out_path, inputs, self.settings_digest)
+
+    def run(self):
+        """Interleaves audiobooks chapter by chapter.
+
+        Each chapter is converted into the output format and recorded in the manifest as soon as it's interleaved,
+        so an interrupted job picks up where it left off when it's run again. Cancelling kills the running FFmpeg
+        processes and chapter workers, or only this run's chapters on a shared scheduler, and removes the partial
+        files. If settings.trace_path is set, a trace of the stages in this process and in the chapter workers is
+        saved there, even if the job fails.
+        """
+        if self.settings.is_valid() is False:
+            return
+        tracer = self.start_trace() if self.settings.trace_path else None
+        try:
+            if tracer is None:
+                self.run_stages()
+            else:
+                with tracing.use(tracer), tracing.span("run", book=self.settings.dst_name):
+                    self.run_stages()
+        except CancelledError:
+            # FFmpeg was killed part way through a file, the cleanup below removes what it left behind
+            pass
+        finally:
+            if utils.is_cancelled(self.cancel_event):
+                self.remove_partial_files()
+            self.remove_cancel_file()
+            if tracer is not None:
+                self.finish_trace(tracer)
+
+    def remove_partial_files(self):
+        """Removes the tmp files and half written cache entries of a cancelled run.
+
+        Finished chapters stay in the output folder and the manifest, and the caches only keep complete entries, so
+        the next run picks up where this one stopped. Chapters that were still running on a shared scheduler have
+        stopped by now, see cancel_chapters().
+        """
+        self.filemanager.remove_tmp_files()
+        for cache_dir in (self.analysis_dir, self.edl_dir):
+            if cache_dir is None or not isdir(cache_dir):
+                continue
+            for f in utils.list_files(cache_dir):
+                if f.endswith(".part"):
+                    try:
+                        remove(pjoin(cache_dir, f))
+                    except OSError as e:
+                        logging.exception(e)
+
+    def cancel_chapters(self, futures, timeout=CANCEL_WAIT_SECONDS):
+        """Stops this run's chapters on a scheduler shared with other jobs, leaving the other jobs' chapters alone.
+
+        Queued chapters are dropped, and running ones are stopped by creating the cancel file their workers check
+        between split points. Waits for them to stop, so no tmp files show up after the partial files are removed.
+
+        Args:
+            futures (iterable(Future)): Futures of the chapters that haven't finished yet.
+            timeout (float): Longest time to wait for the running chapters to stop, None to not wait.
+        """
+        self.signal_cancel_file()
+        running = [f for f in futures if not f.cancel()]
+        if timeout is not None and len(running) > 0:
+            wait(running, timeout=timeout)
+
+    def signal_cancel_file(self):
+        """Creates the cancel file that stops this run's running chapters."""
+        if self.cancel_path is None:
+            return
+        try:
+            open(self.cancel_path, 'w').close()
+        except OSError as e:
+            logging.exception(e)
+
+    def remove_cancel_file(self):
+        if self.cancel_path is not None and isfile(self.cancel_path):
+            try:
+                remove(self.cancel_path)
+            except OSError as e:
+                logging.exception(e)
+
+    def start_trace(self):
+        """Creates the directory a traced run's processes flush their events to, and the run's own Tracer.
+
+        Each run traces into its own Tracer, so runs sharing this process don't mix up or end each other's traces.
+
+        Returns:
+            Tracer: Tracer to make active while the run's stages run.
+        """
+        tmp_root = self.filemanager.create_tmp_root()
+        self.trace_dir = pjoin(tmp_root, TRACE_DIRECTORY, f"{os.getpid()}-{id(self):x}")
+        shutil.rmtree(self.trace_dir, ignore_errors=True)
+        return tracing.Tracer(self.trace_dir)
+
+    def finish_trace(self, tracer):
+        """Saves the events of a traced run to settings.trace_path as Chrome trace-event JSON."""
+        tracer.flush()
+        try:
+            tracing.export_chrome_trace(self.trace_dir, self.settings.trace_path)
+        except OSError as e:
+            logging.exception(e)
+        shutil.rmtree(self.trace_dir, ignore_errors=True)
+        self.trace_dir = None
+
+    def run_stages(self):
+        """Runs every stage of the job. See run()."""
+        fm = self.filemanager
+
+        stage_start = time.perf_counter()
+        with tracing.span("preflight"):
+            report = self.preflight()
+            skipped = self.plan_resume()
+        self.stage_seconds["preflight"] = time.perf_counter() - stage_start
+        if len(self.chapter_numbers) == 0:
+            self.update_status(100, "Finished! Every chapter was already up to date")
+            return
+        if skipped > 0:
+            self.update_status(1, f"Skipping {skipped} chapter(s) that are already up to date")
+        audio_seconds = sum(sum(report.durations[n - 1]) for n in self.chapter_numbers)
+        self.progress = self.create_progress_tracker(report, audio_seconds)
+
+        # region convert input files
+        stage_start = time.perf_counter()
+        with tracing.span("convert_inputs"):
+            self.update_status(1, "Creating temporary workspace")
+            self.create_workspace()
+            convertor = AudioConvertor(self.settings.tmp_audio_format, self.probe_cache, self.cancel_event)
+            self.update_status(2, "Converting input files")
+            fm.convert_tmp_files(convertor, status_queue=self.progress.stage_queue("convert_inputs"),
+                                 cancel=self.cancel_event, skip=self.cached_inputs)
+            if utils.is_cancelled(self.cancel_event):
+                return
+            self.cache_converted_inputs()
+            self.progress.stage("convert_inputs").finish()
+        self.stage_seconds["convert_inputs"] = time.perf_counter() - stage_start
+        self.throughput.record("convert_inputs", audio_seconds, self.stage_seconds["convert_inputs"])
+        self.update_status(99, "Done converting input files")
+        # endregion
+
+        stage_start = time.perf_counter()
+        convert_seconds = 0.0
+        with tracing.span("plan_chapters"):
+            tasks = self.plan_chapters()
+        output_convertor = AudioConvertor(self.settings.dst_audio_format, self.probe_cache, self.cancel_event)
+
+        # Interleave the chapters in worker processes, keeping the estimated memory use under the budget
+        chapter_scheduler = self.chapter_scheduler
+        owns_scheduler = chapter_scheduler is None
+        if owns_scheduler:
+            chapter_scheduler = ChapterScheduler(memory_budget=self.settings.memory_budget,
+                                                 max_workers=self.settings.max_jobs)
+        futures = []
+        # Chapters still being interleaved -> their progress node, weighted by the chapter's audio duration
+        chapter_progress = {}
+        for task in tasks:
+            durations = [convertor.get_duration(task.src_path_1), convertor.get_duration(task.src_path_2)]
+            chapter_progress[task.dst_path] = self.progress.stage("interleave").add(task.dst_path, sum(durations))
+            if self.shards is None:
+                self.progress.stage("convert_outputs").add(task.dst_path, sum(durations))
+            estimate = self.estimate_memory(task, durations)
+            futures.append(chapter_scheduler.submit(run_chapter_task, task, estimate, self.priority))
+
+        chapter_count = len(tasks)
+        pending = set(futures)
+        try:
+            with tracing.span("interleave", chapters=chapter_count):
+                while len(pending) > 0:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    # Count the metrics saved by the chapters that just finished in this process's registry
+                    metrics.REGISTRY.merge_directory(self.metrics_dir)
+                    for key, percent in chapter_scheduler.poll_progress().items():
+                        if key in chapter_progress:
+                            chapter_progress[key].set(percent / 100.0)
+                    for f in done:
+                        tmp_path = f.result()
+                        chapter_progress.pop(tmp_path).finish()
+                        chapter_scheduler.forget_progress([tmp_path])
+                        if self.shards is None:
+                            # Finish whole chapters right away, virtual chapters are finished once they're joined
+                            convert_start = time.perf_counter()
+                            self.finish_chapter(tmp_path, output_convertor)
+                            convert_seconds += time.perf_counter() - convert_start
+                    if utils.is_cancelled(self.cancel_event):
+                        if owns_scheduler:
+                            # Nothing else runs on this scheduler, kill the workers instead of waiting for them
+                            chapter_scheduler.terminate()
+                        else:
+                            # Leave the other jobs on the shared scheduler alone, only stop this run's chapters
+                            self.cancel_chapters(pending)
+                        return
+                    finished = chapter_count - len(pending)
+                    self.progress.update(f"Processing chapters, {finished}/{chapter_count} done")
+        except Exception:
+            # The job has failed, don't leave its other chapters running
+            if owns_scheduler:
+                chapter_scheduler.terminate()
+            else:
+                self.cancel_chapters(pending)
+            raise
+        finally:
+            chapter_scheduler.forget_progress(list(chapter_progress))
+            if owns_scheduler:
+                chapter_scheduler.shutdown()
+            metrics.REGISTRY.merge_directory(self.metrics_dir)
+
+        # Join the interleaved virtual chapters back into a single output file
+        if utils.is_cancelled(self.cancel_event):
+            return
+        with tracing.span("join_shards"):
+            self.join_shards(tasks)
+        self.progress.stage("interleave").finish()
+        # Stored per worker, the estimate scales it back up by the number of workers
+        workers = max(1, min(chapter_scheduler.max_workers, len(tasks)))
+        self.stage_seconds["interleave"] = time.perf_counter() - stage_start - convert_seconds
+        self.throughput.record("interleave", audio_seconds / workers, self.stage_seconds["interleave"])
+
+        convert_start = time.perf_counter()
+        with tracing.span("convert_outputs"):
+            for f_in, f_out in fm.get_output_conversions(self.settings.dst_file_format):
+                self.update_status(99, "Converting interleaved audio to selected output format")
+                if self.finish_chapter(f_in, output_convertor) is None:
+                    return
+        self.progress.stage("convert_outputs").finish()
+        convert_seconds += time.perf_counter() - convert_start
+        self.stage_seconds["convert_outputs"] = convert_seconds
+        self.throughput.record("convert_outputs", audio_seconds, convert_seconds)
+        self.update_status(100, "Finished!")
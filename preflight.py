@@ -0,0 +1,215 @@
+"""
+InterLivre, audiobook splicer
+
+Preflight checks that run before any heavy work: probing, chapter pairing, disk space, and a runtime estimate
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isfile, join as pjoin
+from audiotools import CancelledError
+import tracing
+
+THROUGHPUT_FILENAME = "throughput.json"
+# Audio seconds processed per wall clock second for each stage, used until a run on this host has been measured
+DEFAULT_THROUGHPUT = {"convert_inputs": 400.0, "interleave": 30.0, "convert_outputs": 150.0}
+# Weight of the newest measurement when updating the throughput history
+THROUGHPUT_SMOOTHING = 0.5
+# Bitrate FFmpeg uses for mp3 output by default
+MP3_BITS_PER_SECOND = 128000
+# Chapter pairs whose durations differ by more than this ratio are probably mismatched
+MAX_DURATION_RATIO = 2.0
+DEFAULT_PROBE_WORKERS = 16
+
+
+class PreflightError(Exception):
+    """Raised when a job can't run because preflight checks failed."""
+    pass
+
+
+class ThroughputHistory:
+    """Measured throughput of each pipeline stage in audio seconds per second, saved as JSON.
+
+    Attributes:
+        path (str): Path to the JSON file, or None to keep the history in memory only.
+        rates (dict): Throughput per stage name.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.rates = dict(DEFAULT_THROUGHPUT)
+        if path is not None and isfile(path):
+            try:
+                with open(path) as f:
+                    self.rates.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.exception(e)
+
+    def record(self, stage, audio_seconds, wall_seconds):
+        """Folds a new measurement of a stage into the history and saves it."""
+        if audio_seconds <= 0 or wall_seconds <= 0:
+            return
+        rate = audio_seconds / wall_seconds
+        old = self.rates.get(stage)
+        self.rates[stage] = rate if old is None else old + THROUGHPUT_SMOOTHING * (rate - old)
+        if self.path is not None:
+            try:
+                with open(self.path, 'w') as f:
+                    json.dump(self.rates, f)
+            except OSError as e:
+                logging.exception(e)
+
+    def estimate(self, stage, audio_seconds, parallelism=1):
+        """Returns the predicted wall clock seconds for a stage to process audio_seconds of audio."""
+        return audio_seconds / (self.rates[stage] * max(1, parallelism))
+
+
+class PreflightReport:
+    """Results of the preflight checks.
+
+    Attributes:
+        errors (list(str)): Problems that stop the job from running.
+        warnings (list(str)): Suspicious inputs that don't stop the job.
+        durations (list(tuple)): Book 1 and book 2 durations in seconds for each chapter pair.
+        tmp_bytes (int): Peak disk space used in the tmp workspace.
+        output_bytes (int): Disk space used by the output files.
+        free_bytes (int): Free disk space in the output directory.
+        estimated_seconds (dict): Predicted wall clock seconds for each stage.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.durations = []
+        self.tmp_bytes = 0
+        self.output_bytes = 0
+        self.free_bytes = 0
+        self.estimated_seconds = {}
+
+    @property
+    def ok(self):
+        """bool: True if there are no errors."""
+        return len(self.errors) == 0
+
+    @property
+    def total_estimated_seconds(self):
+        return sum(self.estimated_seconds.values())
+
+    def summary(self):
+        """Returns a human readable summary of the report."""
+        gb = 1024 ** 3
+        lines = [f"{len(self.durations)} chapter pair(s), "
+                 f"{sum(d[0] + d[1] for d in self.durations) / 3600.0:.1f} hours of audio",
+                 f"Disk space needed: {(self.tmp_bytes + self.output_bytes) / gb:.2f} GB "
+                 f"({self.free_bytes / gb:.2f} GB free)",
+                 f"Estimated run time: {self.total_estimated_seconds / 60.0:.1f} minutes"]
+        lines += [f"Error: {e}" for e in self.errors]
+        lines += [f"Warning: {w}" for w in self.warnings]
+        return "\n".join(lines)
+
+
+class Preflight:
+    """Checks a job before it starts.
+
+    Probes every selected source file concurrently, checks that the chapters pair up, estimates the disk space the
+    tmp workspace and the outputs need, and predicts the run time from the throughput measured on earlier runs.
+
+    Attributes:
+        settings (JobSettings): Job to check.
+        convertor (AudioConvertor): Used to probe the source files. Its probe cache makes repeat checks cheap.
+        throughput (ThroughputHistory): Measured throughput used for the runtime estimate.
+        max_workers (int): Number of files to probe at the same time.
+    """
+
+    def __init__(self, settings, convertor, throughput=None, max_workers=DEFAULT_PROBE_WORKERS):
+        self.settings = settings
+        self.convertor = convertor
+        self.throughput = throughput if throughput is not None else ThroughputHistory()
+        self.max_workers = max_workers
+
+    def _probe(self, path):
+        try:
+            info = self.convertor.probe(path)
+            return float(info['duration']), None
+        except CancelledError:
+            raise
+        except Exception as e:
+            return 0.0, f"Couldn't read audio from {path} ({e})"
+
+    def run(self, filelists):
+        """Runs the checks.
+
+        Args:
+            filelists (list(list(str))): Book 1 and book 2 files to include.
+
+        Returns:
+            PreflightReport: Results of the checks.
+        """
+        report = PreflightReport()
+        s = self.settings
+        if len(filelists[0]) != len(filelists[1]):
+            # Same rule as the interleaving and the resume planning, which pair up the first files of each book
+            report.warnings.append(f"Book 1 has {len(filelists[0])} file(s) and book 2 has {len(filelists[1])}, "
+                                   f"only the first {min(len(filelists[0]), len(filelists[1]))} of each are "
+                                   f"interleaved")
+        if len(filelists[0]) == 0 or len(filelists[1]) == 0:
+            report.errors.append("No input files selected")
+            return report
+
+        # Probe everything concurrently, ffprobe runs in its own process so threads are enough
+        paths = [pjoin(s.src1_dir, f) for f in filelists[0]] + [pjoin(s.src2_dir, f) for f in filelists[1]]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(tracing.bind(self._probe), paths))
+        for duration, error in results:
+            if error is not None:
+                report.errors.append(error)
+        durations1 = [r[0] for r in results[:len(filelists[0])]]
+        durations2 = [r[0] for r in results[len(filelists[0]):]]
+
+        # Check that the chapters pair up
+        for i, (d1, d2) in enumerate(zip(durations1, durations2)):
+            report.durations.append((d1, d2))
+            if d1 > 0 and d2 > 0 and max(d1, d2) / min(d1, d2) > MAX_DURATION_RATIO:
+                report.warnings.append(f"Chapter {i + 1} durations differ a lot ({d1:.0f}s and {d2:.0f}s), "
+                                       f"check that {filelists[0][i]} and {filelists[1][i]} belong together")
+
+        # Disk usage
+        tmp_format = s.tmp_audio_format
+        dst_format = s.dst_audio_format
+        book_seconds = sum(durations1) + sum(durations2)
+        tmp_bytes_per_second = tmp_format.sample_rate * tmp_format.channels * tmp_format.bit_depth // 8
+        source_bytes = sum(os.path.getsize(p) for p in paths if isfile(p))
+        # Copies of the sources, their converted wav versions, and the interleaved wav files
+        report.tmp_bytes = int(source_bytes + 2 * book_seconds * tmp_bytes_per_second)
+        if s.shard_single_files and len(paths) == 2:
+            # Virtual chapters are a second copy of both books and of the interleaved output
+            report.tmp_bytes += int(2 * book_seconds * tmp_bytes_per_second)
+        if dst_format.file_format == 'mp3':
+            report.output_bytes = int(book_seconds * MP3_BITS_PER_SECOND / 8)
+        else:
+            report.output_bytes = int(book_seconds * dst_format.sample_rate * dst_format.channels *
+                                      dst_format.bit_depth // 8)
+        try:
+            report.free_bytes = shutil.disk_usage(s.dst_dir).free
+        except OSError as e:
+            report.errors.append(f"Couldn't check free space in {s.dst_dir} ({e})")
+        else:
+            if report.tmp_bytes + report.output_bytes > report.free_bytes:
+                report.errors.append(f"Not enough disk space in {s.dst_dir}, "
+                                     f"{(report.tmp_bytes + report.output_bytes) / 1024 ** 3:.2f} GB needed and "
+                                     f"{report.free_bytes / 1024 ** 3:.2f} GB free")
+
+        # Runtime
+        workers = min(s.max_jobs if s.max_jobs else (os.cpu_count() or 1), len(report.durations))
+        report.estimated_seconds = {
+            "convert_inputs": self.throughput.estimate("convert_inputs", book_seconds),
+            "interleave": self.throughput.estimate("interleave", book_seconds, workers),
+            "convert_outputs": self.throughput.estimate("convert_outputs", book_seconds)}
+        return report
@@ -0,0 +1,94 @@
+"""
+InterLivre, audiobook splicer
+
+Quick preview of the interleaving settings using only the start of the first chapter pair
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import os
+import wave
+from os.path import join as pjoin
+from audiotools import AudioConvertor
+from interleaver import Interleaver
+from pipeline import Pipeline
+from preflight import PreflightError
+import utils
+
+PREVIEW_DIRECTORY = "preview"
+PREVIEW_FILENAME = "preview.wav"
+DEFAULT_PREVIEW_MINUTES = 3
+
+
+class Preview:
+    """Interleaves the first few minutes of the first chapter pair so the settings can be checked by ear.
+
+    Only the previewed range of each source is decoded, so a preview takes a couple of seconds regardless of the
+    length of the books. The preview is written as a wav file in the preview folder of the tmp directory inside the
+    output directory, next to the probe cache it reuses. The output chapters and the manifest are left alone.
+
+    Attributes:
+        settings (JobSettings): Job to preview.
+        minutes (float): Length of audio to take from the start of each source.
+    """
+
+    def __init__(self, settings, minutes=DEFAULT_PREVIEW_MINUTES, status_queue=None, cancel=None):
+        self.settings = settings
+        self.minutes = minutes
+        self.status_queue = status_queue
+        self.cancel_event = cancel
+
+    def decode_clip(self, convertor, src_path, dst_path):
+        """Writes the first minutes of src_path to dst_path in the interleaving format."""
+        seconds = self.minutes * 60.0
+        if convertor.output_format.equals(convertor.get_audio_format(src_path)):
+            # Already in the right format, just copy the first frames
+            with wave.open(src_path, 'rb') as src, wave.open(dst_path, 'wb') as dst:
+                dst.setparams(src.getparams())
+                dst.writeframes(src.readframes(int(seconds * src.getframerate())))
+        else:
+            convertor.convert(src_path, dst_path, max_seconds=seconds)
+
+    def run(self):
+        """Makes the preview.
+
+        Returns:
+            str: Path to the preview wav file.
+
+        Raises:
+            PreflightError: If there are no input files to preview.
+        """
+        s = self.settings
+        pipeline = Pipeline(s, status_queue=self.status_queue, cancel=self.cancel_event)
+        pipeline.open_caches()
+        src_files = pipeline.get_selected_files()
+        if len(src_files[0]) == 0 or len(src_files[1]) == 0:
+            raise PreflightError("No input files selected")
+        preview_dir = pjoin(pipeline.filemanager.create_tmp_root(), PREVIEW_DIRECTORY)
+        os.makedirs(preview_dir, exist_ok=True)
+
+        convertor = AudioConvertor(s.tmp_audio_format, pipeline.probe_cache, self.cancel_event)
+        clips = []
+        for i, src_path in enumerate([pjoin(s.src1_dir, src_files[0][0]), pjoin(s.src2_dir, src_files[1][0])]):
+            utils.update_progress(self.status_queue, i * 25,
+                                  f"Decoding the first {self.minutes:g} minutes of book {i + 1}")
+            clip_path = pjoin(preview_dir, f"book{i + 1}.wav")
+            self.decode_clip(convertor, src_path, clip_path)
+            clips.append(clip_path)
+            if utils.is_cancelled(self.cancel_event):
+                return None
+
+        tmp_audio_format = s.tmp_audio_format
+        interleaver = Interleaver(sample_rate=tmp_audio_format.sample_rate,
+                                  is_stereo=tmp_audio_format.channels == 2,
+                                  min_seg_seconds=s.seg_size_min,
+                                  max_seg_seconds=s.seg_size_max,
+                                  status_queue=self.status_queue,
+                                  cancel=self.cancel_event)
+        preview_path = pjoin(preview_dir, PREVIEW_FILENAME)
+        interleaver.interleave(clips[0], clips[1], preview_path, "Preview")
+        if utils.is_cancelled(self.cancel_event):
+            return None
+        return preview_path
@@ -0,0 +1,95 @@
+"""
+InterLivre, audiobook splicer
+
+Persistent cache of ffprobe results
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from os.path import abspath
+
+PROBE_CACHE_FILENAME = "probe-cache.sqlite"
+
+
+class ProbeCache:
+    """Caches ffprobe stream info keyed on (path, size, mtime, inode).
+
+    Results are kept in memory and, if a path is given, in a SQLite database so they survive between runs.
+    Any change to a file's size, modification time or inode makes its cached result stale.
+
+    Attributes:
+        path (str): Path to the SQLite database, or None to cache in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+                self._db.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, "
+                                 "mtime_ns INTEGER, ino INTEGER, info TEXT)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                # Fall back to an in-memory cache, e.g. if the workspace is on a filesystem without locking
+                logging.exception(e)
+                self._db = None
+
+    @classmethod
+    def file_key(cls, in_path):
+        """Returns the (path, size, mtime, inode) key for a file, or None if it doesn't exist."""
+        try:
+            st = os.stat(in_path)
+        except OSError:
+            return None
+        return abspath(in_path), st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, in_path):
+        """Returns the cached ffprobe stream info for a file, or None if it's missing or stale."""
+        key = self.file_key(in_path)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key[0])
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT size, mtime_ns, ino, info FROM probes WHERE path = ?",
+                                   (key[0],)).fetchone()
+            if row is None or tuple(row[:3]) != key[1:]:
+                return None
+            info = json.loads(row[3])
+            self._entries[key[0]] = (key, info)
+            return info
+
+    def put(self, in_path, info):
+        """Stores ffprobe stream info for a file."""
+        key = self.file_key(in_path)
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key[0]] = (key, info)
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                                 (key[0], key[1], key[2], key[3], json.dumps(info)))
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.exception(e)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,274 @@
+"""
+InterLivre, audiobook splicer
+
+Hierarchical job progress (book, stage, chapter, source) weighted by audio duration, reported at a fixed rate with
+the audio throughput and a smoothed estimate of the time left
+
+Example:
+    tracker = ProgressTracker(status_queue, audio_seconds=7200, stage_seconds={"interleave": 300, ...})
+    chapter = tracker.stage("interleave").add("book_01.wav", weight=1800)
+    chapter.set(0.5)
+    tracker.update("Processing chapters, 0/4 done")
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import queue
+import threading
+import time
+import utils
+
+# Time between reports sent to the status queue
+REPORT_INTERVAL_SECONDS = 0.25
+# Time between progress messages sent by each chapter worker
+WORKER_REPORT_INTERVAL_SECONDS = 0.1
+# How far each report moves the time left towards the latest measurement, lower is steadier but slower to adapt
+ETA_SMOOTHING = 0.2
+# Progress needed before the measured rate is used for the time left at all, and before it's used alone
+MIN_ETA_FRACTION = 0.01
+TRUSTED_ETA_FRACTION = 0.1
+
+
+def format_duration(seconds):
+    """Formats a duration in seconds for people, e.g. '45 s', '12 min' or '1 h 5 min'."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} s"
+    minutes = (seconds + 30) // 60
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60} min"
+
+
+class ProgressNode:
+    """One level of a job's progress. Its fraction done is the weighted mean of its children's, if it has any.
+
+    Attributes:
+        name (str): Name of the book, stage, chapter or source.
+        weight (float): Share of the parent's work, e.g. seconds of audio or estimated seconds of work.
+        children (list(ProgressNode)): Parts of this node's work.
+    """
+
+    def __init__(self, name, weight=1.0):
+        self.name = name
+        self.weight = weight
+        self.children = []
+        self._fraction = 0.0
+
+    def add(self, name, weight=1.0):
+        """Adds a part of this node's work and returns it."""
+        child = ProgressNode(name, weight)
+        self.children.append(child)
+        return child
+
+    def child(self, name):
+        """Returns the child with the given name, or None."""
+        for c in self.children:
+            if c.name == name:
+                return c
+        return None
+
+    def set(self, fraction):
+        """Sets the fraction done of a node without children, from 0 to 1."""
+        self._fraction = utils.clamp(fraction, 0.0, 1.0)
+
+    def finish(self):
+        self._fraction = 1.0
+        for c in self.children:
+            c.finish()
+
+    @property
+    def fraction(self):
+        """float: Fraction of the work done, from 0 to 1."""
+        total = sum(c.weight for c in self.children)
+        if total <= 0:
+            return self._fraction
+        return sum(c.weight * c.fraction for c in self.children) / total
+
+
+class StageStatusQueue:
+    """Status queue for code that reports a stage's progress from 0 to 100 on its own.
+
+    The progress sets the stage's fraction done and the message is passed on to the tracker, so the overall
+    progress keeps going up instead of starting again at 0 for each stage.
+    """
+
+    def __init__(self, tracker, node):
+        self.tracker = tracker
+        self.node = node
+
+    def put(self, status):
+        progress, msg = status
+        if progress >= 0:
+            self.node.set(progress / 100.0)
+        self.tracker.update(msg)
+
+
+class ChapterProgressQueue:
+    """Status queue for an Interleaver in a chapter worker process.
+
+    Sends (key, progress) tuples to the scheduler's progress queue, at most once per interval, so a chapter with
+    thousands of split points doesn't flood the coordinating process.
+    """
+
+    def __init__(self, progress_queue, key, interval=WORKER_REPORT_INTERVAL_SECONDS):
+        self.progress_queue = progress_queue
+        self.key = key
+        self.interval = interval
+        self._last_report = 0.0
+
+    def put(self, status):
+        now = time.monotonic()
+        if self.progress_queue is None or now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        try:
+            self.progress_queue.put_nowait((self.key, status[0]))
+        except (queue.Full, OSError, ValueError):
+            # Progress is best effort, never hold up the chapter for it
+            pass
+
+
+class ProgressTracker:
+    """Progress of a whole job, sent to a status queue at most once per interval.
+
+    Stages are weighted by their estimated run time and chapters by their audio duration. Each report is a
+    (progress, message) tuple whose message ends with the throughput and the time left. A status queue with a
+    put_progress(snapshot) method gets the snapshot() dictionary instead.
+
+    Attributes:
+        status_queue: Receives the reports. May be None.
+        audio_seconds (float): Seconds of audio the job processes.
+        estimated_seconds (float): Predicted run time of the job, or None if unknown.
+        root (ProgressNode): Progress of the book, with a child for each stage.
+        message (str): Latest status message.
+        interval (float): Minimum seconds between reports.
+    """
+
+    def __init__(self, status_queue, audio_seconds=0.0, stage_seconds=None, interval=REPORT_INTERVAL_SECONDS,
+                 clock=time.monotonic):
+        """
+        Args:
+            status_queue: Receives the reports. May be None.
+            audio_seconds (float): Seconds of audio the job processes.
+            stage_seconds (dict): Estimated run time of each stage, which creates the stages in that order.
+            interval (float): Minimum seconds between reports.
+            clock (function): Returns the time in seconds, for testing.
+        """
+        self.status_queue = status_queue
+        self.audio_seconds = audio_seconds
+        self.interval = interval
+        self.root = ProgressNode("book")
+        self.message = ""
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._last_report = None
+        self._eta = None
+        stage_seconds = stage_seconds if stage_seconds is not None else {}
+        self.estimated_seconds = sum(stage_seconds.values()) if len(stage_seconds) > 0 else None
+        for name, seconds in stage_seconds.items():
+            self.root.add(name, max(seconds, 0.0))
+        if self.estimated_seconds is not None and self.estimated_seconds <= 0:
+            # No useful estimate, count every stage the same
+            self.estimated_seconds = None
+            for node in self.root.children:
+                node.weight = 1.0
+
+    def stage(self, name):
+        """Returns the progress node of a stage, adding it with the average weight if it's new."""
+        node = self.root.child(name)
+        if node is None:
+            weights = [c.weight for c in self.root.children]
+            node = self.root.add(name, sum(weights) / len(weights) if len(weights) > 0 else 1.0)
+        return node
+
+    def stage_queue(self, name):
+        """Returns a StageStatusQueue that maps a stage's own 0 to 100 progress into the job's."""
+        return StageStatusQueue(self, self.stage(name))
+
+    def update(self, msg=None, force=False):
+        """Sets the status message and reports the progress if the interval has passed since the last report.
+
+        Args:
+            msg (str): New status message, None to keep the current one.
+            force (bool): Report now, e.g. when a stage starts.
+
+        Returns:
+            bool: True if a report was sent.
+        """
+        with self._lock:
+            if msg is not None:
+                self.message = msg
+            now = self._clock()
+            if not force and self._last_report is not None and now - self._last_report < self.interval:
+                return False
+            snapshot = self._snapshot(now)
+            self._last_report = now
+        self._report(snapshot)
+        return True
+
+    def snapshot(self):
+        """Returns the progress as a JSON-serializable dictionary."""
+        with self._lock:
+            return self._snapshot(self._clock(), update_eta=False)
+
+    def _snapshot(self, now, update_eta=True):
+        fraction = self.root.fraction
+        elapsed = now - self._start
+        done_seconds = fraction * self.audio_seconds
+        if update_eta:
+            self._update_eta(fraction, elapsed, now)
+        return {"progress": fraction * 100.0, "message": self.message, "elapsed_seconds": elapsed,
+                "audio_seconds_done": done_seconds, "audio_seconds_total": self.audio_seconds,
+                "audio_seconds_per_second": done_seconds / elapsed if elapsed > 0 else 0.0,
+                "eta_seconds": self._eta}
+
+    def _update_eta(self, fraction, elapsed, now):
+        """Moves the time left towards a blend of the preflight estimate and the rate measured so far.
+
+        The measured rate counts for more as the job goes on, and for everything once TRUSTED_ETA_FRACTION of it is
+        done. Between measurements the time left counts down, so it
+        doesn't jump around when a chapter finishes.
+        """
+        if fraction >= 1.0:
+            self._eta = 0.0
+            return
+        measured = elapsed * (1.0 - fraction) / fraction if fraction >= MIN_ETA_FRACTION else None
+        if self.estimated_seconds is not None:
+            prior = self.estimated_seconds * (1.0 - fraction)
+            trust = min(fraction / TRUSTED_ETA_FRACTION, 1.0)
+            target = prior if measured is None else trust * measured + (1.0 - trust) * prior
+        elif measured is not None:
+            target = measured
+        else:
+            return
+        if self._eta is None:
+            self._eta = target
+        else:
+            since_last = now - self._last_report if self._last_report is not None else 0.0
+            counted_down = max(self._eta - since_last, 0.0)
+            self._eta = counted_down + ETA_SMOOTHING * (target - counted_down)
+
+    def _report(self, snapshot):
+        if self.status_queue is None:
+            return
+        put_progress = getattr(self.status_queue, "put_progress", None)
+        if put_progress is not None:
+            put_progress(snapshot)
+        else:
+            self.status_queue.put((int(utils.clamp(snapshot["progress"], 1, 99)), self.format_message(snapshot)))
+
+    @classmethod
+    def format_message(cls, snapshot):
+        """Returns the status message followed by the throughput and time left, if they're known yet."""
+        details = []
+        if snapshot["audio_seconds_done"] > 0:
+            details.append(f"{snapshot['audio_seconds_per_second']:.1f}x real time")
+        if snapshot["eta_seconds"] is not None:
+            details.append(f"about {format_duration(snapshot['eta_seconds'])} left")
+        if len(details) == 0:
+            return snapshot["message"]
+        return f"{snapshot['message']} ({', '.join(details)})"
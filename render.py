@@ -0,0 +1,114 @@
+"""
+InterLivre, audiobook splicer
+
+Render-only entry point that rebuilds interleaved chapters from their edit decision lists without any analysis
+
+Example:
+    python render.py OUTPUT_DIR/interlivre-tmp/edl OUTPUT_DIR --format mp3 --rate 44100
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import logging
+import sys
+import tempfile
+from os.path import basename, isdir, join as pjoin
+import numpy as np
+from scipy.io import wavfile as wav
+from audiotools import AudioConvertor, AudioFormat
+from edl import EditDecisionList, EDL_EXTENSION
+from interleaver import Interleaver
+import utils
+
+
+def render_chapter(edl_path, dst_path, audio_format, status_queue=None, cancel=None):
+    """Rebuilds an interleaved chapter from its EditDecisionList and its source files.
+
+    The sources are decoded again and cut and faded as the list says, then converted into audio_format.
+
+    Args:
+        edl_path (str): Path to the chapter's EditDecisionList.
+        dst_path (str): Path to write the chapter to.
+        audio_format (AudioFormat): Output format.
+
+    Returns:
+        str: dst_path, or None if cancelled.
+
+    Raises:
+        ValueError: If a source file changed since the list was made.
+    """
+    edl = EditDecisionList.load(edl_path)
+    decode_format = AudioFormat(edl.sample_rate, 16, edl.channels, 'wav')
+    convertor = AudioConvertor(decode_format, cancel=cancel)
+    interleaver = Interleaver(sample_rate=edl.sample_rate, is_stereo=edl.channels == 2, status_queue=status_queue,
+                              cancel=cancel)
+    interleaver.status_msg = f"Rendering {basename(dst_path)}"
+    with tempfile.TemporaryDirectory(prefix="interlivre-render-") as tmp_dir:
+        buffers = []
+        for i, src_path in enumerate(edl.sources):
+            if len(edl.fingerprints) > i and utils.fingerprint_file(src_path) != edl.fingerprints[i]:
+                raise ValueError(f"{src_path} changed since its edit decision list was made")
+            decoded_path = src_path
+            if decode_format.equals(convertor.get_audio_format(src_path)) is False:
+                decoded_path = pjoin(tmp_dir, f"source{i + 1}.wav")
+                convertor.convert(src_path, decoded_path)
+                if utils.is_cancelled(cancel):
+                    return None
+            buffers.append(interleaver.read(decoded_path))
+        audio = interleaver.render_edl(edl, buffers[0], buffers[1])
+        if audio is None:
+            return None
+        rendered_path = pjoin(tmp_dir, "rendered.wav")
+        wav.write(rendered_path, edl.sample_rate, audio.astype(np.int16))
+        convertor.output_format = audio_format
+        convertor.convert(rendered_path, dst_path)
+    if utils.is_cancelled(cancel):
+        return None
+    return dst_path
+
+
+def render_directory(edl_dir, dst_dir, audio_format, status_queue=None, cancel=None):
+    """Rebuilds every chapter with an EditDecisionList in edl_dir into dst_dir.
+
+    Returns:
+        list(str): Paths to the rendered chapters.
+    """
+    edl_files = sorted([f for f in utils.list_files(edl_dir) if f.endswith(f".{EDL_EXTENSION}")], key=str.lower)
+    res = []
+    for i, f in enumerate(edl_files):
+        if utils.is_cancelled(cancel):
+            break
+        utils.update_progress(status_queue, i / len(edl_files) * 100.0, f"Rendering file {i + 1}/{len(edl_files)}")
+        chapter_name = f[:-len(EDL_EXTENSION) - 1]
+        dst_path = pjoin(dst_dir, f"{chapter_name}.{audio_format.file_format}")
+        if render_chapter(pjoin(edl_dir, f), dst_path, audio_format, cancel=cancel) is not None:
+            res.append(dst_path)
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild interleaved chapters from their edit decision lists.")
+    parser.add_argument('edl', help="An edit decision list, or a directory of them")
+    parser.add_argument('dst', help="Output file, or output directory when rendering a directory")
+    parser.add_argument('--format', default='wav', choices=['wav', 'mp3'])
+    parser.add_argument('--rate', type=int, default=48000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    audio_format = AudioFormat(args.rate, 16, 1, args.format)
+    try:
+        if isdir(args.edl):
+            render_directory(args.edl, args.dst, audio_format)
+        else:
+            render_chapter(args.edl, args.dst, audio_format)
+    except (OSError, ValueError) as e:
+        logging.error(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+InterLivre, audiobook splicer
+
+End to end scaling benchmark: runs the whole convert, interleave and encode pipeline headless on synthetic book
+pairs of different sizes and records the time of each stage, peak memory, and tmp disk use
+
+Python allocations, numpy arrays included, are traced with tracemalloc in the coordinating process and, while they
+interleave, in the chapter workers, whose peaks are reported separately.
+
+Example:
+    python scalebenchmark.py --chapters 1 4 16 --chapter-length 5m 30m --workers 1 4 --output scaling.json
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from os.path import isdir, isfile, join as pjoin
+from queue import Empty
+from audiotools import AudioConvertor, AudioFormat
+from benchmark import BOOK2_LENGTH_RATIO, host_info, parse_duration
+from pipeline import JobSettings, Pipeline, TRACEMALLOC_ENV
+from synthspeech import SyntheticSpeech
+import metrics
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is left out there
+    resource = None
+
+RESULTS_VERSION = 1
+DEFAULT_CHAPTERS = [1, 4]
+DEFAULT_CHAPTER_LENGTHS = ["2m", "10m"]
+DEFAULT_FORMATS = ["wav"]
+# Seconds between samples of the tmp workspace size
+TMP_SAMPLE_SECONDS = 0.25
+STAGES = ["preflight", "convert_inputs", "interleave", "convert_outputs"]
+
+
+def get_book_dir(root, chapters, chapter_seconds, input_format, book):
+    return pjoin(root, "books", f"{chapters}x{chapter_seconds:g}s-{input_format}", f"book{book}")
+
+
+def build_book_pair(root, chapters, chapter_seconds, input_format, seed=0):
+    """Writes a synthetic book pair under root, reusing chapters written by earlier runs.
+
+    Book 2 chapters are a little longer than book 1's. mp3 books are encoded from wav with FFmpeg.
+
+    Returns:
+        list(str): Book 1 and book 2 directories.
+    """
+    dirs = []
+    for book in (1, 2):
+        book_dir = get_book_dir(root, chapters, chapter_seconds, input_format, book)
+        os.makedirs(book_dir, exist_ok=True)
+        for c in range(chapters):
+            path = pjoin(book_dir, f"chapter_{c + 1:03d}.{input_format}")
+            if isfile(path):
+                continue
+            seconds = chapter_seconds if book == 1 else chapter_seconds * BOOK2_LENGTH_RATIO
+            speech = SyntheticSpeech(seconds, seed=seed + 2 * c + book)
+            # Write next to the chapter and rename, so an interrupted build never leaves a truncated chapter
+            part_path = f"{path}.part.wav"
+            speech.write(part_path)
+            if input_format == 'wav':
+                os.replace(part_path, path)
+            else:
+                AudioConvertor(AudioFormat(speech.sample_rate, 16, 1, input_format)).convert(part_path, path)
+                os.remove(part_path)
+        dirs.append(book_dir)
+    return dirs
+
+
+class DirectorySizeSampler:
+    """Samples the total size of the files in a directory tree from a background thread and keeps the peak."""
+
+    def __init__(self, path, interval=TMP_SAMPLE_SECONDS):
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def size(self):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for f in filenames:
+                try:
+                    total += os.lstat(pjoin(dirpath, f)).st_size
+                except OSError:
+                    # Removed between listing and stat
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.size())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.size())
+        return self.peak_bytes
+
+
+def max_rss_bytes(who):
+    """Returns the peak resident set size of this process or its largest child in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _run_case(case, queue):
+    """Runs one benchmark case. Runs in a fresh process so the peak memory figures belong to this case alone."""
+    # Chapter workers are spawned from this process and inherit its environment, they report their peaks through the
+    # metrics the pipeline collects from them
+    os.environ[TRACEMALLOC_ENV] = "1"
+    try:
+        src1_dir, src2_dir = case["book_dirs"]
+        dst_dir = pjoin(case["root"], "out")
+        # Every case starts cold, without the caches or the resume manifest of the last one
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        os.makedirs(dst_dir)
+        settings = JobSettings(src1_dir, src2_dir, dst_dir, "bench", max_jobs=case["workers"],
+                               dst_file_format=case["output_format"])
+        pipeline = Pipeline(settings)
+        sampler = DirectorySizeSampler(dst_dir).start()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            pipeline.run()
+        finally:
+            wall_seconds = time.perf_counter() - start
+            tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            peak_dst_bytes = sampler.stop()
+        output_bytes = sum(os.path.getsize(p) for p in pipeline.output_paths if isfile(p))
+        audio_seconds = case["chapters"] * case["chapter_seconds"] * (1 + BOOK2_LENGTH_RATIO)
+        queue.put({"wall_seconds": wall_seconds,
+                   "stage_seconds": pipeline.stage_seconds,
+                   "audio_seconds": audio_seconds,
+                   "realtime_factor": audio_seconds / wall_seconds if wall_seconds > 0 else None,
+                   "peak_rss_bytes": max_rss_bytes(resource.RUSAGE_SELF) if resource else None,
+                   "peak_child_rss_bytes": max_rss_bytes(resource.RUSAGE_CHILDREN) if resource else None,
+                   # Python allocations only, numpy arrays included, in the coordinating process
+                   "tracemalloc_peak_bytes": tracemalloc_peak,
+                   # Highest peak of any chapter worker while interleaving one chapter
+                   "worker_tracemalloc_peak_bytes": metrics.REGISTRY.maximum("chapter_tracemalloc_peak_bytes").get(),
+                   # Outputs are written next to the tmp workspace, so take them out of the peak
+                   "peak_tmp_bytes": max(0, peak_dst_bytes - output_bytes),
+                   "output_bytes": output_bytes,
+                   "outputs": len(pipeline.output_paths)})
+    except Exception as e:
+        logging.exception(e)
+        queue.put({"error": str(e)})
+
+
+def run_case(case):
+    """Runs a case in its own process and returns its measurements merged into the case."""
+    # Build the books here, so generating them doesn't count towards the case's peak memory
+    try:
+        case = dict(case, book_dirs=build_book_pair(case["root"], case["chapters"], case["chapter_seconds"],
+                                                    case["input_format"], case["seed"]))
+    except Exception as e:
+        logging.exception(e)
+        return dict({k: v for k, v in case.items() if k != "root"},
+                    error=f"Couldn't build the synthetic books ({e})")
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_run_case, args=(case, queue), name="InterLivreBenchmark")
+    p.start()
+    try:
+        while True:
+            try:
+                result = queue.get(timeout=1.0)
+                break
+            except Empty:
+                if not p.is_alive():
+                    # e.g. killed for running out of memory
+                    result = {"error": f"Benchmark process exited with code {p.exitcode}"}
+                    break
+    finally:
+        p.join()
+    return dict({k: v for k, v in case.items() if k not in ("root", "book_dirs")}, **result)
+
+
+def run_scaling(root, chapters, chapter_lengths, input_formats, workers, output_format='wav', seed=0,
+                out=sys.stdout):
+    """Runs every combination of the given chapter counts, chapter lengths, input formats and worker counts.
+
+    Returns:
+        dict: The results, ready to be saved as JSON.
+    """
+    runs = []
+    if out is not None:
+        print(table_header(), file=out, flush=True)
+    for n, seconds, fmt, w in itertools.product(chapters, chapter_lengths, input_formats, workers):
+        case = {"root": root, "chapters": n, "chapter_seconds": seconds, "input_format": fmt, "workers": w,
+                "output_format": output_format, "seed": seed}
+        run = run_case(case)
+        runs.append(run)
+        if out is not None:
+            print(table_row(run), file=out, flush=True)
+    return {"version": RESULTS_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "host": host_info(),
+            "runs": runs}
+
+
+# region Reporting
+
+def table_header():
+    return (f"{'chapters':>8} {'length':>8} {'in':>4} {'jobs':>4} {'wall s':>8} "
+            + " ".join(f"{s[:12]:>12}" for s in STAGES)
+            + f" {'x realtime':>10} {'rss MB':>8} {'child MB':>8} {'main traced MB':>14} {'worker traced MB':>16} "
+              f"{'tmp MB':>8}")
+
+
+def table_row(run):
+    if "error" in run:
+        return (f"{run['chapters']:>8} {run['chapter_seconds']:>7.0f}s {run['input_format']:>4} {run['workers']:>4} "
+                f"failed: {run['error']}")
+    mb = 1024.0 * 1024.0
+
+    def fmt_mb(v, width):
+        return f"{v / mb:>{width}.1f}" if v is not None else f"{'-':>{width}}"
+    stages = " ".join(f"{run['stage_seconds'].get(s, 0.0):>12.2f}" for s in STAGES)
+    return (f"{run['chapters']:>8} {run['chapter_seconds']:>7.0f}s {run['input_format']:>4} {run['workers']:>4} "
+            f"{run['wall_seconds']:>8.2f} {stages} {run['realtime_factor'] or 0:>10.1f} "
+            f"{fmt_mb(run['peak_rss_bytes'], 8)} {fmt_mb(run['peak_child_rss_bytes'], 8)} "
+            f"{fmt_mb(run['tracemalloc_peak_bytes'], 14)} {fmt_mb(run.get('worker_tracemalloc_peak_bytes'), 16)} "
+            f"{fmt_mb(run['peak_tmp_bytes'], 8)}")
+
+
+def write_csv(results, path):
+    """Writes one row per run, for plotting scaling curves."""
+    fields = ["chapters", "chapter_seconds", "input_format", "workers", "audio_seconds", "wall_seconds"] + \
+             [f"{s}_seconds" for s in STAGES] + \
+             ["realtime_factor", "peak_rss_bytes", "peak_child_rss_bytes", "tracemalloc_peak_bytes",
+              "worker_tracemalloc_peak_bytes", "peak_tmp_bytes", "output_bytes", "error"]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for run in results["runs"]:
+            row = dict(run)
+            for s in STAGES:
+                row[f"{s}_seconds"] = run.get("stage_seconds", {}).get(s)
+            writer.writerow(row)
+
+# endregion
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End to end scaling benchmark of the InterLivre pipeline")
+    parser.add_argument('--chapters', nargs='+', type=int, default=DEFAULT_CHAPTERS, help="Chapter counts to test")
+    parser.add_argument('--chapter-length', nargs='+', type=parse_duration, default=DEFAULT_CHAPTER_LENGTHS,
+                        help="Chapter lengths to test, e.g. 5m 30m 2h")
+    parser.add_argument('--formats', nargs='+', choices=['wav', 'mp3'], default=DEFAULT_FORMATS,
+                        help="Input formats to test")
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, os.cpu_count() or 1],
+                        help="Chapter worker process counts to test")
+    parser.add_argument('--output-format', choices=['wav', 'mp3'], default='wav', help="Format of the output files")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic speech")
+    parser.add_argument('--workdir', default=pjoin(tempfile.gettempdir(), "interlivre-scale-benchmark"),
+                        help="Directory for the synthetic books and outputs, books are reused between runs")
+    parser.add_argument('--output', default=None, help="Path to save the results as JSON")
+    parser.add_argument('--csv', default=None, help="Path to save the results as CSV, one row per run")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    lengths = [parse_duration(d) if isinstance(d, str) else d for d in args.chapter_length]
+    workers = sorted(set(args.workers))
+    if not isdir(args.workdir):
+        os.makedirs(args.workdir)
+    results = run_scaling(args.workdir, args.chapters, lengths, args.formats, workers, args.output_format, args.seed)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    return 1 if any("error" in r for r in results["runs"]) else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
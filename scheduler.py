@@ -0,0 +1,285 @@
+"""
+InterLivre, audiobook splicer
+
+Memory-budget-aware scheduling of chapter work across worker processes
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Bytes held per sample while interleaving a chapter: both 16 bit sources, the float64 output buffer that
+# assemble_segments grows with np.append (old and new copies exist at the same time), and the final 16 bit output.
+BYTES_PER_CHAPTER_SAMPLE = 2 + 8 + 8 + 2
+# Interpreter, NumPy and SciPy overhead of each worker process
+WORKER_OVERHEAD_BYTES = 100 * 1024 * 1024
+# Fraction of physical memory to use when no budget is configured
+DEFAULT_BUDGET_RATIO = 0.5
+DEFAULT_BUDGET_BYTES = 4 * 1024 * 1024 * 1024
+# Progress messages waiting to be polled. Workers drop messages once it's full, which keeps the pipe under it from
+# filling up when nobody polls, as a worker can't exit while it still has messages to write into a full pipe.
+PROGRESS_QUEUE_SIZE = 100
+# Time between checks of a job's cancel file in the worker running one of its tasks
+CANCEL_FILE_POLL_SECONDS = 0.02
+
+# Set in each worker process by the pool initializer
+_worker_cancel_event = None
+_worker_progress_queue = None
+
+
+def estimate_chapter_bytes(durations, sample_rate, channels):
+    """Estimates the peak memory used to interleave one chapter.
+
+    Args:
+        durations (list(float)): Durations in seconds of the chapter's source files.
+        sample_rate (int): Sample rate used for interleaving.
+        channels (int): Channel count used for interleaving.
+
+    Returns:
+        int: Estimated peak bytes.
+    """
+    samples = sum(durations) * sample_rate * channels
+    return int(samples * BYTES_PER_CHAPTER_SAMPLE) + WORKER_OVERHEAD_BYTES
+
+
+def default_memory_budget():
+    """Returns a memory budget in bytes based on the physical memory of the host."""
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * DEFAULT_BUDGET_RATIO)
+    except (ValueError, OSError, AttributeError):
+        return DEFAULT_BUDGET_BYTES
+
+
+def worker_cancel_event():
+    """Returns the cancel event shared with the scheduler, or None outside of a worker process."""
+    return _worker_cancel_event
+
+
+def worker_progress_queue():
+    """Returns the queue tasks report their progress to, or None outside of a worker process."""
+    return _worker_progress_queue
+
+
+class TaskCancelEvent:
+    """Cancel event for a task of one job, in the worker process running it.
+
+    Set when the whole scheduler is cancelled, or when the job creates its cancel file. The file lets a job stop its
+    own running tasks on a scheduler it shares with other jobs, without touching theirs. The file is checked at most
+    once per interval, as the check runs for every split point.
+    """
+
+    def __init__(self, cancel_path, event=None, interval=CANCEL_FILE_POLL_SECONDS):
+        self.cancel_path = cancel_path
+        self.event = event
+        self.interval = interval
+        self._next_check = 0.0
+        self._cancelled = False
+
+    def is_set(self):
+        if self._cancelled or (self.event is not None and self.event.is_set()):
+            return True
+        now = time.monotonic()
+        if self.cancel_path is not None and now >= self._next_check:
+            self._next_check = now + self.interval
+            self._cancelled = os.path.exists(self.cancel_path)
+        return self._cancelled
+
+
+def _init_worker(cancel_event, progress_queue=None):
+    global _worker_cancel_event, _worker_progress_queue
+    _worker_cancel_event = cancel_event
+    _worker_progress_queue = progress_queue
+    if progress_queue is not None:
+        # Progress is best effort, never let unsent messages keep the worker from exiting
+        progress_queue.cancel_join_thread()
+
+
+class ChapterScheduler:
+    """Runs chapter tasks in worker processes while keeping their total estimated memory under a budget.
+
+    Pending tasks are admitted in priority order, first-fit: short chapters are packed together as long as they fit
+    in the remaining budget. A task larger than the whole budget waits until every running task has finished and then
+    runs alone. Tasks that have been passed over too many times stop smaller tasks from overtaking them.
+
+    Attributes:
+        memory_budget (int): Maximum total estimated bytes of the running tasks.
+        max_workers (int): Maximum number of tasks running at the same time.
+        cancel_event (multiprocessing.Event): Set to ask running tasks to stop early.
+        progress_queue (multiprocessing.Queue): Receives (key, progress) tuples from running tasks, see
+            poll_progress(). Holds at most PROGRESS_QUEUE_SIZE messages, later ones are dropped until it's polled.
+    """
+
+    def __init__(self, memory_budget=None, max_workers=None):
+        self.memory_budget = memory_budget if memory_budget else default_memory_budget()
+        self.max_workers = max_workers if max_workers else (os.cpu_count() or 1)
+        # Spawn rather than fork, the parent process may be running GUI threads
+        self._mp_context = multiprocessing.get_context("spawn")
+        self.cancel_event = self._mp_context.Event()
+        self.progress_queue = self._mp_context.Queue(PROGRESS_QUEUE_SIZE)
+        self._task_progress = {}
+        self._progress_lock = threading.Lock()
+        self._executor = None
+        self._lock = threading.RLock()
+        self._pending = []
+        self._seq = 0
+        self._running = 0
+        self._running_bytes = 0
+        self._max_skips = 2 * self.max_workers
+
+    def submit(self, fn, task, estimated_bytes, priority=0):
+        """Queues fn(task) to run in a worker process once it fits in the memory budget.
+
+        Args:
+            fn (callable): Picklable, module level function to run.
+            task: Picklable argument for fn.
+            estimated_bytes (int): Estimated peak memory of the task.
+            priority (int): Lower values are admitted first.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the return value of fn(task).
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append([priority, self._seq, fn, task, estimated_bytes, future, 0])
+            self._seq += 1
+            self._pending.sort(key=lambda p: (p[0], p[1]))
+            self._dispatch()
+        return future
+
+    def cancel(self):
+        """Cancels every pending task and asks running tasks to stop."""
+        self.cancel_event.set()
+        with self._lock:
+            for entry in self._pending:
+                entry[5].cancel()
+            self._pending = []
+
+    def terminate(self):
+        """Cancels every task and kills the worker processes right away instead of waiting for running tasks.
+
+        The running tasks fail, so only use this on a scheduler that isn't shared with other jobs. The next submit()
+        starts new workers.
+        """
+        self.cancel()
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is None:
+            return
+        terminate_workers = getattr(executor, "terminate_workers", None)
+        if terminate_workers is not None:
+            terminate_workers()
+            return
+        # Before Python 3.14 the executor can't kill its workers, but it copes with them dying
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait=True):
+        """Cancels pending tasks and shuts down the worker processes.
+
+        Progress nobody polled is dropped, so the workers never wait to write it.
+        """
+        with self._lock:
+            for entry in self._pending:
+                entry[5].cancel()
+            self._pending = []
+            executor = self._executor
+            self._executor = None
+        self.poll_progress()
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+        self.poll_progress()
+        with self._progress_lock:
+            self._task_progress = {}
+
+    def poll_progress(self):
+        """Collects the progress reported by the running tasks.
+
+        Only the latest progress of each task is kept, so it's fine to call this less often than tasks report.
+
+        Returns:
+            dict: Latest progress percent reported for each task key.
+        """
+        with self._progress_lock:
+            while True:
+                try:
+                    key, progress = self.progress_queue.get_nowait()
+                except (queue.Empty, OSError, EOFError):
+                    break
+                self._task_progress[key] = progress
+            return dict(self._task_progress)
+
+    def forget_progress(self, keys):
+        """Drops the progress of tasks that have finished."""
+        with self._progress_lock:
+            for key in keys:
+                self._task_progress.pop(key, None)
+
+    @property
+    def running_bytes(self):
+        """int: Total estimated bytes of the tasks currently running."""
+        return self._running_bytes
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._mp_context,
+                                                 initializer=_init_worker,
+                                                 initargs=(self.cancel_event, self.progress_queue))
+        return self._executor
+
+    def _can_admit(self, estimated_bytes):
+        if self._running == 0:
+            return True
+        return self._running_bytes + estimated_bytes <= self.memory_budget
+
+    def _dispatch(self):
+        """Admits pending tasks in order while they fit. Must be called with the lock held."""
+        i = 0
+        while i < len(self._pending) and self._running < self.max_workers:
+            entry = self._pending[i]
+            priority, seq, fn, task, estimated_bytes, future, skips = entry
+            if future.cancelled():
+                self._pending.pop(i)
+                continue
+            if not self._can_admit(estimated_bytes):
+                if estimated_bytes > self.memory_budget or skips >= self._max_skips:
+                    # Let the running tasks drain so this one can start
+                    break
+                entry[6] += 1
+                i += 1
+                continue
+            self._pending.pop(i)
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._running += 1
+            self._running_bytes += estimated_bytes
+            try:
+                inner = self._get_executor().submit(fn, task)
+            except Exception as e:
+                logging.exception(e)
+                self._running -= 1
+                self._running_bytes -= estimated_bytes
+                future.set_exception(e)
+                continue
+            inner.add_done_callback(lambda f, fut=future, b=estimated_bytes: self._on_task_done(f, fut, b))
+
+    def _on_task_done(self, inner, future, estimated_bytes):
+        with self._lock:
+            self._running -= 1
+            self._running_bytes -= estimated_bytes
+            self._dispatch()
+        if inner.cancelled():
+            future.set_exception(RuntimeError("Chapter task was cancelled"))
+        elif inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
@@ -0,0 +1,114 @@
+"""
+InterLivre, audiobook splicer
+
+Virtual chapter sharding for books that arrive as a single long file per language
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import wave
+import numpy as np
+from scipy.io import wavfile as wav
+from os.path import join as pjoin
+import utils
+
+
+class ChapterSharder:
+    """Splits a pair of long recordings into matching virtual chapters at long silences.
+
+    Cut points are placed at the same relative positions in both books and then moved to the middle of the longest
+    silence found nearby, so each pair of shards covers roughly the same part of the story. Shards are cut in silence,
+    which means the interleaved shards can be concatenated back together without audible seams.
+
+    Attributes:
+        shard_seconds (int): Target length of each virtual chapter in seconds.
+        search_seconds (int): Distance in seconds on either side of each target position to search for silence.
+        sample_rate (int): Sample rate of the wav files being sharded.
+        noise_threshold (int): Samples below this amplitude count as silence, see Interleaver.noise_threshold.
+    """
+
+    def __init__(self, noise_threshold, shard_seconds=1800, search_seconds=60, sample_rate=48000):
+        self.noise_threshold = noise_threshold
+        self.shard_seconds = shard_seconds
+        self.search_seconds = search_seconds
+        self.sample_rate = sample_rate
+
+    def shard_count(self, src1_len, src2_len):
+        """Returns the number of virtual chapters to split both sources into, based on the shorter source."""
+        shard_len = self.shard_seconds * self.sample_rate
+        return max(1, int(round(min(src1_len, src2_len) / shard_len)))
+
+    def find_cut_points(self, buffer, shard_count):
+        """Finds the indices at which to split buffer into shard_count virtual chapters.
+
+        Args:
+            buffer (np.array): Audio data.
+            shard_count (int): Number of virtual chapters to create.
+
+        Returns:
+            list(int): Sorted cut indices, including 0 and len(buffer).
+        """
+        search_len = self.search_seconds * self.sample_rate
+        cut_points = [0]
+        for k in range(1, shard_count):
+            target = int(len(buffer) * k / shard_count)
+            window_start = max(target - search_len, cut_points[-1] + 1)
+            window_end = min(target + search_len, len(buffer))
+            silence = utils.find_longest_silence(buffer, self.noise_threshold, window_start, window_end)
+            if silence is None:
+                # No quiet moment nearby, fall back to the target itself
+                cut_points.append(target)
+            else:
+                cut_points.append((silence[0] + silence[1]) // 2)
+        cut_points.append(len(buffer))
+        return cut_points
+
+    def shard(self, src_path, dst_dir, shard_count, prefix="tmp_shard"):
+        """Splits a wav file on disk into shard_count wav files.
+
+        Args:
+            src_path (str): Path to the wav file to split.
+            dst_dir (str): Directory in which to write the shards.
+            shard_count (int): Number of virtual chapters to create.
+            prefix (str): Filename prefix for the shards.
+
+        Returns:
+            list(str): Paths to the shards, in order.
+        """
+        file_sr, buf = wav.read(src_path, mmap=True)
+        cut_points = self.find_cut_points(buf, shard_count)
+        res = []
+        for i in range(0, len(cut_points) - 1):
+            shard_path = pjoin(dst_dir, f"{prefix}_{i + 1:04d}.wav")
+            wav.write(shard_path, file_sr, np.asarray(buf[cut_points[i]:cut_points[i + 1]]))
+            res.append(shard_path)
+        return res
+
+    def shard_pair(self, src_path_1, src_path_2, dst_dir_1, dst_dir_2):
+        """Splits the two sources of a single-file book into the same number of matching virtual chapters.
+
+        Returns:
+            A tuple containing the list of shard paths for source 1 and the list of shard paths for source 2.
+        """
+        _, buf1 = wav.read(src_path_1, mmap=True)
+        _, buf2 = wav.read(src_path_2, mmap=True)
+        shard_count = self.shard_count(len(buf1), len(buf2))
+        del buf1, buf2
+        return self.shard(src_path_1, dst_dir_1, shard_count), self.shard(src_path_2, dst_dir_2, shard_count)
+
+    def stitch(self, shard_paths, dst_path):
+        """Concatenates interleaved shards back into a single 16 bit wav file.
+
+        Shards were cut in silence, so they are joined end to end without any crossfade. Shards are streamed to disk
+        one at a time to avoid holding the whole book in memory.
+        """
+        with wave.open(dst_path, 'wb') as out:
+            for i, p in enumerate(shard_paths):
+                file_sr, buf = wav.read(p, mmap=True)
+                if i == 0:
+                    out.setnchannels(1 if buf.ndim == 1 else buf.shape[1])
+                    out.setsampwidth(2)
+                    out.setframerate(file_sr)
+                out.writeframes(np.ascontiguousarray(buf, dtype=np.int16).tobytes())
@@ -0,0 +1,192 @@
+"""
+InterLivre, audiobook splicer
+
+Silence analysis of source audio, saved as compact binary sidecars so it can be reused between runs
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import logging
+import os
+import struct
+import time
+from os.path import join as pjoin
+from uuid import uuid4
+import numpy as np
+import metrics
+import utils
+
+ANALYSIS_DIRECTORY = "analysis"
+# Quiet runs shorter than this are gaps within speech, not pauses worth splitting at
+MIN_SILENCE_SECONDS = 0.05
+SIDECAR_EXTENSION = "silence"
+# Samples scanned between checks for cancellation, one minute of 48 kHz audio
+SCAN_CHUNK_SAMPLES = 48000 * 60
+_MAGIC = b"ILSM"
+_VERSION = 1
+# magic, version, threshold, buffer length, speech start, speech end, run count
+_HEADER = struct.Struct("<4sHiqqqq")
+
+
+class SilenceMap:
+    """Quiet regions and speech boundaries of one audio source at one noise threshold.
+
+    Only depends on the audio and the threshold, so the same map serves any segment sizes and any pairing with
+    another book.
+
+    Attributes:
+        length (int): Number of samples in the source.
+        threshold (int): Noise gate threshold the map was made with.
+        speech_start (int): Index of the first sample over the threshold, or -1 if there is none.
+        speech_end (int): Index of the last sample over the threshold, or 0 if there is none.
+        run_starts (np.array): Start index (inclusive) of each quiet run.
+        run_ends (np.array): End index (exclusive) of each quiet run.
+    """
+
+    def __init__(self, length, threshold, speech_start, speech_end, run_starts, run_ends):
+        self.length = length
+        self.threshold = threshold
+        self.speech_start = speech_start
+        self.speech_end = speech_end
+        self.run_starts = np.asarray(run_starts, dtype=np.int64)
+        self.run_ends = np.asarray(run_ends, dtype=np.int64)
+
+    @classmethod
+    def analyze(cls, buffer, threshold, min_run_samples=1, cancel=None):
+        """Scans a buffer of audio once and returns its SilenceMap.
+
+        Args:
+            buffer (np.array): Audio data.
+            threshold (int): Noise gate threshold.
+            min_run_samples (int): Quiet runs shorter than this aren't kept.
+            cancel: Event checked between chunks of the scan. May be None.
+
+        Returns:
+            SilenceMap: The analysis, or None if cancelled.
+        """
+        length = len(buffer)
+        scan_start = time.perf_counter()
+        run_starts, run_ends = cls.scan(buffer, threshold, cancel)
+        if run_starts is None:
+            return None
+        scan_seconds = time.perf_counter() - scan_start
+        metrics.counter("silence_samples_scanned_total", "Samples scanned for silence").inc(length)
+        metrics.counter("silence_scan_seconds_total", "Seconds spent scanning for silence").inc(scan_seconds)
+        if scan_seconds > 0:
+            metrics.histogram("silence_scan_samples_per_second", "Samples scanned for silence per second of each scan",
+                              metrics.SCAN_RATE_BUCKETS).observe(length / scan_seconds)
+        if len(run_starts) == 1 and run_starts[0] == 0 and run_ends[0] == length:
+            speech_start, speech_end = -1, 0
+        else:
+            speech_start = int(run_ends[0]) if len(run_starts) > 0 and run_starts[0] == 0 else 0
+            speech_end = int(run_starts[-1]) - 1 if len(run_ends) > 0 and run_ends[-1] == length else length - 1
+        keep = (run_ends - run_starts) >= min_run_samples
+        return cls(length, threshold, speech_start, speech_end, run_starts[keep], run_ends[keep])
+
+    @classmethod
+    def scan(cls, buffer, threshold, cancel=None):
+        """Finds every quiet run in a buffer, a chunk at a time so a cancelled job doesn't wait for the whole scan.
+
+        Returns:
+            Two numpy arrays containing the start (inclusive) and end (exclusive) index of each run, or (None, None)
+            if cancelled.
+        """
+        starts, ends = [], []
+        for chunk_start in range(0, len(buffer), SCAN_CHUNK_SAMPLES):
+            if utils.is_cancelled(cancel):
+                return None, None
+            s, e = utils.find_silent_runs(buffer, threshold, chunk_start, min(chunk_start + SCAN_CHUNK_SAMPLES,
+                                                                              len(buffer)))
+            if len(s) > 0 and len(ends) > 0 and ends[-1][-1] == s[0]:
+                # Join the run that crosses the chunk boundary
+                ends[-1][-1] = e[0]
+                s, e = s[1:], e[1:]
+            if len(s) > 0:
+                starts.append(s)
+                ends.append(e)
+        if len(starts) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(starts), np.concatenate(ends)
+
+    def longest_silence(self, start, end):
+        """Finds the longest quiet run within [start, end).
+
+        Returns:
+            A tuple containing the start, middle, and end indices of the longest quiet run, or (start, start, start)
+            if there isn't one.
+        """
+        lo = int(np.searchsorted(self.run_ends, start, side='right'))
+        hi = int(np.searchsorted(self.run_starts, end, side='left'))
+        if hi <= lo:
+            return start, start, start
+        starts = np.maximum(self.run_starts[lo:hi], start)
+        ends = np.minimum(self.run_ends[lo:hi], end)
+        k = int(np.argmax(ends - starts))
+        run_start, run_end = int(starts[k]), int(ends[k])
+        return run_start, (run_end - run_start) // 2 + run_start, run_end
+
+    def to_bytes(self):
+        header = _HEADER.pack(_MAGIC, _VERSION, self.threshold, self.length, self.speech_start, self.speech_end,
+                              len(self.run_starts))
+        return header + self.run_starts.astype('<i8').tobytes() + self.run_ends.astype('<i8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Returns a SilenceMap from bytes written by to_bytes().
+
+        Raises:
+            ValueError: If the data isn't a valid silence map.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("Truncated silence map")
+        magic, version, threshold, length, speech_start, speech_end, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION or len(data) != _HEADER.size + 16 * count:
+            raise ValueError("Invalid silence map")
+        runs = np.frombuffer(data, dtype='<i8', offset=_HEADER.size).astype(np.int64)
+        return cls(length, threshold, speech_start, speech_end, runs[:count], runs[count:])
+
+
+class SilenceMapCache:
+    """Directory of SilenceMap sidecars keyed by a fingerprint of the source and the noise threshold.
+
+    Attributes:
+        root (str): Directory holding the sidecars.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def sidecar_path(self, src_path, threshold):
+        return pjoin(self.root, f"{utils.fingerprint_file(src_path)}-{threshold}.{SIDECAR_EXTENSION}")
+
+    def get_or_analyze(self, src_path, buffer, threshold, min_run_samples=1, cancel=None):
+        """Returns the SilenceMap of a source file, analyzing the buffer read from it and saving it on a miss.
+
+        Returns None if cancelled during the analysis.
+        """
+        path = self.sidecar_path(src_path, threshold)
+        try:
+            with open(path, 'rb') as f:
+                silence_map = SilenceMap.from_bytes(f.read())
+            if silence_map.length == len(buffer):
+                metrics.counter("silence_map_cache_total", "Silence map sidecar lookups").inc(result="hit")
+                return silence_map
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.exception(e)
+        metrics.counter("silence_map_cache_total", "Silence map sidecar lookups").inc(result="miss")
+        silence_map = SilenceMap.analyze(buffer, threshold, min_run_samples, cancel)
+        if silence_map is None:
+            return None
+        tmp_path = f"{path}.{uuid4().hex}.part"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(silence_map.to_bytes())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.exception(e)
+        return silence_map
@@ -0,0 +1,143 @@
+"""
+InterLivre, audiobook splicer
+
+Start up profiling: times every module import and reports how long it took to get to the first window or the
+command line being ready. Enabled with --startup-profile.
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import sys
+import time
+
+STARTUP_PROFILE_FLAG = "--startup-profile"
+# Number of imports listed in the report
+REPORT_TOP_IMPORTS = 15
+
+_profile = None
+
+
+class _TimedLoader:
+    """Wraps a module loader to time how long executing the module takes."""
+
+    def __init__(self, profile, loader):
+        self.profile = profile
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.profile.begin_import()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profile.end_import(module.__name__)
+
+
+class _TimingFinder:
+    """Meta path finder that wraps the loader of every module found by the rest of sys.meta_path."""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(self.profile, spec.loader)
+                return spec
+        return None
+
+
+class StartupProfile:
+    """Collects import times and named checkpoints from the moment it's created.
+
+    Import times are kept both including and excluding the modules each import pulled in, like python -X importtime.
+
+    Attributes:
+        start (float): perf_counter() value when profiling began.
+        imports (dict): Module name to a list of [self seconds, cumulative seconds].
+        marks (list(tuple)): (label, seconds since start) for each checkpoint.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.imports = {}
+        self.marks = []
+        self._stack = []
+        self._finder = _TimingFinder(self)
+
+    def install(self):
+        sys.meta_path.insert(0, self._finder)
+
+    def uninstall(self):
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    def begin_import(self):
+        # [start time, seconds spent in nested imports]
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def end_import(self, name):
+        began, nested = self._stack.pop()
+        elapsed = time.perf_counter() - began
+        self.imports[name] = [elapsed - nested, elapsed]
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def mark(self, label):
+        self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self, top=REPORT_TOP_IMPORTS):
+        """Returns the profile as human readable text."""
+        lines = [f"Start up profile, {len(self.imports)} modules imported"]
+        lines += [f"  {seconds * 1000.0:8.1f} ms  {label}" for label, seconds in self.marks]
+        lines.append("Slowest imports (self ms, cumulative ms):")
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        lines += [f"  {s * 1000.0:8.1f} {c * 1000.0:8.1f}  {name}" for name, (s, c) in slowest]
+        return "\n".join(lines)
+
+
+def enable(argv=None):
+    """Starts profiling if argv contains --startup-profile, and removes the flag from argv.
+
+    Args:
+        argv (list(str)): Command line to check, defaults to sys.argv.
+
+    Returns:
+        bool: True if profiling is on.
+    """
+    global _profile
+    argv = sys.argv if argv is None else argv
+    if STARTUP_PROFILE_FLAG in argv:
+        argv.remove(STARTUP_PROFILE_FLAG)
+        if _profile is None:
+            _profile = StartupProfile()
+            _profile.install()
+    return _profile is not None
+
+
+def mark(label):
+    """Records a checkpoint. Does nothing unless profiling is on."""
+    if _profile is not None:
+        _profile.mark(label)
+
+
+def finish(label):
+    """Records the final checkpoint, stops profiling and prints the report to stderr."""
+    global _profile
+    if _profile is None:
+        return
+    _profile.mark(label)
+    _profile.uninstall()
+    print(_profile.report(), file=sys.stderr)
+    _profile = None
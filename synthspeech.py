@@ -0,0 +1,161 @@
+"""
+InterLivre, audiobook splicer
+
+Deterministic speech-like test signals for benchmarks, so performance can be measured without real audiobooks
+
+Example:
+    speech = SyntheticSpeech(3600, pause_distribution='exponential', noise_floor=80, seed=7)
+    buffer = speech.samples()
+    speech.write("chapter.wav")
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import wave
+import numpy as np
+
+# Pause length distributions, each draws count pause lengths in seconds with the given mean and spread
+PAUSE_DISTRIBUTIONS = {
+    'exponential': lambda rng, mean, spread, count: rng.exponential(mean, count),
+    'lognormal': lambda rng, mean, spread, count: rng.lognormal(np.log(mean) - spread ** 2 / 2, spread, count),
+    'uniform': lambda rng, mean, spread, count: rng.uniform(mean * (1 - spread), mean * (1 + spread), count),
+}
+# Syllables per second, sets how fast the loudness of a burst wobbles
+SYLLABLE_RATE = 4.0
+# Seconds of audio generated at a time, keeps memory flat for 10 hour signals
+WRITE_BLOCK_SECONDS = 60
+
+
+class SyntheticSpeech:
+    """Bursts of voice-like harmonics separated by pauses, on top of a constant noise floor.
+
+    The same arguments always produce the same samples, whichever block of the signal is asked for first, so long
+    signals can be generated a block at a time.
+
+    Attributes:
+        seconds (float): Length of the signal.
+        sample_rate (int): Samples per second.
+        channels (int): 1 for mono or 2 for stereo.
+        length (int): Length of the signal in samples.
+        burst_starts (np.array): Start index (inclusive) of each burst of speech.
+        burst_ends (np.array): End index (exclusive) of each burst of speech.
+        pitches (np.array): Fundamental frequency of each burst in Hz.
+    """
+
+    def __init__(self, seconds, sample_rate=48000, channels=1, seed=0, burst_seconds=(0.5, 6.0),
+                 pause_distribution='lognormal', pause_seconds=0.6, pause_spread=0.8, noise_floor=60,
+                 speech_level=9000):
+        """
+        Args:
+            seconds (float): Length of the signal.
+            sample_rate (int): Samples per second.
+            channels (int): 1 for mono or 2 for stereo.
+            seed (int): Seed for every random choice.
+            burst_seconds (tuple): Shortest and longest burst of speech, drawn uniformly.
+            pause_distribution (str): Key of PAUSE_DISTRIBUTIONS.
+            pause_seconds (float): Mean pause length.
+            pause_spread (float): Spread of the pause lengths, see PAUSE_DISTRIBUTIONS.
+            noise_floor (int): Standard deviation of the background noise in 16 bit sample units.
+            speech_level (int): Peak amplitude of the speech in 16 bit sample units.
+
+        Raises:
+            ValueError: If pause_distribution is unknown.
+        """
+        if pause_distribution not in PAUSE_DISTRIBUTIONS:
+            raise ValueError(f"Unknown pause distribution '{pause_distribution}', "
+                             f"expected one of {', '.join(PAUSE_DISTRIBUTIONS)}")
+        self.seconds = seconds
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.seed = seed
+        self.noise_floor = noise_floor
+        self.speech_level = speech_level
+        self.length = int(round(seconds * sample_rate))
+
+        # Lay out the bursts and pauses up front, a generous guess at the count is cheaper than growing the arrays
+        rng = np.random.default_rng([seed, 0])
+        mean_cycle = (burst_seconds[0] + burst_seconds[1]) / 2 + pause_seconds
+        count = int(seconds / mean_cycle * 1.5) + 16
+        starts, ends, pitches = [], [], []
+        pos = 0
+        while pos < self.length:
+            bursts = rng.uniform(burst_seconds[0], burst_seconds[1], count)
+            pauses = np.maximum(PAUSE_DISTRIBUTIONS[pause_distribution](rng, pause_seconds, pause_spread, count), 0)
+            cycle = np.round(np.column_stack((pauses, bursts)) * sample_rate).astype(np.int64).ravel()
+            edges = pos + np.cumsum(cycle)
+            starts.append(edges[0::2])
+            ends.append(edges[1::2])
+            # Fundamental frequency of each burst, in the range of adult voices
+            pitches.append(rng.uniform(90.0, 240.0, count))
+            pos = int(edges[-1])
+        self.burst_starts = np.concatenate(starts)
+        self.burst_ends = np.minimum(np.concatenate(ends), self.length)
+        keep = self.burst_starts < self.length
+        self.burst_starts = self.burst_starts[keep]
+        self.burst_ends = self.burst_ends[keep]
+        self.pitches = np.concatenate(pitches)[:len(self.burst_starts)]
+
+    def _noise(self, start, end):
+        """Returns the noise floor for [start, end), drawn one second at a time so any block gives the same values."""
+        first = start // self.sample_rate
+        last = (end - 1) // self.sample_rate
+        seconds = [np.random.default_rng([self.seed, 1, s]).standard_normal(self.sample_rate * self.channels,
+                                                                             dtype=np.float32)
+                   for s in range(first, last + 1)]
+        noise = np.concatenate(seconds)
+        noise = noise.reshape(-1, self.channels) * np.float32(self.noise_floor)
+        offset = start - first * self.sample_rate
+        return noise[offset:offset + end - start]
+
+    def samples(self, start=0, end=None):
+        """Returns samples [start, end) of the signal.
+
+        Returns:
+            np.array: int16 samples, shaped (n,) for mono and (n, 2) for stereo.
+        """
+        end = self.length if end is None else min(end, self.length)
+        shape = (max(end - start, 0),) if self.channels == 1 else (max(end - start, 0), self.channels)
+        audio = np.empty(shape, dtype=np.int16)
+        # Render a block at a time so the float work arrays stay small
+        block = WRITE_BLOCK_SECONDS * self.sample_rate
+        for block_start in range(start, end, block):
+            block_end = min(block_start + block, end)
+            audio[block_start - start:block_end - start] = self._render(block_start, block_end)
+        return audio
+
+    def _render(self, start, end):
+        idx = np.arange(start, end, dtype=np.int64)
+
+        # Find the burst each sample falls in, if any
+        burst = np.searchsorted(self.burst_starts, idx, side='right') - 1
+        valid = burst >= 0
+        burst_clipped = np.maximum(burst, 0)
+        in_burst = valid & (idx < self.burst_ends[burst_clipped])
+
+        # A few harmonics of the burst's pitch, with a syllable envelope that fades in and out of silence.
+        # Phases are taken from the start of each burst so float32 keeps enough precision for 10 hour signals.
+        since_start = ((idx - self.burst_starts[burst_clipped]) / self.sample_rate).astype(np.float32)
+        phase = np.float32(2 * np.pi) * self.pitches[burst_clipped].astype(np.float32) * since_start
+        s1 = np.sin(phase)
+        c1 = np.cos(phase)
+        # sin(x) + sin(2x) / 2 + sin(3x) / 4, using the double and triple angle formulas
+        voice = s1 * (np.float32(1.75) + c1 - s1 * s1)
+        envelope = np.float32(0.5) - np.float32(0.5) * np.cos(np.float32(2 * np.pi * SYLLABLE_RATE) * since_start)
+        speech = np.where(in_burst, voice * envelope * np.float32(self.speech_level / 1.75), np.float32(0))
+
+        audio = speech[:, np.newaxis] + self._noise(start, end)
+        audio = np.clip(np.round(audio), -32768, 32767).astype(np.int16)
+        return audio[:, 0] if self.channels == 1 else audio
+
+    def write(self, path):
+        """Writes the signal to a 16 bit wav file a block at a time."""
+        block = WRITE_BLOCK_SECONDS * self.sample_rate
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(self.channels)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            for start in range(0, self.length, block):
+                f.writeframes(self.samples(start, start + block).astype('<i2').tobytes())
+        return path
@@ -0,0 +1,238 @@
+"""
+InterLivre, audiobook splicer
+
+Lightweight timing spans around the pipeline stages, exported as Chrome trace-event JSON for Perfetto or
+chrome://tracing
+
+The active Tracer is a context variable, so each thread or asyncio task traces into its own one and concurrent
+traced runs in one process keep their events apart.
+
+Example:
+    tracing.enable(trace_dir)
+    with tracing.span("segment", chapter="book_01.wav", source=1):
+        ...
+    tracing.export_chrome_trace(trace_dir, "trace.json")
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from os.path import isdir, join as pjoin
+from uuid import uuid4
+
+TRACE_DIRECTORY = "trace"
+TRACE_EXTENSION = "trace.jsonl"
+
+_tracer = contextvars.ContextVar("tracer", default=None)
+
+
+class _NullSpan:
+    """Span used while tracing is off. Does nothing, and a single instance is shared by every call."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """Times a block of code and records it as a complete ('X') trace event when the block exits."""
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self._ts = 0
+        self._start = 0
+
+    def __enter__(self):
+        self._ts = time.time_ns() // 1000
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        dur = (time.perf_counter_ns() - self._start) // 1000
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add({"name": self.name, "cat": self.cat, "ph": "X", "ts": self._ts, "dur": dur,
+                         "pid": os.getpid(), "tid": threading.get_native_id(), "args": self.args})
+        return False
+
+    def set(self, **args):
+        """Adds tags to the span, e.g. results only known once the work is done."""
+        self.args.update(args)
+
+
+class Tracer:
+    """Collects trace events for this process, or for one run in it.
+
+    Events stay in memory until flush() appends them to a file of their own in trace_dir, so the chapter worker
+    processes can each write theirs and export_chrome_trace() can join them up afterwards.
+
+    Attributes:
+        trace_dir (str): Directory the events are flushed to, or None to keep them in memory only.
+        events (list(dict)): Events recorded since the last flush.
+    """
+
+    def __init__(self, trace_dir=None):
+        self.trace_dir = trace_dir
+        self.events = []
+        self._lock = threading.Lock()
+        self._path = None
+        if trace_dir is not None:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    def add(self, event):
+        # list.append is atomic, the lock is only needed to swap the list out in flush()
+        self.events.append(event)
+
+    def flush(self):
+        """Appends the events recorded so far to this process's file in trace_dir."""
+        if self.trace_dir is None:
+            return
+        with self._lock:
+            events, self.events = self.events, []
+            if len(events) == 0:
+                return
+            if self._path is None:
+                self._path = pjoin(self.trace_dir, f"{os.getpid()}-{uuid4().hex[:8]}.{TRACE_EXTENSION}")
+            try:
+                with open(self._path, 'a') as f:
+                    f.writelines(json.dumps(e) + "\n" for e in events)
+            except OSError as e:
+                logging.exception(e)
+
+
+def enable(trace_dir=None):
+    """Turns tracing on in the current context, i.e. this thread or asyncio task.
+
+    Args:
+        trace_dir (str): Directory to flush events to, or None to keep them in memory.
+
+    Returns:
+        Tracer: The active tracer. If tracing was already on, it's left as it was.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        tracer = Tracer(trace_dir)
+        _tracer.set(tracer)
+    return tracer
+
+
+def disable():
+    """Flushes any remaining events and turns tracing off in the current context."""
+    tracer = _tracer.get()
+    if tracer is not None:
+        tracer.flush()
+        _tracer.set(None)
+
+
+def is_enabled():
+    return _tracer.get() is not None
+
+
+def get_tracer():
+    """Returns the active Tracer, or None if tracing is off."""
+    return _tracer.get()
+
+
+@contextlib.contextmanager
+def use(tracer):
+    """Makes tracer the active Tracer within the block, e.g. for one traced run among others in the same process.
+
+    The tracer isn't flushed on exit.
+    """
+    token = _tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _tracer.reset(token)
+
+
+def bind(fn):
+    """Returns fn wrapped to trace into the caller's active Tracer, for work handed to another thread.
+
+    Threads don't inherit the active Tracer, so spans recorded by work submitted to an executor are lost without this.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with use(tracer):
+            return fn(*args, **kwargs)
+    return run
+
+
+def span(name, cat="pipeline", **args):
+    """Returns a context manager that records the time spent in its block as a trace event.
+
+    Costs a context variable lookup and returns a shared no-op object while tracing is off.
+
+    Args:
+        name (str): Name of the event, e.g. the stage.
+        cat (str): Category of the event, used to filter events in the trace viewer.
+        args: Tags shown with the event, e.g. chapter and source.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, cat, args)
+
+
+def flush():
+    """Writes the active Tracer's events to its trace directory. Does nothing while tracing is off."""
+    tracer = _tracer.get()
+    if tracer is not None:
+        tracer.flush()
+
+
+def load_events(trace_dir):
+    """Returns every event flushed to trace_dir by any process."""
+    events = []
+    if not isdir(trace_dir):
+        return events
+    for f in sorted(os.listdir(trace_dir)):
+        if not f.endswith(TRACE_EXTENSION):
+            continue
+        try:
+            with open(pjoin(trace_dir, f)) as fp:
+                events += [json.loads(line) for line in fp if line.strip()]
+        except (OSError, ValueError) as e:
+            logging.exception(e)
+    return events
+
+
+def export_chrome_trace(events, path):
+    """Writes trace events as a Chrome trace-event JSON file that Perfetto or chrome://tracing can open.
+
+    Args:
+        events (list(dict) or str): Events, or a trace directory to load them from.
+        path (str): Path to write the trace to.
+    """
+    if isinstance(events, str):
+        events = load_events(events)
+    # Name the processes so the chapter workers are easy to tell apart from the coordinating process
+    pids = sorted({e["pid"] for e in events})
+    first_pid = min(pids, key=lambda pid: min(e["ts"] for e in events if e["pid"] == pid)) if pids else None
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                 "args": {"name": "InterLivre" if pid == first_pid else f"Chapter worker {pid}"}} for pid in pids]
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": metadata + sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}, f)
+    return path
@@ -10,16 +10,27 @@ InterLivreApp@gmail.com
 
 import logging
 import sys
-from os import listdir, pardir
+from os import listdir, pardir, scandir, stat
 from os.path import isfile, abspath, basename, join as pjoin
-from numpy import linspace
+from hashlib import blake2b
 
 
 # region files
 def list_files_with_extension(dir_path, extension):
     """Returns a list of files in a directory with the given extension."""
-    file_list = list_files(dir_path)
-    return [f for f in file_list if f.split('.')[-1] == extension]
+    return scan_files(dir_path, [extension])
+
+
+def scan_files(dir_path, extensions):
+    """Returns a list of files in a directory with any of the given extensions.
+
+    Reads the directory in a single scandir pass, which usually knows each entry's type without a stat call.
+    """
+    if dir_path is None or dir_path == "":
+        return []
+    extensions = set(extensions)
+    with scandir(dir_path) as entries:
+        return [e.name for e in entries if e.name.split('.')[-1] in extensions and e.is_file()]
 
 
 def list_files(dir_path):
@@ -43,6 +54,34 @@ def strip_extension(file_path):
 def get_parent_directory(file_path):
     """Strips the last element from a path"""
     return abspath(pjoin(file_path, pardir))
+
+
+def fingerprint_file(file_path, chunk_size=1024 * 1024):
+    """Returns a fast fingerprint of a file as a hex string.
+
+    Hashes chunks from the start, middle and end of the file instead of the whole file, which is enough to tell
+    audio files apart without reading hours of audio. An edit that keeps the size and misses the chunks would go
+    unnoticed, so the file's size, modification time and inode are hashed too, like the probe cache keys its
+    entries. A file that's rewritten or copied gets a new fingerprint even if its content is the same.
+    """
+    h = blake2b(digest_size=16)
+    st = stat(file_path)
+    size = st.st_size
+    h.update(f"{size}-{st.st_mtime_ns}-{st.st_ino}".encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        for offset in sorted(set([0, max(0, size // 2 - chunk_size // 2), max(0, size - chunk_size)])):
+            f.seek(offset)
+            h.update(f.read(chunk_size))
+    return h.hexdigest()
+
+
+def checksum_file(file_path, chunk_size=1024 * 1024):
+    """Returns the blake2b checksum of a whole file as a hex string."""
+    h = blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
 # endregion
 
 
@@ -61,10 +100,47 @@ def float_to_int16(x):
 
 def apply_lin_env(buffer, start, end, start_gain, end_gain):
     """Applies a linear envelope to buffer in place from [start, end)."""
+    import numpy as np
     fade_time = end - start
-    env = linspace(start_gain, end_gain, num=fade_time)
-    for i in range(0, fade_time):
-        buffer[i + start] *= env[i]
+    env = np.linspace(start_gain, end_gain, num=fade_time)
+    if buffer.ndim > 1:
+        # One gain per frame, applied to every channel
+        env = env[:, np.newaxis]
+    buffer[start:end] = buffer[start:end] * env
+
+
+def find_silent_runs(buffer, threshold, start=0, end=None):
+    """Finds every run of samples below the amplitude threshold in buffer[start:end].
+
+    Stereo buffers are treated as silent only where both channels are below the threshold.
+
+    Args:
+        buffer (np.array): Audio data.
+        threshold (int): Noise gate threshold.
+        start (int): Index in buffer to begin search.
+        end (int): Index in buffer to stop search.
+
+    Returns:
+        Two numpy arrays containing the start (inclusive) and end (exclusive) indices in buffer of each silent run.
+    """
+    import numpy as np
+    if end is None:
+        end = len(buffer)
+    window = np.abs(np.asarray(buffer[start:end], dtype=np.int32))
+    if window.ndim == 2:
+        window = window.max(axis=1)
+    quiet = np.concatenate(([False], window < threshold, [False]))
+    edges = np.flatnonzero(quiet[1:] != quiet[:-1])
+    return edges[0::2] + start, edges[1::2] + start
+
+
+def find_longest_silence(buffer, threshold, start=0, end=None):
+    """Returns (start, end) indices of the longest run of samples below threshold in buffer[start:end], or None."""
+    run_starts, run_ends = find_silent_runs(buffer, threshold, start, end)
+    if len(run_starts) == 0:
+        return None
+    k = int((run_ends - run_starts).argmax())
+    return int(run_starts[k]), int(run_ends[k])
 
 # endregion
 
@@ -0,0 +1,241 @@
+"""
+InterLivre, audiobook splicer
+
+Headless watch-folder mode that interleaves book pairs as they are dropped into an inbox
+
+Each book goes in its own folder in the inbox, holding one folder of chapters per recording. Folders are taken in
+alphabetical order as book 1 and book 2 unless the book folder has an interlivre.json file with JobSettings to use
+for that book. Output goes to a folder with the same name in the outbox.
+
+Example:
+    python watchfolder.py INBOX OUTBOX --settings defaults.json --books 2
+
+Copyright (C) 2024 VimHalen
+See LICENSE for license information.
+InterLivreApp@gmail.com
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, isdir, isfile, join as pjoin
+from pipeline import JobSettings, Pipeline
+from preflight import PreflightError
+from scheduler import ChapterScheduler
+import metrics
+import utils
+
+BOOK_SETTINGS_FILENAME = "interlivre.json"
+# A book is queued once none of its audio files have changed for this long
+SETTLE_SECONDS = 30
+POLL_SECONDS = 5
+INPUT_FILE_FORMATS = ['wav', 'mp3']
+
+
+class _LogStatusQueue:
+    """Logs the status messages of one book, skipping progress-only updates."""
+
+    def __init__(self, name):
+        self.name = name
+        self.last_msg = None
+
+    def put(self, status):
+        progress, msg = status
+        if msg != self.last_msg and not msg.startswith("Processing chapters") and \
+                not msg.startswith("Converting file"):
+            logging.info(f"{self.name}: {msg}")
+        self.last_msg = msg
+
+
+class WatchFolder:
+    """Watches an inbox for book pairs and interleaves each one once its files stop changing.
+
+    Books run in a pool of threads, and their chapters share one ChapterScheduler so the number of worker processes
+    and the memory budget hold across every book. A book is queued again whenever its files change and settle, and
+    the output manifest makes sure only new or changed chapters are processed.
+
+    Attributes:
+        inbox (str): Directory to watch.
+        outbox (str): Directory to write each book's output folder into.
+        base_settings (JobSettings): Settings for every book, before the book's own interlivre.json is applied.
+        settle_seconds (float): How long a book's files must stay unchanged before it's queued.
+        poll_seconds (float): Time between scans of the inbox.
+        metrics_textfile (str): Path the metrics are written to for the node exporter after each book, or None.
+    """
+
+    def __init__(self, inbox, outbox, base_settings=None, settle_seconds=SETTLE_SECONDS, poll_seconds=POLL_SECONDS,
+                 max_books=1, metrics_textfile=None):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.base_settings = base_settings if base_settings is not None else JobSettings()
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.metrics_textfile = metrics_textfile
+        self.cancel_event = threading.Event()
+        self.chapter_scheduler = ChapterScheduler(memory_budget=self.base_settings.memory_budget,
+                                                  max_workers=self.base_settings.max_jobs)
+        self._executor = ThreadPoolExecutor(max_workers=max_books, thread_name_prefix="InterLivreBook")
+        self._lock = threading.Lock()
+        # Book directory -> (snapshot, time it last changed)
+        self._changes = {}
+        # Book directory -> snapshot that was last processed, whether it succeeded or not
+        self._processed = {}
+        # Book directory -> future of the running or queued job
+        self._jobs = {}
+
+    def find_books(self):
+        """Returns the book directories in the inbox that hold exactly two folders of chapters."""
+        books = []
+        for name in sorted(os.listdir(self.inbox), key=str.lower):
+            path = pjoin(self.inbox, name)
+            if not name.startswith('.') and isdir(path) and len(self.get_book_dirs(path)) == 2:
+                books.append(path)
+        return books
+
+    def get_book_dirs(self, book_dir):
+        """Returns the chapter folders of a book, in alphabetical order."""
+        return sorted([pjoin(book_dir, d) for d in os.listdir(book_dir)
+                       if not d.startswith('.') and isdir(pjoin(book_dir, d))], key=str.lower)
+
+    def snapshot(self, book_dir):
+        """Returns the (path, size, mtime) of every audio file and the settings file of a book."""
+        res = []
+        paths = [pjoin(book_dir, BOOK_SETTINGS_FILENAME)]
+        for src_dir in self.get_book_dirs(book_dir):
+            paths += [pjoin(src_dir, f) for f in utils.scan_files(src_dir, INPUT_FILE_FORMATS)]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            res.append((path, st.st_size, st.st_mtime_ns))
+        return tuple(sorted(res))
+
+    def get_job_settings(self, book_dir):
+        """Returns the JobSettings for a book, with its own interlivre.json applied over the base settings."""
+        d = self.base_settings.to_dict()
+        src_dirs = self.get_book_dirs(book_dir)
+        d.update({"src1_dir": src_dirs[0], "src2_dir": src_dirs[1], "dst_dir": pjoin(self.outbox, basename(book_dir)),
+                  "dst_name": basename(book_dir), "src_files_selected": None})
+        settings_path = pjoin(book_dir, BOOK_SETTINGS_FILENAME)
+        if isfile(settings_path):
+            with open(settings_path) as f:
+                overrides = json.load(f)
+            # Relative source folders are inside the book folder
+            for key in ("src1_dir", "src2_dir"):
+                if key in overrides:
+                    overrides[key] = pjoin(book_dir, overrides[key])
+            d.update(overrides)
+        return JobSettings.from_dict(d)
+
+    def poll(self):
+        """Scans the inbox once and queues every book whose files have settled since it was last processed.
+
+        Returns:
+            list(str): Book directories queued by this scan.
+        """
+        now = time.monotonic()
+        queued = []
+        for book_dir in self.find_books():
+            snapshot = self.snapshot(book_dir)
+            with self._lock:
+                if book_dir in self._jobs:
+                    continue
+                previous = self._changes.get(book_dir)
+                if previous is None or previous[0] != snapshot:
+                    self._changes[book_dir] = (snapshot, now)
+                    continue
+                if now - previous[1] < self.settle_seconds or self._processed.get(book_dir) == snapshot:
+                    continue
+                self._jobs[book_dir] = self._executor.submit(self._run_book, book_dir, snapshot)
+            queued.append(book_dir)
+        return queued
+
+    def _run_book(self, book_dir, snapshot):
+        name = basename(book_dir)
+        result = "failed"
+        try:
+            settings = self.get_job_settings(book_dir)
+            os.makedirs(settings.dst_dir, exist_ok=True)
+            logging.info(f"{name}: starting")
+            Pipeline(settings, status_queue=_LogStatusQueue(name), cancel=self.cancel_event,
+                     chapter_scheduler=self.chapter_scheduler).run()
+            result = "cancelled" if self.cancel_event.is_set() else "finished"
+        except PreflightError as e:
+            result = "preflight_error"
+            logging.error(f"{name}: {e}")
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            metrics.counter("books_total", "Books processed by the watch folder").inc(result=result)
+            self.write_metrics()
+            with self._lock:
+                self._processed[book_dir] = snapshot
+                del self._jobs[book_dir]
+
+    def write_metrics(self):
+        """Writes the metrics for the node exporter's textfile collector, if a metrics textfile is set."""
+        if self.metrics_textfile is None:
+            return
+        try:
+            metrics.REGISTRY.write_prometheus_textfile(self.metrics_textfile)
+        except OSError as e:
+            logging.exception(e)
+
+    def run(self):
+        """Watches the inbox until stop() is called."""
+        logging.info(f"Watching {self.inbox}")
+        try:
+            while not self.cancel_event.is_set():
+                try:
+                    self.poll()
+                except OSError as e:
+                    logging.exception(e)
+                self.cancel_event.wait(self.poll_seconds)
+        finally:
+            self.cancel_event.set()
+            self._executor.shutdown(wait=True)
+            self.chapter_scheduler.shutdown()
+
+    def stop(self):
+        """Stops watching and cancels the running books."""
+        self.cancel_event.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Interleave book pairs as they are dropped into an inbox folder.")
+    parser.add_argument('inbox')
+    parser.add_argument('outbox')
+    parser.add_argument('--settings', default=None, help="Path to a JSON file of JobSettings used for every book")
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help="Seconds a book's files must stay unchanged before it's processed")
+    parser.add_argument('--poll', type=float, default=POLL_SECONDS, help="Seconds between scans of the inbox")
+    parser.add_argument('--books', type=int, default=1, help="Number of books to process at the same time")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of chapter worker processes")
+    parser.add_argument('--metrics-textfile', default=None, metavar='PATH',
+                        help="Prometheus textfile updated after each book, for the node exporter's textfile collector")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    settings = JobSettings()
+    if args.settings is not None:
+        with open(args.settings) as f:
+            settings = JobSettings.from_dict(json.load(f))
+    if args.jobs is not None:
+        settings.max_jobs = args.jobs
+    watcher = WatchFolder(args.inbox, args.outbox, settings, args.settle, args.poll, args.books,
+                          metrics_textfile=args.metrics_textfile)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())